@@ -1,25 +1,49 @@
+import time
+
+_MODULE_STARTED = time.perf_counter()
+
 import streamlit as st
 import sqlite3
 import pandas as pd
 import datetime
-import google.generativeai as genai
 import json
-from PIL import Image
+import hashlib
+import unicodedata
 import io
+import difflib
+import re
+import os
+import random
+import sys
+import threading
+import uuid
+import functools
+import logging
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from typing import TypedDict
+
+# google.generativeai と PIL は重いので、使う処理の中で import する（_get_genai / _import_pil）
+_IMPORTS_S = time.perf_counter() - _MODULE_STARTED
+
+logger = logging.getLogger("diet_app")
 
 # =============================
 # Page / Theme
 # =============================
-st.set_page_config(
-    page_title="ウェルネスダイアリー",
-    page_icon="💪",
-    layout="wide",
-    initial_sidebar_state="expanded",
-)
+def _setup_page():
+    """ページ設定と共通スタイル。st.set_page_config は描画の最初に1回だけ呼ぶ必要がある。"""
+    st.set_page_config(
+        page_title="ウェルネスダイアリー",
+        page_icon="💪",
+        layout="wide",
+        initial_sidebar_state="expanded",
+    )
 
-# ---- Global Styles (accessible, minimal, modern) ----
-st.markdown(
-    """
+    # ---- Global Styles (accessible, minimal, modern) ----
+    st.markdown(
+        """
     <style>
   @import url('https://fonts.googleapis.com/css2?family=Noto+Sans+JP:wght@400;500;700&display=swap');
   @import url('https://fonts.googleapis.com/css2?family=Material+Symbols+Outlined:wght@400');
@@ -120,34 +144,308 @@ st.markdown(
   }
 </style>
     """,
-    unsafe_allow_html=True,
-)
+        unsafe_allow_html=True,
+    )
+
 
 # =============================
 # API Key (Gemini)
 # =============================
-try:
-    GOOGLE_API_KEY = st.secrets["GOOGLE_API_KEY"]
-    genai.configure(api_key=GOOGLE_API_KEY)
-except (KeyError, FileNotFoundError):
-    st.error("⚠️ Google APIキーが設定されていません。")
-    st.info("Streamlit の Secrets に `GOOGLE_API_KEY` を設定してください。")
-    st.stop()
+def _get_api_key():
+    """Secrets（無ければ環境変数）から API キーを返す。未設定なら None。"""
+    try:
+        return st.secrets["GOOGLE_API_KEY"]
+    except (KeyError, FileNotFoundError):
+        return os.environ.get("GOOGLE_API_KEY")
+
+
+def _require_api_key():
+    # ここではキーの有無だけ確認し、genai の import と configure は初回の呼び出しまで遅らせる
+    if not _get_api_key():
+        st.error("⚠️ Google APIキーが設定されていません。")
+        st.info("Streamlit の Secrets に `GOOGLE_API_KEY` を設定してください。")
+        st.stop()
+
+
+# -----------------------------
+# Lazy imports / startup timing
+# -----------------------------
+@st.cache_resource
+def _get_startup_report() -> dict:
+    """起動計測。cold は プロセス最初の実行、last_run_s は直前の再実行の所要時間。"""
+    return {"cold": None, "last_run_s": None, "lazy_imports": {}}
+
+
+def _record_lazy_import(name: str, started: float):
+    _get_startup_report()["lazy_imports"][name] = time.perf_counter() - started
+
+
+def _record_run(run_s: float):
+    report = _get_startup_report()
+    if report["cold"] is None:
+        report["cold"] = {"imports_s": _IMPORTS_S, "module_s": _MODULE_S, "first_run_s": run_s}
+        logger.info("cold start: %s", json.dumps(report["cold"]))
+    report["last_run_s"] = run_s
+
+
+def format_startup_report() -> str:
+    report = _get_startup_report()
+    cold = report["cold"]
+    parts = []
+    if cold:
+        parts.append(
+            f"起動: import {cold['imports_s'] * 1000:.0f}ms / モジュール全体 {cold['module_s'] * 1000:.0f}ms / "
+            f"初回描画 {cold['first_run_s'] * 1000:.0f}ms"
+        )
+    if report["last_run_s"] is not None:
+        parts.append(f"直前の再実行 {report['last_run_s'] * 1000:.0f}ms")
+    for name, seconds in report["lazy_imports"].items():
+        parts.append(f"{name} 読込 {seconds * 1000:.0f}ms")
+    return "・".join(parts)
+
+
+@st.cache_resource
+def _get_genai():
+    """google.generativeai を import して API キーを設定する（初回の Gemini 呼び出し時に1回だけ）。"""
+    started = time.perf_counter()
+    import google.generativeai as genai
+    if GEMINI_API_ENDPOINT:
+        genai.configure(api_key=_get_api_key(), transport="rest", client_options={"api_endpoint": GEMINI_API_ENDPOINT})
+    else:
+        genai.configure(api_key=_get_api_key())
+    _record_lazy_import("genai", started)
+    return genai
+
+
+def _import_pil():
+    """PIL は画像入力でしか使わないので、その処理に入ったときに import する。"""
+    started = time.perf_counter()
+    first_import = "PIL.ImageOps" not in sys.modules
+    from PIL import Image, ImageOps
+    if first_import:
+        _record_lazy_import("PIL", started)
+    return Image, ImageOps
+
 
 # =============================
-# Database (SQLite)
+# Metrics
 # =============================
-DB_FILE = "diet_records.db"
+# DB ヘルパー・Gemini 呼び出し・描画セクションの所要時間などをプロセス内に貯め、
+# 構造化ログ（1行1JSON）として diet_app.metrics ロガーに出す。
+# DIET_APP_METRICS_LOG にパスを指定するとそのファイルに追記する（未指定ならロガーの設定に従う）。
+METRICS_WINDOW = 1000   # 操作ごとに保持する直近サンプル数（p50/p95 の計算対象）
+METRICS_LOG_FILE = os.environ.get("DIET_APP_METRICS_LOG")
+metrics_logger = logging.getLogger("diet_app.metrics")
+
+
+class _OpStats:
+    __slots__ = ("count", "errors", "samples", "totals")
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.samples = deque(maxlen=METRICS_WINDOW)
+        self.totals = {}
+
+
+class _Metrics:
+    """操作名ごとのレイテンシ（直近 METRICS_WINDOW 件）と、行数・トークン数などの累計。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ops = {}
+
+    def record(self, op: str, elapsed_s: float, ok: bool = True, **fields):
+        ms = elapsed_s * 1000
+        with self._lock:
+            stats = self._ops.get(op)
+            if stats is None:
+                stats = self._ops[op] = _OpStats()
+            stats.count += 1
+            stats.errors += 0 if ok else 1
+            stats.samples.append(ms)
+            for key, value in fields.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    stats.totals[key] = stats.totals.get(key, 0) + value
+        if metrics_logger.isEnabledFor(logging.INFO):
+            metrics_logger.info(json.dumps(
+                {"ts": round(time.time(), 3), "op": op, "ms": round(ms, 3), "ok": ok, **fields},
+                ensure_ascii=False, default=str,
+            ))
+
+    def summary(self) -> list:
+        """操作ごとの件数・失敗数・p50/p95/最大（ms）と、数値フィールドの1回あたり平均。"""
+        with self._lock:
+            items = [(op, s.count, s.errors, sorted(s.samples), dict(s.totals)) for op, s in self._ops.items()]
+        rows = []
+        for op, count, errors, samples, totals in sorted(items):
+            row = {
+                "op": op,
+                "count": count,
+                "errors": errors,
+                "p50_ms": _percentile(samples, 0.50),
+                "p95_ms": _percentile(samples, 0.95),
+                "max_ms": samples[-1] if samples else None,
+            }
+            row.update({f"avg_{key}": value / count for key, value in totals.items()})
+            rows.append(row)
+        return rows
 
-def get_db_connection():
-    conn = sqlite3.connect(DB_FILE)
+    def reset(self):
+        with self._lock:
+            self._ops.clear()
+
+
+def _percentile(sorted_values: list, q: float):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(round(q * (len(sorted_values) - 1))))]
+
+
+@st.cache_resource
+def _get_metrics() -> _Metrics:
+    if METRICS_LOG_FILE:
+        handler = logging.FileHandler(METRICS_LOG_FILE, encoding="utf-8")
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        metrics_logger.addHandler(handler)
+        metrics_logger.setLevel(logging.INFO)
+        metrics_logger.propagate = False
+    return _Metrics()
+
+
+def _result_rows(result):
+    """戻り値から行数を取り出す（DataFrame / (DataFrame, カーソル) のときだけ）。"""
+    if isinstance(result, tuple) and result:
+        result = result[0]
+    return len(result) if isinstance(result, pd.DataFrame) else None
+
+
+def instrumented(op: str, rows=_result_rows):
+    """関数の所要時間・成否・行数を op 名で記録するデコレータ。rows は戻り値→行数の関数。"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            ok = False
+            result = None
+            try:
+                result = func(*args, **kwargs)
+                ok = True
+                return result
+            finally:
+                fields = {}
+                if ok and rows is not None:
+                    count = rows(result)
+                    if count is not None:
+                        fields["rows"] = count
+                _get_metrics().record(op, time.perf_counter() - started, ok, **fields)
+        return wrapper
+    return decorator
+
+
+def _section_timer(prefix: str):
+    """描画セクション用のラップタイマー。lap(name) で前回の lap からの経過時間を記録する。"""
+    last = [time.perf_counter()]
+
+    def lap(name: str):
+        now = time.perf_counter()
+        _get_metrics().record(f"{prefix}.{name}", now - last[0])
+        last[0] = now
+
+    return lap
+
+# =============================
+# Database (SQLite)
+# =============================
+DB_FILE = os.environ.get("DIET_APP_DB_FILE", "diet_records.db")  # ベンチマーク等で別DBを使うときは環境変数で指定
+DB_POOL_SIZE = 8              # プロセス内で保持する接続数の上限
+DB_BUSY_TIMEOUT_MS = 5000     # ロック競合時の待ち時間
+DB_SYNCHRONOUS = "NORMAL"     # WAL では NORMAL でも整合性は保たれる
+DB_CACHED_STATEMENTS = 256    # 接続ごとのプリペアドステートメントキャッシュ
+
+
+def _open_db_connection():
+    """WAL・busy_timeout などを設定した新しい接続を開く。"""
+    conn = sqlite3.connect(
+        DB_FILE,
+        timeout=DB_BUSY_TIMEOUT_MS / 1000,
+        check_same_thread=False,
+        cached_statements=DB_CACHED_STATEMENTS,
+    )
     conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(f"PRAGMA synchronous={DB_SYNCHRONOUS}")
+    conn.execute(f"PRAGMA busy_timeout={int(DB_BUSY_TIMEOUT_MS)}")
     return conn
 
 
-def init_db():
-    conn = get_db_connection()
-    c = conn.cursor()
+class _ConnectionPool:
+    """プロセス内で長寿命の接続を使い回すプール。
+
+    Streamlit は再実行ごとに別スレッドでスクリプトを走らせるため、スレッドローカルではなく
+    貸し出し/返却型にしている。fork 後は親プロセスの接続を使わないよう作り直す。
+    """
+
+    def __init__(self, size: int, opener=None):
+        self.size = size
+        self._opener = opener or _open_db_connection
+        self._lock = threading.Lock()
+        self._idle = []
+        self._pid = os.getpid()
+
+    def _reset_if_forked(self):
+        if self._pid != os.getpid():
+            self._idle = []
+            self._pid = os.getpid()
+
+    def acquire(self):
+        with self._lock:
+            self._reset_if_forked()
+            if self._idle:
+                return self._idle.pop()
+        return self._opener()
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            if self._pid == os.getpid() and len(self._idle) < self.size:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+
+@st.cache_resource
+def _get_db_pool():
+    """再実行をまたいでプロセス内で共有する接続プール。"""
+    return _ConnectionPool(DB_POOL_SIZE)
+
+
+@contextmanager
+def get_db_connection():
+    """プールから接続を借りて返す（close は不要）。"""
+    pool = _get_db_pool()
+    conn = pool.acquire()
+    try:
+        yield conn
+    finally:
+        pool.release(conn)
+
+
+@contextmanager
+def db_transaction():
+    """1トランザクション（=1回のコミット）で書き込みを行う。例外時はロールバック。"""
+    with get_db_connection() as conn:
+        with conn:
+            yield conn
+
+
+# -----------------------------
+# Schema migrations
+# -----------------------------
+# 追加するときは末尾にバージョン番号を増やして足す（既存の番号は書き換えない）。
+
+def _m001_create_tables(c):
     # 食事記録テーブル
     c.execute(
         """
@@ -179,135 +477,1598 @@ def init_db():
         )
         """
     )
-    
+
+
+def _m002_add_is_favorite(c):
+    # 旧バージョンで作られた meals には is_favorite が無い
     c.execute("PRAGMA table_info(meals)")
     columns = [row['name'] for row in c.fetchall()]
     if 'is_favorite' not in columns:
         c.execute("ALTER TABLE meals ADD COLUMN is_favorite INTEGER NOT NULL DEFAULT 0")
 
-    conn.commit()
-    conn.close()
 
+def _m003_add_indexes(c):
+    # 一覧の ORDER BY date DESC, id DESC / 期間抽出 / お気に入り抽出をインデックスで処理する
+    c.execute("CREATE INDEX IF NOT EXISTS idx_meals_date_id ON meals(date, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_meals_favorite_name ON meals(is_favorite, food_name)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_meals_type_date ON meals(meal_type, date)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_exercises_date_id ON exercises(date, id)")
 
-# CRUD helpers for Meals
 
-def add_record(date, meal_type, food_name, nutrients):
-    conn = get_db_connection()
-    c = conn.cursor()
+# daily_totals の栄養素列。マイグレーションは凍結しておくため NUTRIENT_COLUMNS とは別に持つ。
+_DAILY_TOTAL_NUTRIENTS = ("calories", "protein", "carbohydrates", "fat", "vitamin_d", "salt", "zinc", "folic_acid")
+_DAILY_TOTAL_EXCLUDED = "('水分補給')"
+
+
+def _rebuild_daily_totals(c):
+    """daily_totals を meals / exercises から作り直す。"""
+    cols = ", ".join(_DAILY_TOTAL_NUTRIENTS)
+    sums = ", ".join(f"SUM(COALESCE({n}, 0)) AS {n}" for n in _DAILY_TOTAL_NUTRIENTS)
+    picks = ", ".join(f"COALESCE(m.{n}, 0)" for n in _DAILY_TOTAL_NUTRIENTS)
+    c.execute("DELETE FROM daily_totals")
+    c.execute(
+        f"""
+        INSERT INTO daily_totals (date, {cols}, meal_count, exercise_minutes, exercise_count)
+        SELECT d.date, {picks}, COALESCE(m.meal_count, 0),
+               COALESCE(e.exercise_minutes, 0), COALESCE(e.exercise_count, 0)
+        FROM (
+            SELECT date FROM meals WHERE meal_type NOT IN {_DAILY_TOTAL_EXCLUDED}
+            UNION
+            SELECT date FROM exercises
+        ) AS d
+        LEFT JOIN (
+            SELECT date, {sums}, COUNT(*) AS meal_count
+            FROM meals WHERE meal_type NOT IN {_DAILY_TOTAL_EXCLUDED} GROUP BY date
+        ) AS m ON m.date = d.date
+        LEFT JOIN (
+            SELECT date, SUM(duration_minutes) AS exercise_minutes, COUNT(*) AS exercise_count
+            FROM exercises GROUP BY date
+        ) AS e ON e.date = d.date
+        """
+    )
+
+
+def _m004_daily_totals(c):
+    # 1日1行の集計テーブル。meals / exercises への書き込みはトリガーで差分反映する。
+    nutrient_defs = ", ".join(f"{n} REAL NOT NULL DEFAULT 0" for n in _DAILY_TOTAL_NUTRIENTS)
     c.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS daily_totals (
+            date TEXT PRIMARY KEY,
+            {nutrient_defs},
+            meal_count INTEGER NOT NULL DEFAULT 0,
+            exercise_minutes INTEGER NOT NULL DEFAULT 0,
+            exercise_count INTEGER NOT NULL DEFAULT 0
+        )
         """
-        INSERT INTO meals (date, meal_type, food_name, calories, protein, carbohydrates, fat, vitamin_d, salt, zinc, folic_acid)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """,
-        (
-            date.strftime("%Y-%m-%d"),
-            meal_type,
-            food_name,
-            nutrients.get("calories"),
-            nutrients.get("protein"),
-            nutrients.get("carbohydrates"),
-            nutrients.get("fat"),
-            nutrients.get("vitaminD"),
-            nutrients.get("salt"),
-            nutrients.get("zinc"),
-            nutrients.get("folic_acid"),
-        ),
     )
-    conn.commit()
-    conn.close()
 
+    def add_meal(row, sign):
+        sets = ", ".join(f"{n} = {n} {sign} COALESCE({row}.{n}, 0)" for n in _DAILY_TOTAL_NUTRIENTS)
+        return f"UPDATE daily_totals SET {sets}, meal_count = meal_count {sign} 1 WHERE date = {row}.date;"
+
+    def add_exercise(row, sign):
+        return (
+            f"UPDATE daily_totals SET exercise_minutes = exercise_minutes {sign} COALESCE({row}.duration_minutes, 0), "
+            f"exercise_count = exercise_count {sign} 1 WHERE date = {row}.date;"
+        )
+
+    ensure_new = "INSERT OR IGNORE INTO daily_totals (date) VALUES (NEW.date);"
+    drop_empty = "DELETE FROM daily_totals WHERE date = OLD.date AND meal_count = 0 AND exercise_count = 0;"
+    counted_new = f"NEW.meal_type NOT IN {_DAILY_TOTAL_EXCLUDED}"
+    counted_old = f"OLD.meal_type NOT IN {_DAILY_TOTAL_EXCLUDED}"
+    triggers = {
+        "trg_meals_ai_totals": f"AFTER INSERT ON meals WHEN {counted_new} BEGIN {ensure_new} {add_meal('NEW', '+')} END",
+        "trg_meals_ad_totals": f"AFTER DELETE ON meals WHEN {counted_old} BEGIN {add_meal('OLD', '-')} {drop_empty} END",
+        # UPDATE は「旧行を引く」「新行を足す」の2本に分ける（加減算なので発火順に依存しない）
+        "trg_meals_au_old_totals": f"AFTER UPDATE ON meals WHEN {counted_old} BEGIN {add_meal('OLD', '-')} {drop_empty} END",
+        "trg_meals_au_new_totals": f"AFTER UPDATE ON meals WHEN {counted_new} BEGIN {ensure_new} {add_meal('NEW', '+')} END",
+        "trg_exercises_ai_totals": f"AFTER INSERT ON exercises BEGIN {ensure_new} {add_exercise('NEW', '+')} END",
+        "trg_exercises_ad_totals": f"AFTER DELETE ON exercises BEGIN {add_exercise('OLD', '-')} {drop_empty} END",
+        "trg_exercises_au_old_totals": f"AFTER UPDATE ON exercises BEGIN {add_exercise('OLD', '-')} {drop_empty} END",
+        "trg_exercises_au_new_totals": f"AFTER UPDATE ON exercises BEGIN {ensure_new} {add_exercise('NEW', '+')} END",
+    }
+    for name, body in triggers.items():
+        c.execute(f"CREATE TRIGGER IF NOT EXISTS {name} {body}")
+    # 既存データベースの分を埋める
+    _rebuild_daily_totals(c)
+
+
+def _m005_analysis_cache(c):
+    # Gemini の栄養解析結果キャッシュ（入力内容のハッシュがキー）
+    c.execute(
+        """
+        CREATE TABLE IF NOT EXISTS analysis_cache (
+            cache_key TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            model TEXT NOT NULL,
+            prompt_version TEXT NOT NULL,
+            result_json TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            last_used_at REAL NOT NULL,
+            hit_count INTEGER NOT NULL DEFAULT 0
+        )
+        """
+    )
+    c.execute("CREATE INDEX IF NOT EXISTS idx_analysis_cache_last_used ON analysis_cache(last_used_at)")
+
+
+MIGRATIONS = [
+    (1, "create meals / exercises", _m001_create_tables),
+    (2, "meals.is_favorite", _m002_add_is_favorite),
+    (3, "indexes for list / period / favorite queries", _m003_add_indexes),
+    (4, "daily_totals rollup + triggers", _m004_daily_totals),
+    (5, "analysis_cache", _m005_analysis_cache),
+]
+
+
+def _current_schema_version(conn) -> int:
+    row = conn.execute("SELECT MAX(version) AS v FROM schema_version").fetchone()
+    return int(row["v"] or 0)
+
+
+def migrate_db():
+    """未適用のマイグレーションを順に適用し、適用後のバージョンを返す。"""
+    with get_db_connection() as conn:
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                description TEXT NOT NULL,
+                applied_at TEXT NOT NULL
+            )
+            """
+        )
+        for version, description, func in MIGRATIONS:
+            if version <= _current_schema_version(conn):
+                continue
+            # BEGIN IMMEDIATE で他プロセスと直列化し、取得後にもう一度バージョンを確認する
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if version > _current_schema_version(conn):
+                    func(conn.cursor())
+                    conn.execute(
+                        "INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)",
+                        (version, description, datetime.datetime.now().isoformat(timespec="seconds")),
+                    )
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        return _current_schema_version(conn)
+
+
+@st.cache_resource
+def init_db():
+    """プロセス起動後の初回だけマイグレーションを実行する（再実行ごとには走らない）。"""
+    return migrate_db()
+
+
+@instrumented("db.rebuild_daily_totals")
+def rebuild_daily_totals():
+    """daily_totals を全件から再集計する（手作業でDBを触った後などの整合性回復用）。"""
+    with db_transaction() as conn:
+        _rebuild_daily_totals(conn.cursor())
+    _bump_data_version("meals")
+    _bump_data_version("exercises")
+
+
+# -----------------------------
+# Read cache (data-version based)
+# -----------------------------
+# 読み取り系ヘルパーは「テーブルごとのデータバージョン」をキーに st.cache_data でキャッシュする。
+# 書き込み系ヘルパーはコミット後にバージョンを進めるので、変更が無い限り再実行しても DB を読まない。
+# st.cache_data は呼び出しごとにコピーを返すため、呼び出し側で DataFrame を書き換えても安全。
+
+class _DataVersions:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._versions = {"meals": 0, "exercises": 0}
+
+    def get(self, table: str) -> int:
+        return self._versions[table]
+
+    def bump(self, table: str) -> int:
+        with self._lock:
+            self._versions[table] += 1
+            return self._versions[table]
+
+
+@st.cache_resource
+def _get_data_versions():
+    return _DataVersions()
+
+
+def data_version(table: str) -> int:
+    return _get_data_versions().get(table)
+
+
+def _bump_data_version(table: str) -> int:
+    return _get_data_versions().bump(table)
+
+
+# -----------------------------
+# Keyset pagination (date DESC, id DESC)
+# -----------------------------
+# OFFSET を使うと後ろのページほど読み飛ばしが増えるため、直前ページ末尾の (date, id) を
+# カーソルにして idx_*_date_id インデックスから続きを読む。
+
+def _fetch_page(conn, table: str, where: list, params: list, cursor, page_size: int):
+    where = list(where)
+    params = list(params)
+    if cursor:
+        where.append("(date, id) < (?, ?)")
+        params += [cursor[0], int(cursor[1])]
+    sql = f"SELECT * FROM {table}"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY date DESC, id DESC LIMIT ?"
+    # 1件多く読んで次ページの有無を判定する
+    params.append(int(page_size) + 1)
+    df = pd.read_sql_query(sql, conn, params=params)
+    next_cursor = None
+    if len(df) > page_size:
+        df = df.iloc[:page_size]
+        last = df.iloc[-1]
+        next_cursor = (str(last["date"]), int(last["id"]))
+    return df, next_cursor
+
+
+def _date_filters(date_from, date_to):
+    where, params = [], []
+    if date_from:
+        where.append("date >= ?")
+        params.append(date_from.strftime("%Y-%m-%d"))
+    if date_to:
+        where.append("date <= ?")
+        params.append(date_to.strftime("%Y-%m-%d"))
+    return where, params
+
+
+# CRUD helpers for Meals
+
+_INSERT_MEAL_SQL = """
+    INSERT INTO meals (date, meal_type, food_name, calories, protein, carbohydrates, fat, vitamin_d, salt, zinc, folic_acid)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+_SQL_IN_CHUNK = 500  # IN (...) 1回あたりのプレースホルダ数
+
+
+def _meal_row(date, meal_type, food_name, nutrients):
+    nutrients = nutrients or {}
+    return (
+        date.strftime("%Y-%m-%d"),
+        meal_type,
+        food_name,
+        nutrients.get("calories"),
+        nutrients.get("protein"),
+        nutrients.get("carbohydrates"),
+        nutrients.get("fat"),
+        nutrients.get("vitaminD"),
+        nutrients.get("salt"),
+        nutrients.get("zinc"),
+        nutrients.get("folic_acid"),
+    )
+
+
+def _chunks(ids, size=_SQL_IN_CHUNK):
+    ids = [int(i) for i in ids]
+    for i in range(0, len(ids), size):
+        yield ids[i:i + size]
+
+
+@instrumented("db.add_record")
+def add_record(date, meal_type, food_name, nutrients):
+    row = _meal_row(date, meal_type, food_name, nutrients)
+    with db_transaction() as conn:
+        conn.execute(_INSERT_MEAL_SQL, row)
+    _get_food_index().add_rows([row], _bump_data_version("meals"))
+
+
+@instrumented("db.add_records", rows=lambda n: n)
+def add_records(records):
+    """(date, meal_type, food_name, nutrients) のリストを1トランザクションでまとめて登録する。"""
+    rows = [_meal_row(*r) for r in records]
+    if not rows:
+        return 0
+    with db_transaction() as conn:
+        conn.executemany(_INSERT_MEAL_SQL, rows)
+    _get_food_index().add_rows(rows, _bump_data_version("meals"))
+    return len(rows)
+
+
+@st.cache_data(max_entries=2, show_spinner=False)
+def _load_all_records(version: int):
+    with get_db_connection() as conn:
+        return pd.read_sql_query("SELECT * FROM meals ORDER BY date DESC, id DESC", conn)
+
+
+@instrumented("db.get_all_records")
+def get_all_records():
+    return _load_all_records(data_version("meals"))
+
+
+@instrumented("db.get_records_by_period")
+def get_records_by_period(start_date, end_date):
+    query = "SELECT * FROM meals WHERE date BETWEEN ? AND ? ORDER BY date DESC, id DESC"
+    with get_db_connection() as conn:
+        return pd.read_sql_query(
+            query,
+            conn,
+            params=(start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d")),
+        )
+
+
+NUTRIENT_COLUMNS = ["calories", "protein", "carbohydrates", "fat", "vitamin_d", "salt", "zinc", "folic_acid"]
+
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def _load_daily_totals(start: str, end: str, meals_version: int, exercises_version: int):
+    with get_db_connection() as conn:
+        return pd.read_sql_query(
+            "SELECT * FROM daily_totals WHERE date BETWEEN ? AND ? ORDER BY date",
+            conn,
+            params=(start, end),
+        )
+
+
+@instrumented("db.get_daily_totals")
+def get_daily_totals(start_date, end_date=None):
+    """日付（または期間）ごとの栄養素合計・記録数・運動時間を daily_totals から返す。
+
+    栄養素合計と meal_count は水分補給を除外している。記録の無い日は行が含まれない。
+    """
+    end_date = end_date or start_date
+    return _load_daily_totals(
+        start_date.strftime("%Y-%m-%d"),
+        end_date.strftime("%Y-%m-%d"),
+        data_version("meals"),
+        data_version("exercises"),
+    )
+
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def _load_records_page(cursor, page_size, date_from, date_to, meal_types, version: int):
+    where, params = _date_filters(date_from, date_to)
+    if meal_types:
+        where.append(f"meal_type IN ({', '.join('?' for _ in meal_types)})")
+        params += list(meal_types)
+    with get_db_connection() as conn:
+        return _fetch_page(conn, "meals", where, params, cursor, page_size)
+
+
+@instrumented("db.get_records_page")
+def get_records_page(page_size=50, cursor=None, date_from=None, date_to=None, meal_types=None):
+    """食事記録を新しい順に1ページ分返す。戻り値は (DataFrame, 次ページのカーソル or None)。"""
+    return _load_records_page(
+        tuple(cursor) if cursor else None,
+        int(page_size),
+        date_from,
+        date_to,
+        tuple(meal_types or ()),
+        data_version("meals"),
+    )
+
+
+@instrumented("db.delete_record")
+def delete_record(record_id):
+    with db_transaction() as conn:
+        conn.execute("DELETE FROM meals WHERE id = ?", (record_id,))
+    _bump_data_version("meals")
+
+@st.cache_data(max_entries=2, show_spinner=False)
+def _load_favorite_meals(version: int):
+    with get_db_connection() as conn:
+        return pd.read_sql_query("SELECT * FROM meals WHERE is_favorite = 1 ORDER BY food_name ASC", conn)
+
+@instrumented("db.get_favorite_meals")
+def get_favorite_meals():
+    return _load_favorite_meals(data_version("meals"))
+
+@instrumented("db.update_favorite_status")
+def update_favorite_status(meal_id, is_favorite):
+    with db_transaction() as conn:
+        conn.execute("UPDATE meals SET is_favorite = ? WHERE id = ?", (1 if is_favorite else 0, meal_id))
+    _bump_data_version("meals")
+
+@instrumented("db.delete_records")
+def delete_records(record_ids):
+    """複数の食事記録を1トランザクションで削除する。"""
+    ids = list(record_ids)
+    if not ids:
+        return
+    with db_transaction() as conn:
+        for chunk in _chunks(ids):
+            conn.execute(f"DELETE FROM meals WHERE id IN ({', '.join('?' for _ in chunk)})", chunk)
+    _bump_data_version("meals")
+
+@instrumented("db.update_favorite_statuses")
+def update_favorite_statuses(favorite_ids, unfavorite_ids):
+    """お気に入りの付け外しを1回の UPDATE（チャンク単位）で反映する。"""
+    on_ids = {int(i) for i in favorite_ids}
+    all_ids = sorted(on_ids | {int(i) for i in unfavorite_ids})
+    if not all_ids:
+        return
+    with db_transaction() as conn:
+        for chunk in _chunks(all_ids):
+            on_chunk = [i for i in chunk if i in on_ids]
+            marks = ", ".join("?" for _ in chunk)
+            on_marks = ", ".join("?" for _ in on_chunk)  # SQLite は空の IN () を許容する
+            conn.execute(
+                f"UPDATE meals SET is_favorite = (id IN ({on_marks})) WHERE id IN ({marks})",
+                on_chunk + chunk,
+            )
+    _bump_data_version("meals")
+
+
+# CRUD helpers for Exercises
+@instrumented("db.add_exercise_record")
+def add_exercise_record(date, exercise_name, duration_minutes):
+    with db_transaction() as conn:
+        conn.execute(
+            "INSERT INTO exercises (date, exercise_name, duration_minutes) VALUES (?, ?, ?)",
+            (date.strftime("%Y-%m-%d"), exercise_name, duration_minutes)
+        )
+    _bump_data_version("exercises")
+
+@st.cache_data(max_entries=2, show_spinner=False)
+def _load_all_exercise_records(version: int):
+    with get_db_connection() as conn:
+        return pd.read_sql_query("SELECT * FROM exercises ORDER BY date DESC, id DESC", conn)
+
+@instrumented("db.get_all_exercise_records")
+def get_all_exercise_records():
+    return _load_all_exercise_records(data_version("exercises"))
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def _load_exercise_records_page(cursor, page_size, date_from, date_to, version: int):
+    where, params = _date_filters(date_from, date_to)
+    with get_db_connection() as conn:
+        return _fetch_page(conn, "exercises", where, params, cursor, page_size)
+
+@instrumented("db.get_exercise_records_page")
+def get_exercise_records_page(page_size=50, cursor=None, date_from=None, date_to=None):
+    """運動記録を新しい順に1ページ分返す。戻り値は (DataFrame, 次ページのカーソル or None)。"""
+    return _load_exercise_records_page(
+        tuple(cursor) if cursor else None,
+        int(page_size),
+        date_from,
+        date_to,
+        data_version("exercises"),
+    )
+
+@instrumented("db.get_exercise_records_by_period")
+def get_exercise_records_by_period(start_date, end_date):
+    query = "SELECT * FROM exercises WHERE date BETWEEN ? AND ? ORDER BY date DESC, id DESC"
+    with get_db_connection() as conn:
+        return pd.read_sql_query(
+            query,
+            conn,
+            params=(start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d")),
+        )
+
+@instrumented("db.delete_exercise_record")
+def delete_exercise_record(record_id):
+    with db_transaction() as conn:
+        conn.execute("DELETE FROM exercises WHERE id = ?", (record_id,))
+    _bump_data_version("exercises")
+
+@instrumented("db.delete_exercise_records")
+def delete_exercise_records(record_ids):
+    """複数の運動記録を1トランザクションで削除する。"""
+    ids = list(record_ids)
+    if not ids:
+        return
+    with db_transaction() as conn:
+        for chunk in _chunks(ids):
+            conn.execute(f"DELETE FROM exercises WHERE id IN ({', '.join('?' for _ in chunk)})", chunk)
+    _bump_data_version("exercises")
+
+@st.cache_data(max_entries=2, show_spinner=False)
+def _load_unique_exercise_names(version: int):
+    with get_db_connection() as conn:
+        df = pd.read_sql_query("SELECT DISTINCT exercise_name FROM exercises ORDER BY exercise_name", conn)
+        return df['exercise_name'].tolist()
+
+@instrumented("db.get_unique_exercise_names")
+def get_unique_exercise_names():
+    return _load_unique_exercise_names(data_version("exercises"))
+
+
+# =============================
+# History-backed food lookup
+# =============================
+# よく食べる料理は過去の記録から栄養値を推定し、AI を呼ばずに済ませる。
+# 料理名ごとに直近の記録を最大 FOOD_INDEX_MAX_SAMPLES 件持ち、中央値を推定値にする。
+FOOD_INDEX_MAX_SAMPLES = 20
+FOOD_INDEX_FUZZY_CUTOFF = 0.85
+_FOOD_INDEX_EXCLUDED = ("水分補給",)
+# DB の列名 → 解析結果（analyze_*_with_gemini）のキー
+_NUTRIENT_RESULT_KEYS = {
+    "calories": "calories", "protein": "protein", "carbohydrates": "carbohydrates", "fat": "fat",
+    "vitamin_d": "vitaminD", "salt": "salt", "zinc": "zinc", "folic_acid": "folic_acid",
+}
+# 類似一致でも、数量・単位・盛りの大きさ（「100g」と「200g」、「大盛り」と「並盛り」）が違えば別の料理とみなす
+_FOOD_QUALIFIER_RE = re.compile(
+    r"\d+(?:\.\d+)?(?:kg|g|ml|l|cc|個|本|枚|杯|切れ|切|皿|人前|貫|粒|袋|缶|パック|玉|合|口)?"
+    r"|大盛|並盛|中盛|小盛|特盛|メガ|ミニ|ハーフ|ダブル|大|中|小|半"
+)
+_FOOD_KEY_STRIP_RE = re.compile(r"[\s()（）\[\]［］「」『』【】,、。.:：!！?？~〜ー-]+")
+_FOOD_ITEM_SPLIT_RE = re.compile(r"[、,，。\n+＋・]")
+_FOOD_ITEM_TAIL_RE = re.compile(r"(を|は|も)?(食べ(た|ました)|飲(んだ|みました))?$")
+
+
+def food_key(name: str) -> str:
+    """料理名の照合キー（全角/半角・大小文字・空白・括弧や記号の揺れを除く）。"""
+    return _FOOD_KEY_STRIP_RE.sub("", unicodedata.normalize("NFKC", name or "").lower())
+
+
+def _food_qualifiers(key: str) -> list:
+    return sorted(_FOOD_QUALIFIER_RE.findall(key))
+
+
+class _FoodIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.version = None
+        self._samples = {}   # key -> list[tuple(nutrients...)]（新しい順）
+        self._names = {}     # key -> 表示用の料理名（最新の記録のもの）
+
+    def _add(self, food_name, values, append_new: bool):
+        key = food_key(food_name)
+        if not key:
+            return
+        samples = self._samples.setdefault(key, [])
+        vec = tuple(float(v) if v is not None else 0.0 for v in values)
+        if append_new:
+            samples.insert(0, vec)
+            self._names[key] = food_name
+        else:
+            samples.append(vec)
+            self._names.setdefault(key, food_name)
+        del samples[FOOD_INDEX_MAX_SAMPLES:]
+
+    def rebuild(self, version: int):
+        cols = ", ".join(NUTRIENT_COLUMNS)
+        marks = ", ".join("?" for _ in _FOOD_INDEX_EXCLUDED)
+        with get_db_connection() as conn:
+            rows = conn.execute(
+                f"SELECT food_name, {cols} FROM meals WHERE meal_type NOT IN ({marks}) ORDER BY id DESC",
+                _FOOD_INDEX_EXCLUDED,
+            ).fetchall()
+        with self._lock:
+            self._samples, self._names = {}, {}
+            for r in rows:
+                self._add(r["food_name"], tuple(r)[1:], append_new=False)
+            self.version = version
+
+    def add_rows(self, meal_rows, new_version: int):
+        """add_record/add_records で追加された行（_meal_row の形）を反映する。"""
+        with self._lock:
+            if self.version is None or self.version != new_version - 1:
+                # 未構築、または削除など別の変更が挟まった → 次回参照時に作り直す
+                return
+            for row in meal_rows:
+                if row[1] in _FOOD_INDEX_EXCLUDED:
+                    continue
+                self._add(row[2], row[3:], append_new=True)
+            self.version = new_version
+
+    def ensure_fresh(self):
+        version = data_version("meals")
+        if self.version != version:
+            self.rebuild(version)
+
+    def lookup(self, name: str):
+        """料理名に一致（なければ類似）する記録の (料理名, 中央値 dict, 件数) を返す。無ければ None。
+
+        類似一致は、数量・単位・盛りの大きさが完全に一致する候補に限る（量の違う料理の値を使わないため）。
+        """
+        key = food_key(name)
+        if not key:
+            return None
+        with self._lock:
+            if key not in self._samples:
+                qualifiers = _food_qualifiers(key)
+                close = [
+                    k for k in difflib.get_close_matches(key, list(self._samples), n=5, cutoff=FOOD_INDEX_FUZZY_CUTOFF)
+                    if _food_qualifiers(k) == qualifiers
+                ]
+                if not close:
+                    return None
+                key = close[0]
+            samples = list(self._samples[key])
+            name = self._names[key]
+        medians = pd.DataFrame(samples, columns=NUTRIENT_COLUMNS).median()
+        nutrients = {_NUTRIENT_RESULT_KEYS[c]: round(float(medians[c]), 2) for c in NUTRIENT_COLUMNS}
+        return name, nutrients, len(samples)
+
+    def __len__(self):
+        return len(self._samples)
+
+
+@st.cache_resource
+def _get_food_index():
+    return _FoodIndex()
+
+
+def _resolve_food_items(index, text: str):
+    """text を既知の料理名の並びとして解釈する。「とんかつ」のように「と」を含む料理名があるので、
+    丸ごと照合できなければ「と」の位置で前から順に区切りを試す。"""
+    hit = index.lookup(_FOOD_ITEM_TAIL_RE.sub("", text))
+    if hit:
+        return [hit]
+    for i, ch in enumerate(text):
+        if ch != "と" or i == 0:
+            continue
+        head = index.lookup(text[:i])
+        if head is None:
+            continue
+        rest = _resolve_food_items(index, text[i + 1:])
+        if rest is not None:
+            return [head] + rest
+    return None
+
+
+@instrumented("history.estimate_from_history")
+def estimate_from_history(description: str):
+    """記述の料理が全て過去の記録で見つかれば、analyze_text_with_gemini と同じ形の推定結果を返す。
+
+    1品でも見つからなければ None（AI に任せる）。
+    """
+    index = _get_food_index()
+    index.ensure_fresh()
+    parts = [p.strip() for p in _FOOD_ITEM_SPLIT_RE.split(unicodedata.normalize("NFKC", description or ""))]
+    parts = [p for p in parts if food_key(_FOOD_ITEM_TAIL_RE.sub("", p))]
+    if not parts or not len(index):
+        return None
+    dishes = []
+    for part in parts:
+        hits = _resolve_food_items(index, part)
+        if hits is None:
+            return None
+        for name, nutrients, n in hits:
+            dishes.append({"name": name, "rationale": f"過去の記録{n}件の中央値", "nutrients": nutrients})
+    totals = {k: round(sum(d["nutrients"][k] for d in dishes), 2) for k in _NUTRIENT_RESULT_KEYS.values()}
+    return {
+        "summary": "・".join(d["name"] for d in dishes),
+        "totalNutrients": totals,
+        "dishes": dishes,
+        "source": "history",
+    }
+
+
+# =============================
+# Gemini analysis cache
+# =============================
+# 同じ記述・同じ写真の再解析で API を呼ばないよう、入力内容のハッシュをキーに結果を保存する。
+# プロンプトを変えたら ANALYSIS_PROMPT_VERSION を上げること（古い結果はキーが変わって使われなくなる）。
+ANALYSIS_PROMPT_VERSION = "2"
+ANALYSIS_CACHE_MAX_ENTRIES = 500
+ANALYSIS_CACHE_TTL_DAYS = 30
+
+
+class _CacheStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def record(self, hit: bool):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+
+@st.cache_resource
+def _get_analysis_cache_stats():
+    return _CacheStats()
+
+
+def _normalize_description(text: str) -> str:
+    """全角/半角・大文字小文字・空白の揺れを吸収する。"""
+    t = unicodedata.normalize("NFKC", text or "").lower()
+    return " ".join(t.split())
+
+
+def analysis_cache_key(kind: str, model: str, payload) -> str:
+    """kind（text/image）・モデル名・プロンプト版・入力内容から SHA-256 キーを作る。"""
+    h = hashlib.sha256()
+    for part in (kind, model, ANALYSIS_PROMPT_VERSION):
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    h.update(payload if isinstance(payload, bytes) else _normalize_description(payload).encode("utf-8"))
+    return h.hexdigest()
+
+
+def analysis_cache_get(cache_key: str):
+    """キャッシュ済みの解析結果を返す。無い/期限切れなら None。"""
+    now = time.time()
+    oldest = now - ANALYSIS_CACHE_TTL_DAYS * 86400
+    with get_db_connection() as conn:
+        row = conn.execute(
+            "SELECT result_json FROM analysis_cache WHERE cache_key = ? AND created_at >= ?",
+            (cache_key, oldest),
+        ).fetchone()
+        if row is not None:
+            with conn:
+                conn.execute(
+                    "UPDATE analysis_cache SET last_used_at = ?, hit_count = hit_count + 1 WHERE cache_key = ?",
+                    (now, cache_key),
+                )
+    _get_analysis_cache_stats().record(row is not None)
+    return json.loads(row["result_json"]) if row is not None else None
+
+
+def analysis_cache_put(cache_key: str, kind: str, model: str, result: dict):
+    """解析結果を保存し、TTL 超過分と上限を超えた古い順（LRU）のエントリを削除する。"""
+    now = time.time()
+    with db_transaction() as conn:
+        conn.execute(
+            """
+            INSERT OR REPLACE INTO analysis_cache
+                (cache_key, kind, model, prompt_version, result_json, created_at, last_used_at, hit_count)
+            VALUES (?, ?, ?, ?, ?, ?, ?, 0)
+            """,
+            (cache_key, kind, model, ANALYSIS_PROMPT_VERSION, json.dumps(result, ensure_ascii=False), now, now),
+        )
+        conn.execute(
+            "DELETE FROM analysis_cache WHERE created_at < ?",
+            (now - ANALYSIS_CACHE_TTL_DAYS * 86400,),
+        )
+        conn.execute(
+            """
+            DELETE FROM analysis_cache WHERE cache_key IN (
+                SELECT cache_key FROM analysis_cache ORDER BY last_used_at DESC LIMIT -1 OFFSET ?
+            )
+            """,
+            (ANALYSIS_CACHE_MAX_ENTRIES,),
+        )
+
+
+def analysis_cache_stats() -> dict:
+    """このプロセスでのヒット/ミス数と保存件数を返す。"""
+    stats = _get_analysis_cache_stats()
+    with get_db_connection() as conn:
+        entries = conn.execute("SELECT COUNT(*) FROM analysis_cache").fetchone()[0]
+    total = stats.hits + stats.misses
+    return {
+        "hits": stats.hits,
+        "misses": stats.misses,
+        "hit_rate": (stats.hits / total) if total else 0.0,
+        "entries": entries,
+    }
+
+
+# =============================
+# Gemini model registry
+# =============================
+# モデル名はここで一元管理する。ヘルパーは役割名（"text" など）で参照する。
+GEMINI_MODELS = {
+    "advice": "gemini-2.5-flash",     # 相談タブのアドバイス
+    "text": "gemini-2.5-flash",       # フリー記述の栄養推定
+    "exercise": "gemini-2.5-flash",   # 運動記録の抽出・修正
+    "refine": "gemini-2.5-flash",     # 栄養素の修正対話・補足説明の反映
+    "planner": "gemini-2.5-flash",    # 記録への質問 → 集計計画
+    "sql": "gemini-2.5-flash",        # 自由モードの SQL 生成
+}
+GEMINI_IMAGE_MODELS = ["gemini-2.5-flash", "gemini-1.5-pro-latest"]  # 画像解析（先頭から順に試す）
+# 全モデル共通の generation_config（空なら API 既定値）
+GEMINI_GENERATION_CONFIG = {}
+# 接続先の差し替え（scripts/fake_gemini_server.py などのローカルスタブで負荷試験する場合）
+GEMINI_API_ENDPOINT = os.environ.get("DIET_APP_GEMINI_ENDPOINT")
+
+# -----------------------------
+# Retry / circuit breaker
+# -----------------------------
+# 全ての generate_content は registry.generate() を通り、ここの方針でリトライ・遮断・同時実行制限を受ける。
+GEMINI_MAX_ATTEMPTS = 3            # 1回の呼び出しあたりの最大試行回数
+GEMINI_BACKOFF_BASE_S = 0.5        # 指数バックオフの初期値（full jitter）
+GEMINI_BACKOFF_MAX_S = 8.0
+GEMINI_DEADLINE_S = 45.0           # リトライ・待ち時間を含めた1回の呼び出しの上限
+GEMINI_MAX_CONCURRENCY = 4         # プロセス全体での同時呼び出し数
+GEMINI_BREAKER_FAILURES = 5        # 連続でこの回数失敗したら遮断
+GEMINI_BREAKER_COOLDOWN_S = 30.0   # 遮断してから試験的に1回通すまでの時間
+# 一時的とみなす HTTP ステータス（429 と 5xx）
+_GEMINI_RETRYABLE_CODES = {408, 429, 500, 502, 503, 504}
+_GEMINI_RETRYABLE_ERRORS = {
+    "ResourceExhausted", "TooManyRequests", "ServiceUnavailable", "InternalServerError",
+    "DeadlineExceeded", "GatewayTimeout", "BadGateway", "RetryError",
+}
+
+
+class GeminiUnavailableError(RuntimeError):
+    """Gemini が一時的に使えない（遮断中・混雑・期限切れ）ことを表す。メッセージはそのまま画面に出せる。"""
+
+
+def _is_retryable(e: Exception) -> bool:
+    code = getattr(e, "code", None)
+    if isinstance(code, int) and code in _GEMINI_RETRYABLE_CODES:
+        return True
+    return type(e).__name__ in _GEMINI_RETRYABLE_ERRORS or isinstance(e, (ConnectionError, TimeoutError))
+
+
+class _CircuitBreaker:
+    """連続失敗で遮断（open）し、クールダウン後に1回だけ試験的に通す（half-open）。"""
+
+    def __init__(self, failure_threshold: int, cooldown_s: float):
+        self.failure_threshold = failure_threshold
+        self.cooldown_s = cooldown_s
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            return "half_open" if time.monotonic() - self._opened_at >= self.cooldown_s else "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.cooldown_s or self._trial_running:
+                return False
+            self._trial_running = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial_running or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+            self._trial_running = False
+
+    def release_trial(self):
+        """試験呼び出しが一時的でない理由で失敗したとき、状態を変えずに次の試験を許す。"""
+        with self._lock:
+            self._trial_running = False
+
+
+def _backoff_delay(attempt: int) -> float:
+    return random.uniform(0, min(GEMINI_BACKOFF_MAX_S, GEMINI_BACKOFF_BASE_S * (2 ** attempt)))
+
+
+class _GeminiModelRegistry:
+    """設定済みの GenerativeModel をモデル名ごとに1つだけ作って使い回す。
+
+    genai のクライアント（トランスポート）は genai.configure() 単位で共有されるので、
+    ハンドルを使い回せば呼び出しごとの生成コストだけが消える。呼び出し回数・失敗回数も数える。
+    """
+
+    def __init__(self, generation_config: dict = None):
+        self.generation_config = dict(generation_config or {})
+        self._models = {}
+        self._calls = {}
+        self._errors = {}
+        self._breakers = {}
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(GEMINI_MAX_CONCURRENCY)
+
+    def model(self, name: str):
+        with self._lock:
+            model = self._models.get(name)
+            if model is None:
+                model = _get_genai().GenerativeModel(name, generation_config=self.generation_config or None)
+                self._models[name] = model
+            return model
+
+    def breaker(self, name: str) -> _CircuitBreaker:
+        with self._lock:
+            breaker = self._breakers.get(name)
+            if breaker is None:
+                breaker = self._breakers[name] = _CircuitBreaker(GEMINI_BREAKER_FAILURES, GEMINI_BREAKER_COOLDOWN_S)
+            return breaker
+
+    def generate(self, name: str, contents, deadline_s: float = None, **kwargs):
+        """generate_content を遮断・同時実行制限・リトライ付きで呼ぶ。
+
+        429/5xx などの一時的なエラーは jitter 付き指数バックオフで GEMINI_MAX_ATTEMPTS 回まで再試行する。
+        遮断中・期限切れ・混雑で呼べない場合は GeminiUnavailableError。それ以外のエラーはそのまま送出する。
+        """
+        model = self.model(name)
+        breaker = self.breaker(name)
+        op = f"gemini.generate.{name}"
+        started = time.perf_counter()
+        deadline = started + (GEMINI_DEADLINE_S if deadline_s is None else deadline_s)
+        fields = _prompt_size_fields(contents)
+        request_options = dict(kwargs.pop("request_options", None) or {})
+        attempt = 0
+        while True:
+            if not breaker.allow():
+                _get_metrics().record(f"gemini.breaker_open.{name}", 0.0, False)
+                raise GeminiUnavailableError(
+                    "AIサービスが不安定なため、一時的に呼び出しを止めています。しばらくしてから再度お試しください。"
+                )
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0 or not self._slots.acquire(timeout=remaining):
+                breaker.release_trial()
+                _get_metrics().record(op, time.perf_counter() - started, False, attempts=attempt, **fields)
+                raise GeminiUnavailableError("AIの呼び出しが混み合っています。しばらくしてから再度お試しください。")
+            attempt += 1
+            with self._lock:
+                self._calls[name] = self._calls.get(name, 0) + 1
+            # SDK 側の自動リトライは切り、期限は残り時間に合わせる（呼び出し元の timeout が短ければそちら）
+            options = {**request_options, "retry": None}
+            options["timeout"] = min(options.get("timeout") or remaining, remaining)
+            try:
+                resp = model.generate_content(contents, request_options=options, **kwargs)
+            except Exception as e:
+                self._slots.release()
+                with self._lock:
+                    self._errors[name] = self._errors.get(name, 0) + 1
+                if not _is_retryable(e):
+                    breaker.release_trial()
+                    _get_metrics().record(op, time.perf_counter() - started, False, attempts=attempt, **fields)
+                    raise
+                breaker.record_failure()
+                delay = _backoff_delay(attempt - 1)
+                if attempt >= GEMINI_MAX_ATTEMPTS or time.perf_counter() + delay >= deadline:
+                    _get_metrics().record(op, time.perf_counter() - started, False, attempts=attempt, **fields)
+                    raise GeminiUnavailableError(
+                        f"AIサービスが混み合っています（{attempt}回試行）。しばらくしてから再度お試しください。"
+                    ) from e
+                logger.info("gemini %s: retry %d after %.2fs (%s)", name, attempt, delay, e)
+                time.sleep(delay)
+                continue
+            breaker.record_success()
+            fields["attempts"] = attempt
+            # ストリームも最初の応答を受けた時点で枠を返す（読まれずに捨てられても枠が漏れないように）
+            self._slots.release()
+            if kwargs.get("stream"):
+                return _stream_with_metrics(resp, op, started, fields)
+            fields.update(_response_size_fields(resp))
+            _get_metrics().record(op, time.perf_counter() - started, True, **fields)
+            return resp
+
+    def stats(self) -> dict:
+        with self._lock:
+            names = sorted(self._calls)
+            breakers = dict(self._breakers)
+            calls = dict(self._calls)
+            errors = dict(self._errors)
+        return {
+            name: {
+                "calls": calls[name],
+                "errors": errors.get(name, 0),
+                "breaker": breakers[name].state if name in breakers else "closed",
+            }
+            for name in names
+        }
+
+
+def _prompt_size_fields(contents) -> dict:
+    parts = contents if isinstance(contents, (list, tuple)) else [contents]
+    chars = sum(len(p) for p in parts if isinstance(p, str))
+    blob_bytes = sum(len(p.get("data") or b"") for p in parts if isinstance(p, dict))
+    fields = {"prompt_chars": chars}
+    if blob_bytes:
+        fields["prompt_blob_bytes"] = blob_bytes
+    return fields
+
+
+def _usage_fields(resp) -> dict:
+    usage = getattr(resp, "usage_metadata", None)
+    if usage is None:
+        return {}
+    fields = {
+        "prompt_tokens": getattr(usage, "prompt_token_count", None),
+        "response_tokens": getattr(usage, "candidates_token_count", None),
+        "total_tokens": getattr(usage, "total_token_count", None),
+    }
+    return {k: v for k, v in fields.items() if isinstance(v, int)}
+
+
+def _response_size_fields(resp) -> dict:
+    try:
+        text = resp.text or ""
+    except ValueError:
+        # 安全フィルタ等で parts を持たない応答
+        text = ""
+    return {"response_chars": len(text), **_usage_fields(resp)}
+
+
+def _stream_with_metrics(resp, op: str, started: float, fields: dict):
+    """ストリーミング応答をそのまま流し、読み終えた時点で所要時間・サイズ・トークン数を記録する。"""
+    ok = False
+    chars = 0
+    last = None
+    try:
+        for chunk in resp:
+            last = chunk
+            try:
+                chars += len(chunk.text or "")
+            except ValueError:
+                pass
+            yield chunk
+        ok = True
+    finally:
+        fields = {**fields, "response_chars": chars, **(_usage_fields(last) if last is not None else {})}
+        _get_metrics().record(op, time.perf_counter() - started, ok, **fields)
+
+
+@st.cache_resource
+def _get_model_registry():
+    return _GeminiModelRegistry(GEMINI_GENERATION_CONFIG)
+
+
+def gemini_model_name(role: str) -> str:
+    """役割名をモデル名に解決する（未登録ならモデル名とみなしてそのまま返す）。"""
+    return GEMINI_MODELS.get(role, role)
+
+
+def gemini_generate(role: str, contents, **kwargs):
+    """役割（またはモデル名）に対応するモデルで generate_content を呼ぶ。"""
+    return _get_model_registry().generate(gemini_model_name(role), contents, **kwargs)
+
+
+def gemini_call_stats() -> dict:
+    """モデル名ごとの呼び出し回数・失敗回数（プロセス起動以降）とサーキットブレーカーの状態。"""
+    return _get_model_registry().stats()
+
+
+# =============================
+# Structured output (JSON schema)
+# =============================
+# JSON を返すヘルパーは response_schema 付きの JSON モードで呼び、応答は validate_* で型を揃えた dict にする。
+# 出力上限などで JSON が途中で切れていても、_repair_json で閉じられるところまで復元して使う
+# （パースに失敗したからといって同じ呼び出しをやり直さない）。
+_NUTRIENT_KEYS = ("calories", "protein", "carbohydrates", "fat", "vitaminD", "salt", "zinc", "folic_acid")
+
+_NUTRIENTS_SCHEMA = {
+    "type": "object",
+    "properties": {k: {"type": "number"} for k in _NUTRIENT_KEYS},
+    "required": list(_NUTRIENT_KEYS),
+}
+MEAL_ANALYSIS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "summary": {"type": "string"},
+        "totalNutrients": _NUTRIENTS_SCHEMA,
+        "dishes": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "name": {"type": "string"},
+                    "rationale": {"type": "string"},
+                    "nutrients": _NUTRIENTS_SCHEMA,
+                },
+                "required": ["name", "nutrients"],
+            },
+        },
+    },
+    "required": ["summary", "totalNutrients", "dishes"],
+}
+EXERCISE_SCHEMA = {
+    "type": "object",
+    "properties": {"name": {"type": "string"}, "duration": {"type": "integer"}},
+    "required": ["name", "duration"],
+}
+NUTRITION_REFINEMENT_SCHEMA = {
+    "type": "object",
+    "properties": {"response_text": {"type": "string"}, "updated_data": MEAL_ANALYSIS_SCHEMA},
+    "required": ["response_text", "updated_data"],
+}
+NOTE_REFINEMENT_SCHEMA = {
+    "type": "object",
+    "properties": {"foodName": {"type": "string"}, "nutrients": _NUTRIENTS_SCHEMA, "note": {"type": "string"}},
+    "required": ["foodName", "nutrients"],
+}
+_PLAN_METRICS = ("calories", "protein", "carbohydrates", "fat", "vitamin_d", "salt", "zinc", "folic_acid")
+QUERY_PLAN_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "action": {"type": "string", "enum": ["aggregate", "filter", "trend", "top_n"]},
+        "date_range": {
+            "type": "object",
+            "nullable": True,
+            "properties": {"start": {"type": "string"}, "end": {"type": "string"}},
+            "required": ["start", "end"],
+        },
+        "meal_types": {"type": "array", "items": {"type": "string"}},
+        "name_contains": {"type": "string", "nullable": True},
+        "metrics": {"type": "array", "items": {"type": "string", "enum": list(_PLAN_METRICS)}},
+        "agg": {"type": "string", "enum": ["sum", "avg", "count"], "nullable": True},
+        "group_by": {"type": "string", "enum": ["date", "meal_type", "food_name"], "nullable": True},
+        "top_n": {"type": "integer", "nullable": True},
+        "sort_by": {"type": "string", "nullable": True},
+        "sort_order": {"type": "string", "enum": ["desc", "asc"], "nullable": True},
+    },
+    "required": ["action", "metrics"],
+}
+SQL_QUERY_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "sql": {"type": "string"},
+        "params": {"type": "array", "items": {"type": "string"}},
+        "intent": {"type": "string"},
+    },
+    "required": ["sql", "params", "intent"],
+}
+
+
+class Nutrients(TypedDict):
+    calories: float
+    protein: float
+    carbohydrates: float
+    fat: float
+    vitaminD: float
+    salt: float
+    zinc: float
+    folic_acid: float
+
+
+class DishEstimate(TypedDict):
+    name: str
+    rationale: str
+    nutrients: Nutrients
+
+
+class MealAnalysis(TypedDict):
+    summary: str
+    totalNutrients: Nutrients
+    dishes: list          # list[DishEstimate]
+
+
+class ExerciseEntry(TypedDict):
+    name: str
+    duration: int
+
+
+class NutritionRefinement(TypedDict):
+    response_text: str
+    updated_data: MealAnalysis
+
+
+class NoteRefinement(TypedDict):
+    foodName: str
+    nutrients: Nutrients
+    note: str
+
+
+class SqlQuery(TypedDict):
+    sql: str
+    params: list
+    intent: str
+
+
+class StructuredOutputError(ValueError):
+    """AIの応答が（復元を試みても）期待した JSON の形にならなかった。"""
+
+
+def json_output_config(schema: dict) -> dict:
+    """generate_content に渡す generation_config（JSON モード＋スキーマ）。"""
+    return {"response_mime_type": "application/json", "response_schema": schema}
+
+
+_JSON_FENCE_RE = re.compile(r"^```(?:json)?\s*|\s*```$")
+_JSON_PARTIAL_ESCAPE_RE = re.compile(r"\\(u[0-9a-fA-F]{0,3})?$")
+
+
+def _repair_json(text: str) -> str:
+    """途中で切れた JSON を、最後に完結している値までで切って括弧を閉じる。
+
+    書きかけの文字列の値は閉じて残し、書きかけのキー・数値・true/false/null は捨てる
+    （数値は末尾が欠けると別の値になってしまうため）。復元できなければ StructuredOutputError。
+    """
+    start = min((i for i in (text.find("{"), text.find("[")) if i >= 0), default=-1)
+    if start < 0:
+        raise StructuredOutputError("応答に JSON が含まれていません")
+    text = text[start:]
+    stack = []          # [開き括弧, 状態]。状態は key / colon / value / after
+    good = None         # (ここまでで切れば値が完結している位置, その時点で必要な閉じ括弧)
+    in_string = escaped = False
+    i, n = 0, len(text)
+
+    def closers():
+        return "".join("}" if open_ == "{" else "]" for open_, _ in reversed(stack))
+
+    def value_done(end):
+        nonlocal good
+        if stack:
+            stack[-1][1] = "after"
+            good = (end, closers())
+
+    while i < n:
+        ch = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+                if stack and stack[-1][1] == "key":
+                    stack[-1][1] = "colon"
+                else:
+                    value_done(i + 1)
+            i += 1
+            continue
+        if ch == '"':
+            in_string = True
+        elif ch in "{[":
+            stack.append([ch, "key" if ch == "{" else "value"])
+            good = (i + 1, closers())
+        elif ch in "}]":
+            if not stack:
+                break
+            stack.pop()
+            if not stack:
+                return text[:i + 1]
+            value_done(i + 1)
+        elif ch == ":":
+            if stack:
+                stack[-1][1] = "value"
+        elif ch == ",":
+            if stack:
+                stack[-1][1] = "key" if stack[-1][0] == "{" else "value"
+        elif not ch.isspace():
+            # 数値・true/false/null。区切りまで読み、末尾で切れていたら完結していないとみなす
+            j = i
+            while j < n and text[j] not in ',}]' and not text[j].isspace():
+                j += 1
+            if j < n:
+                value_done(j)
+            i = j
+            continue
+        i += 1
+
+    if in_string and stack and stack[-1][1] == "value":
+        return _JSON_PARTIAL_ESCAPE_RE.sub("", text) + '"' + closers()
+    if good is None:
+        raise StructuredOutputError("応答の JSON を復元できませんでした")
+    end, close = good
+    return text[:end] + close
+
+
+def _parse_structured(text: str, validate, op: str) -> tuple:
+    """応答テキストを JSON として読み、validate で型を揃えて (結果, 復元したか) を返す。
+
+    壊れていれば一度だけローカルで復元し、validate(data, partial=True) で書きかけだった要素を捨てる。
+    復元した結果は欠けている可能性があるので、呼び出し側でキャッシュしないこと。
+    """
+    text = _JSON_FENCE_RE.sub("", (text or "").strip())
+    try:
+        data = json.loads(text)
+    except ValueError:
+        try:
+            data = json.loads(_repair_json(text))
+        except ValueError as e:
+            _get_metrics().record(f"gemini.json_invalid.{op}", 0.0, False, response_chars=len(text))
+            raise StructuredOutputError(f"AIの応答を JSON として読めませんでした: {e}") from e
+        _get_metrics().record(f"gemini.json_repaired.{op}", 0.0, True, response_chars=len(text))
+        logger.info("gemini %s: repaired truncated JSON (%d chars)", op, len(text))
+        return validate(data, partial=True), True
+    return validate(data), False
+
+
+def _as_float(value, default=0.0):
+    if isinstance(value, bool):
+        return default
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        m = re.search(r"-?\d+(?:\.\d+)?", value.replace(",", ""))
+        if m:
+            return float(m.group())
+    return default
+
+
+def _as_text(value, default="") -> str:
+    return value.strip() if isinstance(value, str) else default
+
+
+def validate_nutrients(value, fallback: dict = None) -> Nutrients:
+    """8項目の栄養素を float に揃える。欠けた項目は fallback（なければ 0.0）で埋める。"""
+    value = value if isinstance(value, dict) else {}
+    fallback = fallback or {}
+    return {k: _as_float(value.get(k), fallback.get(k, 0.0)) for k in _NUTRIENT_KEYS}
+
+
+def validate_meal_analysis(data, partial: bool = False) -> MealAnalysis:
+    """料理ごとの推定結果を検証する。合計が欠けていれば料理の値を足して補う。
+
+    partial（途中で切れた応答を復元したもの）のときは、栄養素が揃っていない料理は書きかけとみなして捨てる。
+    """
+    if not isinstance(data, dict):
+        raise StructuredOutputError("応答が JSON オブジェクトではありません")
+    dishes = []
+    for dish in data.get("dishes") or []:
+        if not isinstance(dish, dict) or not _as_text(dish.get("name")) or not isinstance(dish.get("nutrients"), dict):
+            continue
+        if partial and not all(k in dish["nutrients"] for k in _NUTRIENT_KEYS):
+            continue
+        dishes.append({
+            "name": _as_text(dish.get("name")),
+            "rationale": _as_text(dish.get("rationale")),
+            "nutrients": validate_nutrients(dish.get("nutrients")),
+        })
+    if partial and not dishes:
+        # 合計だけ残っても料理の一覧が無いと記録・修正できない。保存せず、もう一度呼んでもらう
+        raise StructuredOutputError("AIの応答が途中で切れ、料理を読み取れませんでした。もう一度お試しください。")
+    dish_totals = {k: round(sum(d["nutrients"][k] for d in dishes), 2) for k in _NUTRIENT_KEYS}
+    totals = data.get("totalNutrients")
+    if partial and isinstance(totals, dict) and not all(k in totals for k in _NUTRIENT_KEYS):
+        totals = None
+    if not dishes and not isinstance(totals, dict):
+        raise StructuredOutputError("応答に dishes / totalNutrients がありません")
+    return {
+        "summary": _as_text(data.get("summary")) or "・".join(d["name"] for d in dishes),
+        "totalNutrients": validate_nutrients(totals, fallback=dish_totals),
+        "dishes": dishes,
+    }
+
+
+def validate_exercise(data, partial: bool = False) -> ExerciseEntry:
+    if not isinstance(data, dict) or not _as_text(data.get("name")):
+        raise StructuredOutputError("応答に運動名がありません")
+    duration = int(round(_as_float(data.get("duration"))))
+    if duration <= 0:
+        raise StructuredOutputError("応答の運動時間が正しくありません")
+    return {"name": _as_text(data.get("name")), "duration": duration}
+
+
+def validate_nutrition_refinement(data, partial: bool = False) -> NutritionRefinement:
+    if not isinstance(data, dict) or not isinstance(data.get("updated_data"), dict):
+        raise StructuredOutputError("応答に updated_data がありません")
+    return {
+        "response_text": _as_text(data.get("response_text")) or "内容を更新しました。",
+        "updated_data": validate_meal_analysis(data["updated_data"], partial),
+    }
+
+
+def validate_note_refinement(data, partial: bool = False) -> NoteRefinement:
+    if not isinstance(data, dict) or not isinstance(data.get("nutrients"), dict) or not data["nutrients"]:
+        raise StructuredOutputError("応答に nutrients がありません")
+    return {
+        "foodName": _as_text(data.get("foodName")),
+        "nutrients": validate_nutrients(data["nutrients"]),
+        "note": _as_text(data.get("note")),
+    }
+
+
+_PLAN_DATE_RE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+
+
+def validate_query_plan(data, partial: bool = False) -> dict:
+    """集計計画のうち、形の正しい項目だけを残す（欠けた項目は _postprocess_plan / _execute_plan の既定値に任せる）。
+
+    action と metrics が1つも読めなければ、質問を解釈できなかったものとして StructuredOutputError。
+    """
+    if not isinstance(data, dict):
+        raise StructuredOutputError("応答が JSON オブジェクトではありません")
+    metrics = [m for m in data.get("metrics") or [] if m in _PLAN_METRICS]
+    if data.get("action") not in ("aggregate", "filter", "trend", "top_n") or not metrics:
+        raise StructuredOutputError("応答に有効な action / metrics がありません")
+    plan = {"action": data["action"], "metrics": metrics}
+    dr = data.get("date_range")
+    if isinstance(dr, dict) and all(_PLAN_DATE_RE.match(str(dr.get(k) or "")) for k in ("start", "end")):
+        plan["date_range"] = {"start": dr["start"], "end": dr["end"]}
+    else:
+        plan["date_range"] = None
+    plan["meal_types"] = [m for m in data.get("meal_types") or [] if isinstance(m, str) and m]
+    plan["name_contains"] = _as_text(data.get("name_contains")) or None
+    for key, allowed in (("agg", ("sum", "avg", "count")), ("group_by", ("date", "meal_type", "food_name")),
+                         ("sort_order", ("desc", "asc"))):
+        plan[key] = data.get(key) if data.get(key) in allowed else None
+    top_n = data.get("top_n")
+    plan["top_n"] = int(top_n) if isinstance(top_n, (int, float)) and not isinstance(top_n, bool) and top_n > 0 else None
+    plan["sort_by"] = data.get("sort_by") if data.get("sort_by") in _PLAN_METRICS else None
+    return plan
+
+
+def validate_sql_query(data, partial: bool = False) -> SqlQuery:
+    """途中で切れた SQL は条件や LIMIT が欠けて別の意味になり得るので、復元したものは使わない。"""
+    if partial:
+        raise StructuredOutputError("SQL の応答が途中で切れていました")
+    if not isinstance(data, dict) or not _as_text(data.get("sql")):
+        raise StructuredOutputError("応答に sql がありません")
+    params = data.get("params") if isinstance(data.get("params"), list) else []
+    return {
+        "sql": _as_text(data.get("sql")),
+        "params": [p for p in params if isinstance(p, (str, int, float)) and not isinstance(p, bool)],
+        "intent": _as_text(data.get("intent")),
+    }
+
+
+# =============================
+# Gemini helpers
+# =============================
+
+def stream_advice_from_gemini(prompt: str, timings: dict = None):
+    """相談ページのアドバイスを生成し、テキストを届いた順に yield する（st.write_stream にそのまま渡せる）。
+
+    timings を渡すと ttft_s（最初のチャンクまでの秒数）と total_s（全体の秒数）を書き込む。
+    """
+    timings = timings if timings is not None else {}
+    started = time.perf_counter()
+    timings["ttft_s"] = None
+    try:
+        for chunk in gemini_generate("advice", prompt, stream=True):
+            try:
+                text = chunk.text or ""
+            except ValueError:
+                # 安全フィルタ等で parts を持たないチャンク
+                continue
+            if not text:
+                continue
+            if timings["ttft_s"] is None:
+                timings["ttft_s"] = time.perf_counter() - started
+            yield text
+    except Exception as e:
+        st.error(f"アドバイス生成中にエラーが発生しました: {e}")
+        yield "アドバイスの生成に失敗しました。"
+    finally:
+        timings["total_s"] = time.perf_counter() - started
+
+
+# -----------------------------
+# Hedged model fallback
+# -----------------------------
+# "sequential": 失敗したら次のモデル / "hedged": 一定時間応答が無ければ次のモデルも並走 /
+# "parallel": 最初から全モデルを並走。いずれも最初に成功した応答を採用する。
+IMAGE_HEDGE_MODE = "hedged"
+IMAGE_HEDGE_DELAY_S = 6.0      # hedged で予備モデルを起動するまでの待ち時間
+GEMINI_CALL_TIMEOUT_S = 60.0   # 1回の generate_content のタイムアウト
 
-def get_all_records():
-    conn = get_db_connection()
-    df = pd.read_sql_query("SELECT * FROM meals ORDER BY date DESC, id DESC", conn)
-    conn.close()
-    return df
 
+@st.cache_resource
+def _get_gemini_executor():
+    """Gemini 呼び出しを並走させるためのプロセス共有スレッドプール。"""
+    return ThreadPoolExecutor(max_workers=8, thread_name_prefix="gemini")
 
-def get_records_by_period(start_date, end_date):
-    conn = get_db_connection()
-    query = "SELECT * FROM meals WHERE date BETWEEN ? AND ? ORDER BY date DESC, id DESC"
-    df = pd.read_sql_query(
-        query,
-        conn,
-        params=(start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d")),
-    )
-    conn.close()
-    return df
 
+def _run_hedged(call, candidates, mode: str = None, delay: float = None):
+    """call(model_name) を candidates の順に（mode に応じて並走させつつ）実行し、
+    最初に成功した (結果, モデル名) を返す。全て失敗したら最後の例外を送出する。
 
-def delete_record(record_id):
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("DELETE FROM meals WHERE id = ?", (record_id,))
-    conn.commit()
-    conn.close()
+    負けた呼び出しは未開始ならキャンセルし、実行中なら結果を捨てる（タイムアウトで終了する）。
+    """
+    mode = mode or IMAGE_HEDGE_MODE
+    delay = IMAGE_HEDGE_DELAY_S if delay is None else delay
+    executor = _get_gemini_executor()
+    waiting = list(candidates)
+    running = {}
+    last_err = None
 
-def get_favorite_meals():
-    conn = get_db_connection()
-    df = pd.read_sql_query("SELECT * FROM meals WHERE is_favorite = 1 ORDER BY food_name ASC", conn)
-    conn.close()
-    return df
+    def launch():
+        name = waiting.pop(0)
+        running[executor.submit(call, name)] = name
 
-def update_favorite_status(meal_id, is_favorite):
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("UPDATE meals SET is_favorite = ? WHERE id = ?", (1 if is_favorite else 0, meal_id))
-    conn.commit()
-    conn.close()
+    launch()
+    if mode == "parallel":
+        while waiting:
+            launch()
+    try:
+        while running:
+            timeout = delay if (mode == "hedged" and waiting) else None
+            done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                # 先行モデルが遅い → 予備モデルを追加で起動
+                launch()
+                continue
+            for fut in done:
+                name = running.pop(fut)
+                try:
+                    return fut.result(), name
+                except Exception as e:
+                    last_err = e
+            if waiting and (mode != "parallel"):
+                # 失敗したら待ち時間を置かずに次へ
+                launch()
+        raise last_err or RuntimeError("モデル候補がありません")
+    finally:
+        for fut in running:
+            fut.cancel()
 
 
-# CRUD helpers for Exercises
-def add_exercise_record(date, exercise_name, duration_minutes):
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute(
-        "INSERT INTO exercises (date, exercise_name, duration_minutes) VALUES (?, ?, ?)",
-        (date.strftime("%Y-%m-%d"), exercise_name, duration_minutes)
-    )
-    conn.commit()
-    conn.close()
+# -----------------------------
+# Image preprocessing
+# -----------------------------
+IMAGE_MAX_EDGE = 1280       # 長辺の上限(px)。これより大きい写真は縮小して送る
+IMAGE_JPEG_QUALITY = 85     # 再エンコード時の JPEG 品質
 
-def get_all_exercise_records():
-    conn = get_db_connection()
-    df = pd.read_sql_query("SELECT * FROM exercises ORDER BY date DESC, id DESC", conn)
-    conn.close()
-    return df
 
-def delete_exercise_record(record_id):
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("DELETE FROM exercises WHERE id = ?", (record_id,))
-    conn.commit()
-    conn.close()
+@instrumented("image.preprocess_image")
+def preprocess_image(image_bytes: bytes, max_edge: int = IMAGE_MAX_EDGE, quality: int = IMAGE_JPEG_QUALITY):
+    """EXIF の向きを反映→長辺 max_edge に縮小→メタデータ無しの JPEG に再エンコードする。
 
-def get_unique_exercise_names():
-    conn = get_db_connection()
-    try:
-        df = pd.read_sql_query("SELECT DISTINCT exercise_name FROM exercises ORDER BY exercise_name", conn)
-        return df['exercise_name'].tolist()
-    finally:
-        conn.close()
+    戻り値は (JPEG バイト列, 統計 dict)。統計には元/処理後のバイト数・サイズ・処理時間を含む。
+    圧縮済みの小さな JPEG などで再エンコードの方が大きくなる場合は、縮小も向きの補正もメタデータの除去も
+    不要なときに限って元のバイト列をそのまま返す（kept_original が True）。
+    """
+    started = time.perf_counter()
+    Image, ImageOps = _import_pil()
+    img = Image.open(io.BytesIO(image_bytes))
+    original_size = img.size
+    original_format = img.format
+    has_metadata = bool(img.info.get("exif") or img.getexif())
+    img = ImageOps.exif_transpose(img)
+    if img.mode in ("RGBA", "LA", "P"):
+        # 透過PNGは白背景に合成（JPEG は透過を持てない）
+        img = img.convert("RGBA")
+        bg = Image.new("RGB", img.size, (255, 255, 255))
+        bg.paste(img, mask=img.getchannel("A"))
+        img = bg
+    elif img.mode != "RGB":
+        img = img.convert("RGB")
+    if max(img.size) > max_edge:
+        img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+    buf = io.BytesIO()
+    # exif を渡さないので撮影日時や位置情報などのメタデータは落ちる
+    img.save(buf, format="JPEG", quality=quality, optimize=True)
+    out = buf.getvalue()
+    kept_original = (
+        len(out) >= len(image_bytes)
+        and original_format in ("JPEG", "PNG")
+        and img.size == original_size
+        and not has_metadata
+    )
+    if kept_original:
+        out = image_bytes
+    stats = {
+        "original_bytes": len(image_bytes),
+        "processed_bytes": len(out),
+        "saved_bytes": len(image_bytes) - len(out),
+        "original_size": original_size,
+        "processed_size": img.size,
+        "elapsed_ms": (time.perf_counter() - started) * 1000,
+        "kept_original": kept_original,
+    }
+    return out, stats
+
+
+def _format_preprocess_stats(stats: dict) -> str:
+    if stats.get("kept_original"):
+        return (
+            f"画像は圧縮済みのため、そのまま送信します（{stats['original_bytes'] / 1024:,.0f}KB、"
+            f"{stats['original_size'][0]}×{stats['original_size'][1]}、{stats['elapsed_ms']:.0f}ms）"
+        )
+    if stats["saved_bytes"] <= 0:
+        # 位置情報などのメタデータを落とすために再エンコードした結果、少し大きくなった場合
+        return (
+            f"画像のメタデータを除去しました: {stats['original_bytes'] / 1024:,.0f}KB → "
+            f"{stats['processed_bytes'] / 1024:,.0f}KB（{stats['elapsed_ms']:.0f}ms）"
+        )
+    ratio = (stats["saved_bytes"] / stats["original_bytes"]) if stats["original_bytes"] else 0.0
+    return (
+        f"画像を最適化しました: {stats['original_bytes'] / 1024:,.0f}KB → {stats['processed_bytes'] / 1024:,.0f}KB"
+        f"（{ratio:.0%} 削減、{stats['original_size'][0]}×{stats['original_size'][1]} → "
+        f"{stats['processed_size'][0]}×{stats['processed_size'][1]}、{stats['elapsed_ms']:.0f}ms）"
+    )
 
 
-# =============================
-# Gemini helpers
-# =============================
+@instrumented("gemini.analyze_image_with_gemini")
+def analyze_image_with_gemini(image_bytes):
+    """画像を解析し、料理ごとの内訳と合計値を含むJSONを返す。失敗時は画面にエラーを出して None。
 
-def get_advice_from_gemini(prompt: str) -> str:
-    """テキストプロンプトからアドバイスを生成（gemini-2.5-flash）。"""
+    image_bytes はそのまま送信するので、事前に preprocess_image() で縮小しておくこと。
+    """
     try:
-        model = genai.GenerativeModel("gemini-2.5-flash")
-        resp = model.generate_content(prompt)
-        return (resp.text or "").strip()
+        return _analyze_image(image_bytes)
     except Exception as e:
-        st.error(f"アドバイス生成中にエラーが発生しました: {e}")
-        return "アドバイスの生成に失敗しました。"
+        st.error(f"画像分析に失敗しました（フォールバックも不可）: {e}")
+        return None
 
-def analyze_image_with_gemini(image_bytes):
-    """画像を解析し、料理ごとの内訳と合計値を含むJSONを返す。"""
-    model_candidates = ["gemini-2.5-flash", "gemini-1.5-pro-latest"]
-    image_pil = Image.open(io.BytesIO(image_bytes))
+
+def _analyze_image(image_bytes):
+    """analyze_image_with_gemini の本体。失敗は例外で返す（バックグラウンドジョブからも呼ぶ）。"""
+    model_candidates = list(GEMINI_IMAGE_MODELS)
+    Image, _ = _import_pil()
+    image_format = Image.open(io.BytesIO(image_bytes)).format or "JPEG"
+    image_part = {"mime_type": Image.MIME.get(image_format, "image/jpeg"), "data": image_bytes}
     prompt = (
         """
         あなたは栄養管理の専門家です。この食事の画像を分析してください。
@@ -327,24 +2088,35 @@ def analyze_image_with_gemini(image_bytes):
         }
         """
     )
-    last_err = None
-    for model_name in model_candidates:
-        try:
-            model = genai.GenerativeModel(model_name)
-            resp = model.generate_content([prompt, image_pil])
-            txt = (resp.text or "").strip().replace("```json", "").replace("```", "")
-            data = json.loads(txt)
-            if isinstance(data, dict) and "dishes" in data and "totalNutrients" in data:
-                return data
-        except Exception as e:
-            last_err = e
-            continue
-    st.error(f"画像分析に失敗しました（フォールバックも不可）: {last_err}")
-    return None
+    cache_key = analysis_cache_key("image", ",".join(model_candidates), image_bytes)
+    cached = analysis_cache_get(cache_key)
+    if cached is not None:
+        return cached
+
+    def call(model_name):
+        resp = gemini_generate(
+            model_name, [prompt, image_part],
+            generation_config=json_output_config(MEAL_ANALYSIS_SCHEMA),
+            request_options={"timeout": GEMINI_CALL_TIMEOUT_S},
+        )
+        return _parse_structured(resp.text, validate_meal_analysis, "analyze_image")
+
+    (data, repaired), model_name = _run_hedged(call, model_candidates)
+    return _finish_meal_analysis(cache_key, "image", model_name, data, repaired)
 
+@instrumented("gemini.analyze_text_with_gemini")
 def analyze_text_with_gemini(description: str):
-    """フリーテキストを解析し、料理ごとの内訳と合計値を含むJSONを返す。"""
-    model = genai.GenerativeModel("gemini-2.5-flash")
+    """フリーテキストを解析し、料理ごとの内訳と合計値を含むJSONを返す。失敗時は画面にエラーを出して None。"""
+    try:
+        return _analyze_text(description)
+    except Exception as e:
+        st.error(f"テキスト分析中にエラーが発生しました: {e}")
+        return None
+
+
+def _analyze_text(description: str):
+    """analyze_text_with_gemini の本体。失敗は例外で返す（バックグラウンドジョブからも呼ぶ）。"""
+    model_name = gemini_model_name("text")
     prompt = (
         f"""
         あなたは栄養管理の専門家です。以下の食事内容の記述を分析してください。
@@ -366,19 +2138,160 @@ def analyze_text_with_gemini(description: str):
         }}
         """
     )
-    try:
-        resp = model.generate_content(prompt)
-        txt = (resp.text or "").strip().replace("```json", "").replace("```", "")
-        data = json.loads(txt)
-        if isinstance(data, dict) and "dishes" in data and "totalNutrients" in data:
-            return data
-    except Exception as e:
-        st.error(f"テキスト分析中にエラーが発生しました: {e}")
-    return None
+    cache_key = analysis_cache_key("text", model_name, description)
+    cached = analysis_cache_get(cache_key)
+    if cached is not None:
+        return cached
+    resp = gemini_generate(model_name, prompt, generation_config=json_output_config(MEAL_ANALYSIS_SCHEMA))
+    data, repaired = _parse_structured(resp.text, validate_meal_analysis, "analyze_text")
+    return _finish_meal_analysis(cache_key, "text", model_name, data, repaired)
+
+
+def _finish_meal_analysis(cache_key: str, kind: str, model_name: str, data: dict, repaired: bool) -> dict:
+    """解析結果をキャッシュして返す。途中で切れた応答から復元したものは料理が欠けている可能性があるので、
+    キャッシュせず truncated を付けて返す（同じ入力でもう一度解析すれば AI に問い合わせ直す）。"""
+    if repaired:
+        return {**data, "truncated": True}
+    analysis_cache_put(cache_key, kind, model_name, data)
+    return data
+
+
+# -----------------------------
+# Background analysis jobs
+# -----------------------------
+# 画像・テキスト解析はスクリプトのスレッドで待たずにジョブとして投げ、結果は再実行時に
+# st.session_state へ取り込む。同じ入力の解析が走っている間は、同じジョブに相乗りする。
+ANALYSIS_JOB_WORKERS = 4
+ANALYSIS_JOB_MAX_PENDING = 16      # 待ち＋実行中のジョブ数の上限
+ANALYSIS_JOB_RETENTION_S = 600     # 終わったジョブを保持する時間
+ANALYSIS_JOB_POLL_S = 1.0          # 画面側で状態を確認する間隔
+
+
+class AnalysisJob:
+    __slots__ = ("id", "key", "kind", "status", "result", "error", "submitted_at", "started_at", "finished_at")
+
+    def __init__(self, key: str, kind: str):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.kind = kind
+        self.status = "queued"      # queued / running / done / error
+        self.result = None
+        self.error = None
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("done", "error")
+
+
+class _AnalysisJobQueue:
+    """セッションごとに解析ジョブを管理する、上限付きのスレッドプール。"""
+
+    def __init__(self, workers: int, max_pending: int):
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="analysis")
+        self._lock = threading.Lock()
+        self._jobs = {}          # job id -> AnalysisJob
+        self._active = {}        # 入力のキー -> 実行中（または待ち）のジョブ
+        self._sessions = {}      # session key -> {job id}
+
+    def submit(self, session_key: str, kind: str, key: str, fn, *args) -> AnalysisJob:
+        """ジョブを登録して返す。同じキーのジョブが未完了ならそれを返す。満杯なら GeminiUnavailableError。"""
+        with self._lock:
+            self._expire()
+            job = self._active.get(key)
+            if job is None:
+                pending = sum(1 for j in self._active.values() if not j.finished)
+                if pending >= self.max_pending:
+                    raise GeminiUnavailableError("解析の順番待ちがいっぱいです。しばらくしてから再度お試しください。")
+                job = AnalysisJob(key, kind)
+                self._jobs[job.id] = job
+                self._active[key] = job
+                self._executor.submit(self._run, job, fn, args)
+            self._sessions.setdefault(session_key, set()).add(job.id)
+            return job
+
+    def _run(self, job: AnalysisJob, fn, args):
+        job.started_at = time.time()
+        job.status = "running"
+        _get_metrics().record(f"jobs.{job.kind}.wait", job.started_at - job.submitted_at)
+        try:
+            job.result = fn(*args)
+            job.status = "done"
+        except Exception as e:
+            job.error = str(e) or type(e).__name__
+            job.status = "error"
+        finally:
+            job.finished_at = time.time()
+            _get_metrics().record(f"jobs.{job.kind}.run", job.finished_at - job.started_at, job.status == "done")
+            with self._lock:
+                if self._active.get(job.key) is job:
+                    del self._active[job.key]
+
+    def get(self, session_key: str, job_id: str):
+        with self._lock:
+            if job_id in self._sessions.get(session_key, ()):
+                return self._jobs.get(job_id)
+        return None
+
+    def forget(self, session_key: str, job_id: str):
+        with self._lock:
+            self._sessions.get(session_key, set()).discard(job_id)
+
+    def _expire(self):
+        cutoff = time.time() - ANALYSIS_JOB_RETENTION_S
+        expired = [jid for jid, j in self._jobs.items() if j.finished and j.finished_at < cutoff]
+        for jid in expired:
+            del self._jobs[jid]
+        if expired:
+            for ids in self._sessions.values():
+                ids.difference_update(expired)
+            for session_key in [k for k, ids in self._sessions.items() if not ids]:
+                del self._sessions[session_key]
+
 
+@st.cache_resource
+def _get_analysis_jobs() -> _AnalysisJobQueue:
+    return _AnalysisJobQueue(ANALYSIS_JOB_WORKERS, ANALYSIS_JOB_MAX_PENDING)
+
+
+def _session_key() -> str:
+    if "session_key" not in st.session_state:
+        st.session_state.session_key = uuid.uuid4().hex
+    return st.session_state.session_key
+
+
+def submit_image_analysis(image_bytes: bytes) -> AnalysisJob:
+    """画像解析をバックグラウンドで始める（同じ画像の解析中なら相乗り）。"""
+    key = analysis_cache_key("image", ",".join(GEMINI_IMAGE_MODELS), image_bytes)
+    return _get_analysis_jobs().submit(_session_key(), "image", key, _analyze_image, image_bytes)
+
+
+IMAGE_BATCH_MAX_FILES = 6   # 一度に分析できる写真の枚数（同時に走るのは ANALYSIS_JOB_WORKERS 枚まで）
+
+
+def _analyze_photo(raw_bytes: bytes) -> dict:
+    """アップロードされたままの写真を縮小してから解析する（複数枚のときはこれをジョブで並走させる）。"""
+    prepared, stats = preprocess_image(raw_bytes)
+    return {"analysis": _analyze_image(prepared), "preprocess": stats}
+
+
+def submit_photo_analysis(raw_bytes: bytes) -> AnalysisJob:
+    """写真1枚の前処理＋解析をバックグラウンドで始める（同じ写真の解析中なら相乗り）。"""
+    key = analysis_cache_key("photo", ",".join(GEMINI_IMAGE_MODELS), raw_bytes)
+    return _get_analysis_jobs().submit(_session_key(), "photo", key, _analyze_photo, raw_bytes)
+
+
+def submit_text_analysis(description: str) -> AnalysisJob:
+    """テキスト解析をバックグラウンドで始める（同じ記述の解析中なら相乗り）。"""
+    key = analysis_cache_key("text", gemini_model_name("text"), description)
+    return _get_analysis_jobs().submit(_session_key(), "text", key, _analyze_text, description)
+
+@instrumented("gemini.parse_exercise_from_text")
 def parse_exercise_from_text(text: str):
     """自由入力の運動記録を解析してJSONを返す"""
-    model = genai.GenerativeModel("gemini-2.5-flash")
     prompt = f"""
     以下のテキストから運動名と時間（分）を抽出し、JSONで返してください。
     時間は必ず整数にしてください。説明や```json```は不要です。
@@ -390,17 +2303,17 @@ def parse_exercise_from_text(text: str):
     }}
     """
     try:
-        resp = model.generate_content(prompt)
-        txt = (resp.text or "").strip().replace("```json", "").replace("```", "")
-        data = json.loads(txt)
-        if isinstance(data, dict) and "name" in data and "duration" in data:
-            return data
+        resp = gemini_generate("exercise", prompt, generation_config=json_output_config(EXERCISE_SCHEMA))
+        return _parse_structured(resp.text, validate_exercise, "exercise")[0]
+    except GeminiUnavailableError:
+        # 入力の問題ではないので呼び出し元で「しばらく待って」と案内する
+        raise
     except Exception:
         return None
 
+@instrumented("gemini.correct_exercise_from_text")
 def correct_exercise_from_text(original_data: dict, correction_text: str):
     """AIが提案した運動記録をユーザーの指示で修正する"""
-    model = genai.GenerativeModel("gemini-2.5-flash")
     prompt = f"""
     以下の現在の運動記録を、ユーザーの修正指示に従って修正し、新しいJSONを返してください。
     時間は必ず整数にしてください。説明や```json```は不要です。
@@ -414,17 +2327,17 @@ def correct_exercise_from_text(original_data: dict, correction_text: str):
     }}
     """
     try:
-        resp = model.generate_content(prompt)
-        txt = (resp.text or "").strip().replace("```json", "").replace("```", "")
-        data = json.loads(txt)
-        if isinstance(data, dict) and "name" in data and "duration" in data:
-            return data
+        resp = gemini_generate("exercise", prompt, generation_config=json_output_config(EXERCISE_SCHEMA))
+        return _parse_structured(resp.text, validate_exercise, "exercise")[0]
+    except GeminiUnavailableError:
+        # 入力の問題ではないので呼び出し元で「しばらく待って」と案内する
+        raise
     except Exception:
         return None
 
+@instrumented("gemini.refine_nutrition_with_ai")
 def refine_nutrition_with_ai(chat_history: list, current_data: dict):
     """栄養素の対話履歴と現在のデータから、修正案を生成する"""
-    model = genai.GenerativeModel("gemini-2.5-flash")
     prompt = f"""
 あなたは栄養管理の専門家です。以下の対話履歴と現在の栄養素データを基に、ユーザーの最新の修正依頼に回答してください。
 - ユーザーの指示が妥当であれば、栄養素データを修正した新しいJSONを返します。
@@ -452,11 +2365,8 @@ def refine_nutrition_with_ai(chat_history: list, current_data: dict):
 }}
 """
     try:
-        resp = model.generate_content(prompt)
-        txt = (resp.text or "").strip().replace("```json", "").replace("```", "")
-        data = json.loads(txt)
-        if isinstance(data, dict) and "response_text" in data and "updated_data" in data:
-            return data
+        resp = gemini_generate("refine", prompt, generation_config=json_output_config(NUTRITION_REFINEMENT_SCHEMA))
+        return _parse_structured(resp.text, validate_nutrition_refinement, "refine_nutrition")[0]
     except Exception as e:
         st.error(f"AIによる修正案の作成中にエラーが発生しました: {e}")
     return None
@@ -518,9 +2428,128 @@ def _parse_fraction_jp(text: str):
     return None
 
 
+# 「半分しか食べてない」「ご飯は1.5倍」のような量の指示だけなら AI を呼ばずに手元で按分する。
+_SCALE_TOKEN_RE = re.compile(
+    r"半分|\d+(?:\.\d+)?\s*分の\s*\d+(?:\.\d+)?|\d+(?:\.\d+)?\s*/\s*\d+(?:\.\d+)?|\d+(?:\.\d+)?\s*倍|\d+(?:\.\d+)?\s*%"
+)
+_SCALE_CLAUSE_SPLIT_RE = re.compile(r"[、。,，\n！!]|あと|それと|それから|また")
+_SCALE_SUBJECT_SPLIT_RE = re.compile(r"[と・&＆]")
+_SCALE_FILLER_RE = re.compile(
+    r"しか|だけ|ほど|くらい|ぐらい|程度|約|実際(?:に|は)?|本当は|ぶん|分量|量"
+    r"|食べ(?:てない|ていない|てません|ました|た|る)|飲(?:んでない|んでいない|みました|んだ)"
+    r"|(?:に|へ)?(?:修正|変更|訂正)?して(?:ください|下さい)?|でした|です|でお願いします|お願いします"
+    r"|\s"
+)
+_SCALE_PARTICLE_RE = re.compile(r"[はをがもの]+$")
+# 対象の語にこれらが残る指示（「ご飯以外は」「ご飯じゃなくてパンを」「焼き鳥5本じゃなくて」「大盛りで」）は
+# 単純な按分ではないので AI に任せる
+_SCALE_NOT_PURE_RE = re.compile(
+    r"以外|除|じゃな|ではな|でな|じゃ無|では無|でも|とか|など|なんか|代わり|かわり|より"
+    r"|大盛|並盛|小盛|特盛|中盛|多め|少なめ|追加|抜き|なし|無し|\d"
+)
+_SCALE_WHOLE_MEAL = ("全部", "全体", "すべて", "全て", "食事", "両方", "みんな", "どれも")
+_KANJI_DIGITS = {"一": "1", "二": "2", "三": "3", "四": "4", "五": "5", "六": "6", "七": "7", "八": "8", "九": "9", "十": "10"}
+
+
+def _normalize_scale_text(text: str) -> str:
+    t = unicodedata.normalize("NFKC", text or "")
+    # 三分の一 → 3分の1
+    return re.sub(
+        r"([一二三四五六七八九十])分の([一二三四五六七八九十])",
+        lambda m: f"{_KANJI_DIGITS[m.group(1)]}分の{_KANJI_DIGITS[m.group(2)]}",
+        t,
+    )
+
+
+def _match_dishes(subject: str, dishes: list) -> list:
+    """料理名が subject を含む料理の index を返す（subject 側に余計な語があれば当てない）。"""
+    key = _normalize_description(subject)
+    hits = []
+    for i, dish in enumerate(dishes):
+        name = _normalize_description(dish.get("name") or "")
+        if key and name and key in name:
+            hits.append(i)
+    return hits
+
+
+def parse_portion_instruction(text: str, dishes: list):
+    """修正指示が「量の按分」だけで表せるなら {料理index: 係数} を返す（全体指定は全料理）。
+
+    料理名に当たらない語や数量以外の指示（「5本じゃなくて3本」「ビールは飲んでいない」など）が
+    残る場合は None を返し、AI に任せる。
+    """
+    factors = {}
+    clauses = [c for c in _SCALE_CLAUSE_SPLIT_RE.split(_normalize_scale_text(text)) if c.strip()]
+    if not clauses:
+        return None
+    for clause in clauses:
+        tokens = list(_SCALE_TOKEN_RE.finditer(clause))
+        if len(tokens) != 1:
+            return None
+        token = tokens[0]
+        factor = _parse_fraction_jp(token.group(0).replace(" ", ""))
+        if factor is None or factor < 0:
+            return None
+        subject = clause[:token.start()]
+        rest = clause[token.end():]
+        if _SCALE_NOT_PURE_RE.search(_SCALE_FILLER_RE.sub("", subject)):
+            return None
+        if re.sub(r"[はをがもの]", "", _SCALE_FILLER_RE.sub("", rest)):
+            return None
+        names = [
+            n for n in (
+                _SCALE_PARTICLE_RE.sub("", _SCALE_FILLER_RE.sub("", p))
+                for p in _SCALE_SUBJECT_SPLIT_RE.split(subject)
+            ) if n
+        ]
+        if not names or all(n in _SCALE_WHOLE_MEAL for n in names):
+            targets = list(range(len(dishes)))
+        else:
+            targets = []
+            for n in names:
+                hit = _match_dishes(n, dishes)
+                if not hit:
+                    return None
+                targets.extend(hit)
+        for i in targets:
+            factors[i] = factors.get(i, 1.0) * factor
+    return factors or None
+
+
+@instrumented("local.apply_portion_adjustment")
+def apply_local_portion_adjustment(correction_text: str, current_data: dict):
+    """量の按分だけの修正指示をローカルで反映する。refine_nutrition_with_ai と同じ形の dict か None を返す。"""
+    dishes = (current_data or {}).get("dishes") or []
+    if not dishes:
+        return None
+    factors = parse_portion_instruction(correction_text, dishes)
+    if not factors:
+        return None
+    updated = json.loads(json.dumps(current_data))  # 深いコピー
+    changed = []
+    for i, factor in sorted(factors.items()):
+        dish = updated["dishes"][i]
+        dish["nutrients"] = _scale_nutrients(dish.get("nutrients"), factor)
+        dish["rationale"] = f"{dish.get('rationale') or ''}（量×{factor:g}）".strip()
+        changed.append(f"{dish.get('name')}×{factor:g}")
+    if "totalNutrients" in updated:
+        totals = {}
+        for dish in updated["dishes"]:
+            for k, v in (dish.get("nutrients") or {}).items():
+                try:
+                    totals[k] = round(totals.get(k, 0.0) + float(v or 0), 2)
+                except (TypeError, ValueError):
+                    continue
+        updated["totalNutrients"] = totals
+    return {
+        "response_text": "量の修正を反映しました: " + "、".join(changed),
+        "updated_data": updated,
+    }
+
+
+@instrumented("gemini.refine_by_note")
 def _refine_by_note(food_name: str, nutrients: dict, note: str):
     """補足説明を反映して、料理名/栄養値の上書き案を返す。失敗時は None。"""
-    model = genai.GenerativeModel("gemini-2.5-flash")
     base_json = json.dumps({"foodName": food_name, "nutrients": nutrients}, ensure_ascii=False)
     schema = """
 以下のJSONのみを返してください。説明不要。コードフェンス不要。
@@ -539,19 +2568,154 @@ def _refine_by_note(food_name: str, nutrients: dict, note: str):
         schema,
     ]
     try:
-        resp = model.generate_content(prompt_parts)
-        txt = (resp.text or "").strip().replace("```json", "").replace("```", "")
-        data = json.loads(txt)
-        if isinstance(data, dict) and data.get("nutrients"):
-            return data
+        resp = gemini_generate("refine", prompt_parts, generation_config=json_output_config(NOTE_REFINEMENT_SCHEMA))
+        return _parse_structured(resp.text, validate_note_refinement, "refine_by_note")[0]
     except Exception:
         return None
-    return None
+
+# =============================
+# Advice context builder (token budget)
+# =============================
+# 履歴を丸ごと to_string() するとプロンプトが際限なく伸びるため、
+# 週次集計 → 日次集計 → 特徴的な日 → 直近の記録 の優先順で予算内に収める。
+ADVICE_CONTEXT_TOKEN_BUDGET = 6000   # 全記録/期間分析
+ADVICE_QNA_TOKEN_BUDGET = 2500       # テキスト相談
+ADVICE_LATENCY_HISTORY_MAX = 50      # セッション内に残すアドバイス応答時間の件数
+_CONTEXT_DAILY_COLS = ["calories", "protein", "carbohydrates", "fat", "salt"]
+
+
+def estimate_tokens(text: str) -> int:
+    """ざっくりしたトークン数の見積もり（ASCII は4文字≒1、日本語などは1文字≒1）。"""
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return int(ascii_chars / 4 + (len(text) - ascii_chars)) + 1
+
+
+def _daily_frame(meals_df: pd.DataFrame, exercises_df: pd.DataFrame) -> pd.DataFrame:
+    """daily_totals と同じ形（水分補給除外）の日次集計を DataFrame から作る。"""
+    meals = meals_df[meals_df["meal_type"] != "水分補給"] if not meals_df.empty else meals_df
+    if meals.empty:
+        daily = pd.DataFrame(columns=["date"] + NUTRIENT_COLUMNS + ["meal_count"])
+    else:
+        daily = meals.groupby("date")[NUTRIENT_COLUMNS].sum(min_count=1).fillna(0)
+        daily["meal_count"] = meals.groupby("date").size()
+        daily = daily.reset_index()
+    if not exercises_df.empty:
+        ex = exercises_df.groupby("date")["duration_minutes"].agg(["sum", "count"]).reset_index()
+        ex.columns = ["date", "exercise_minutes", "exercise_count"]
+        daily = daily.merge(ex, on="date", how="outer")
+    for c in ("meal_count", "exercise_minutes", "exercise_count"):
+        if c not in daily.columns:
+            daily[c] = 0
+    return daily.fillna(0).sort_values("date")
+
+
+def _weekly_frame(daily: pd.DataFrame) -> pd.DataFrame:
+    d = daily.copy()
+    d["week"] = pd.to_datetime(d["date"]).dt.to_period("W-SUN").dt.start_time.dt.strftime("%Y-%m-%d")
+    recorded = d[d["meal_count"] > 0]
+    weekly = recorded.groupby("week")[_CONTEXT_DAILY_COLS].mean()
+    weekly.columns = [f"{c}_日平均" for c in _CONTEXT_DAILY_COLS]
+    weekly["食事記録日数"] = recorded.groupby("week").size()
+    weekly["運動分"] = d.groupby("week")["exercise_minutes"].sum()
+    return weekly.reset_index().rename(columns={"week": "週の開始日"}).fillna(0)
+
+
+def _outlier_days(daily: pd.DataFrame, meals_df: pd.DataFrame, limit: int = 10) -> pd.DataFrame:
+    """摂取カロリーが平均から2σ以上外れた日（主な料理付き）。"""
+    recorded = daily[daily["meal_count"] > 0]
+    if len(recorded) < 7:
+        return pd.DataFrame()
+    cal = recorded["calories"]
+    std = cal.std()
+    if not std:
+        return pd.DataFrame()
+    z = (cal - cal.mean()) / std
+    out = recorded.loc[z.abs() >= 2, ["date"] + _CONTEXT_DAILY_COLS].copy()
+    out["z"] = z[z.abs() >= 2]
+    out = out.reindex(out["z"].abs().sort_values(ascending=False).index).head(limit)
+    top = (
+        meals_df.sort_values("calories", ascending=False)
+        .groupby("date")["food_name"]
+        .apply(lambda names: "・".join(names.head(3)))
+    )
+    out["主な料理"] = out["date"].map(top)
+    return out
+
+
+def _fit_section(title: str, df: pd.DataFrame, budget: int, keep: str = "tail") -> tuple:
+    """df を見出し付き CSV にして budget トークン以内に収める（keep 側の行を残す）。戻り値は (テキスト, 行数)。"""
+    if df is None or df.empty or budget <= 0:
+        return "", 0
+    df = df.round(1)
+
+    def render(n):
+        part = df.tail(n) if keep == "tail" else df.head(n)
+        label = title if n == len(df) else f"{title}（{len(df)}件中{n}件）"
+        return f"# {label}\n{part.to_csv(index=False)}"
+
+    # 収まる最大行数を二分探索
+    lo, hi = 0, len(df)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if estimate_tokens(render(mid)) <= budget:
+            lo = mid
+        else:
+            hi = mid - 1
+    return (render(lo), lo) if lo else ("", 0)
+
+
+@instrumented("advice.build_context")
+def build_advice_context(meals_df: pd.DataFrame, exercises_df: pd.DataFrame,
+                         token_budget: int = ADVICE_CONTEXT_TOKEN_BUDGET, daily_df: pd.DataFrame = None):
+    """食事/運動の履歴を、トークン予算内の要約テキストにする。
+
+    daily_df に get_daily_totals() の結果を渡すと、日次集計を作り直さずにそれを使う。
+    戻り値は (テキスト, レポート dict)。レポートには見積もりトークン数・文字数・各セクションの行数を含む。
+    """
+    meals_df = meals_df if meals_df is not None else pd.DataFrame()
+    exercises_df = exercises_df if exercises_df is not None else pd.DataFrame()
+    daily = daily_df if daily_df is not None and not daily_df.empty else _daily_frame(meals_df, exercises_df)
+    daily = daily.sort_values("date")
+    meal_cols = ["date", "meal_type", "food_name", "calories", "protein", "carbohydrates", "fat"]
+    recent_meals = meals_df[meal_cols].sort_values("date", kind="stable") if not meals_df.empty else meals_df
+    recent_ex = (
+        exercises_df[["date", "exercise_name", "duration_minutes"]].sort_values("date", kind="stable")
+        if not exercises_df.empty else exercises_df
+    )
+    daily_cols = ["date"] + _CONTEXT_DAILY_COLS + ["meal_count", "exercise_minutes"]
+
+    # (見出し, DataFrame, 予算の配分, 残す側)。使い切らなかった分は次のセクションに回す。
+    sections = [
+        ("週次集計（記録日の1日平均）", _weekly_frame(daily) if not daily.empty else None, 0.20, "tail"),
+        ("日次集計（水分補給を除く）", daily[daily_cols] if not daily.empty else None, 0.30, "tail"),
+        ("特徴的な日（摂取カロリーが平均から±2σ以上）", _outlier_days(daily, meals_df) if not meals_df.empty else None, 0.10, "head"),
+        ("最近の食事記録", recent_meals, 0.28, "tail"),
+        ("最近の運動記録", recent_ex, 0.12, "tail"),
+    ]
+    parts, rows, carry = [], {}, 0
+    for title, df, share, keep in sections:
+        budget = int(token_budget * share) + carry
+        text, n = _fit_section(title, df, budget, keep)
+        used = estimate_tokens(text) if text else 0
+        carry = budget - used
+        rows[title] = n
+        if text:
+            parts.append(text)
+    context = "\n".join(parts) if parts else "（記録なし）\n"
+    report = {
+        "est_tokens": estimate_tokens(context),
+        "chars": len(context),
+        "token_budget": token_budget,
+        "rows": rows,
+    }
+    return context, report
+
 
 # =============================
 # Utils: NL → DataFrame query planner
 # =============================
 
+@instrumented("gemini.nl_to_plan")
 def _nl_to_plan(question: str) -> dict:
     """Geminiで自然文→クエリJSONに変換。失敗時は空dictを返す。"""
     schema = """
@@ -570,16 +2734,14 @@ def _nl_to_plan(question: str) -> dict:
 }
 """
     try:
-        model = genai.GenerativeModel("gemini-2.5-flash")
         prompt = f"""ユーザーの質問:
 {question}
 
 上の質問を、指定スキーマのJSONに変換してください。
 {schema}
 """
-        resp = model.generate_content(prompt)
-        txt = resp.text.strip().replace("```json", "").replace("```", "")
-        return json.loads(txt)
+        resp = gemini_generate("planner", prompt, generation_config=json_output_config(QUERY_PLAN_SCHEMA))
+        return _parse_structured(resp.text, validate_query_plan, "nl_to_plan")[0]
     except Exception:
         return {}
 
@@ -598,6 +2760,31 @@ def _postprocess_plan(question: str, plan: dict) -> dict:
         d = today - datetime.timedelta(days=1)
         ds = d.strftime("%Y-%m-%d")
         pr["date_range"] = {"start": ds, "end": ds}
+    week_start = today - datetime.timedelta(days=today.weekday())
+    month_start = today.replace(day=1)
+    if "今週" in q:
+        pr["date_range"] = {"start": week_start.strftime("%Y-%m-%d"), "end": today.strftime("%Y-%m-%d")}
+    if "先週" in q:
+        last_week = week_start - datetime.timedelta(days=7)
+        pr["date_range"] = {
+            "start": last_week.strftime("%Y-%m-%d"),
+            "end": (week_start - datetime.timedelta(days=1)).strftime("%Y-%m-%d"),
+        }
+    if "今月" in q:
+        pr["date_range"] = {"start": month_start.strftime("%Y-%m-%d"), "end": today.strftime("%Y-%m-%d")}
+    if "先月" in q:
+        last_month_end = month_start - datetime.timedelta(days=1)
+        pr["date_range"] = {
+            "start": last_month_end.replace(day=1).strftime("%Y-%m-%d"),
+            "end": last_month_end.strftime("%Y-%m-%d"),
+        }
+    m = re.search(r"(?:直近|過去|最近|ここ)\s*(\d+)\s*日", unicodedata.normalize("NFKC", q))
+    if m:
+        days = max(int(m.group(1)), 1)
+        pr["date_range"] = {
+            "start": (today - datetime.timedelta(days=days - 1)).strftime("%Y-%m-%d"),
+            "end": today.strftime("%Y-%m-%d"),
+        }
 
     # --- "どの/内訳/どれくらい/食材" → 食品別の内訳を求めていると解釈 ---
     if any(k in q for k in ["どの", "内訳", "どれくらい", "どれぐらい", "食材"]):
@@ -609,28 +2796,160 @@ def _postprocess_plan(question: str, plan: dict) -> dict:
     return pr
 
 
+# -----------------------------
+# Plan cache
+# -----------------------------
+# 同じ質問（表記揺れは正規化）には AI を呼ばず、保存しておいた計画を使う。
+# 相対日付は実行時に _postprocess_plan で解決し直すので「今日の〜」を翌日聞いても正しい日付になる。
+# 別の日に保存した計画の期間は、質問の種類で扱いを変える:
+#   「直近3日」「5日前」のような今日から数える期間 → 経過日数ぶんずらす
+#   「今年」「来月」のような暦の上の相対表現 → ずらすと意味が変わるので AI に聞き直す
+#   「9月」「2025年」のような絶対的な期間 → そのまま使う
+PLAN_CACHE_MAX_ENTRIES = 256
+_EXPLICIT_DATE_RE = re.compile(r"\d{4}[-/年]\d{1,2}[-/月]\d{1,2}|\d{1,2}月\d{1,2}日|\d{1,2}/\d{1,2}")
+_ROLLING_DATE_RE = re.compile(
+    r"直近|過去\s*\d|最近\s*\d|ここ\s*\d|一昨日|おととい"
+    r"|\d+\s*(?:日|週間|か月|ヶ月|カ月|ヵ月|年)\s*(?:前|間)"
+)
+_CALENDAR_RELATIVE_RE = re.compile(
+    r"今年|去年|昨年|一昨年|おととし|来年|前年|先々週|先々月|来週|来月|前週|前月|今期|今季|今シーズン|この(?:冬|夏|春|秋)"
+)
+
+
+class _PlanCache:
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._plans = OrderedDict()   # 正規化した質問 -> (計画, 計画を作った日)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._plans.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._plans.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key: str, plan: dict, planned_on: datetime.date):
+        with self._lock:
+            self._plans[key] = (plan, planned_on)
+            self._plans.move_to_end(key)
+            while len(self._plans) > self.max_entries:
+                self._plans.popitem(last=False)
+
+
+@st.cache_resource
+def _get_plan_cache():
+    return _PlanCache(PLAN_CACHE_MAX_ENTRIES)
+
+
+def _shift_date_range(plan: dict, days: int) -> dict:
+    dr = plan.get("date_range") or {}
+    shifted = {}
+    for k in ("start", "end"):
+        d = pd.to_datetime(dr.get(k), errors="coerce")
+        if pd.isna(d):
+            return plan
+        shifted[k] = (d + pd.Timedelta(days=days)).strftime("%Y-%m-%d")
+    return {**plan, "date_range": shifted}
+
+
+@instrumented("planner.plan_question")
+def plan_question(question: str):
+    """質問を実行計画にする。戻り値は (計画, キャッシュから取ったか)。解釈できなければ計画は空 dict。"""
+    # 空白や「？」「。」の有無では計画は変わらない
+    key = re.sub(r"[\s?!。、,.]", "", _normalize_description(question))
+    today = datetime.date.today()
+    cache = _get_plan_cache()
+    entry = cache.get(key)
+    q = unicodedata.normalize("NFKC", question or "")
+    if entry is not None and entry[0].get("date_range") and entry[1] != today and _CALENDAR_RELATIVE_RE.search(q):
+        # 「今年」「来月」などは日数でずらせないので、別の日に作った計画は使わない
+        entry = None
+    if entry is not None:
+        plan, planned_on = entry
+        from_cache = True
+        if (plan.get("date_range") and planned_on != today
+                and _ROLLING_DATE_RE.search(q) and not _EXPLICIT_DATE_RE.search(q)):
+            # 「ここ3日」「5日前」など今日から数える期間は、経過日数ぶんずらしておく
+            plan = _shift_date_range(plan, (today - planned_on).days)
+    else:
+        plan = _nl_to_plan(question)
+        from_cache = False
+        if not plan:
+            # 解釈できなかった質問は保存も補正もせず、画面側で「変換できませんでした」と出す
+            return {}, False
+        cache.put(key, plan, today)
+    return _postprocess_plan(question, plan), from_cache
+
+
+# -----------------------------
+# Analytics frame
+# -----------------------------
+# _execute_plan 用に型変換・日付ソート済みの DataFrame をデータバージョンごとに1つだけ作って共有する。
+# st.cache_resource なので呼び出し側は破壊的変更をしないこと（_execute_plan はスライスしか作らない）。
+
+def _to_analytics_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """date を datetime64、栄養素を float32、meal_type/food_name を category にして (date, id) 順に並べる。"""
+    out = pd.DataFrame({
+        "id": df["id"] if "id" in df.columns else pd.RangeIndex(len(df)),
+        "date": pd.to_datetime(df["date"], errors="coerce"),
+        "meal_type": df["meal_type"].astype("category"),
+        "food_name": df["food_name"].astype("category"),
+    })
+    for c in NUTRIENT_COLUMNS:
+        if c in df.columns:
+            out[c] = pd.to_numeric(df[c], errors="coerce").astype("float32")
+    out = out.sort_values(["date", "id"], kind="stable", na_position="last").reset_index(drop=True)
+    out.attrs["analytics_frame"] = True
+    return out
+
+
+@st.cache_resource(max_entries=2, show_spinner=False)
+def _load_analytics_frame(version: int) -> pd.DataFrame:
+    with get_db_connection() as conn:
+        df = pd.read_sql_query("SELECT * FROM meals ORDER BY date, id", conn)
+    return _to_analytics_frame(df)
+
+
+@instrumented("db.get_analytics_frame")
+def get_analytics_frame() -> pd.DataFrame:
+    """_execute_plan 用の型付き・日付昇順の食事記録（読み取り専用として扱う）。"""
+    return _load_analytics_frame(data_version("meals"))
+
+
+_PLAN_AGG_ALIASES = {"avg": "mean", "average": "mean"}
+
+
+@instrumented("analytics.execute_plan")
 def _execute_plan(df: pd.DataFrame, plan: dict):
-    """計画に従ってDataFrameを抽出/集計し、(結果DF, サマリ文字列)を返す。"""
+    """計画に従ってDataFrameを抽出/集計し、(結果DF, サマリ文字列)を返す。
+
+    df には get_analytics_frame() を渡すのが速い（生の get_all_records() でも動く）。
+    """
     if df.empty:
         return pd.DataFrame(), "記録がありません。"
 
-    work = df.copy()
-    # 型整形
-    work["date"] = pd.to_datetime(work["date"], errors="coerce")
-    num_cols = ["calories", "protein", "carbohydrates", "fat", "vitamin_d", "salt", "zinc", "folic_acid"]
-    for c in num_cols:
-        if c in work.columns:
-            work[c] = pd.to_numeric(work[c], errors="coerce")
+    work = df if df.attrs.get("analytics_frame") else _to_analytics_frame(df)
 
-    # フィルタ
+    # フィルタ（date は昇順なので二分探索でスライスする）
     pr = plan or {}
     dr = pr.get("date_range") or {}
+    dates = work["date"].values
+    lo, hi = 0, len(work)
     if dr.get("start"):
         start = pd.to_datetime(dr.get("start"), errors="coerce")
-        work = work[work["date"] >= start]
+        if not pd.isna(start):
+            lo = int(dates.searchsorted(start.to_datetime64(), side="left"))
     if dr.get("end"):
         end = pd.to_datetime(dr.get("end"), errors="coerce")
-        work = work[work["date"] <= end]
+        if not pd.isna(end):
+            hi = int(dates.searchsorted(end.to_datetime64(), side="right"))
+    work = work.iloc[lo:max(lo, hi)]
 
     mts = pr.get("meal_types") or []
     if mts:
@@ -638,44 +2957,49 @@ def _execute_plan(df: pd.DataFrame, plan: dict):
 
     kw = pr.get("name_contains")
     if kw:
-        work = work[work["food_name"].str.contains(str(kw), case=False, na=False)]
+        # 部分一致は料理名の種類数ぶんだけ判定し、行側はカテゴリの照合だけにする
+        names = work["food_name"].cat.categories
+        work = work[work["food_name"].isin(names[names.str.contains(str(kw), case=False, regex=False)])]
 
     action = (pr.get("action") or "filter").lower()
-    metrics = pr.get("metrics") or ["calories"]
+    metrics = [m for m in (pr.get("metrics") or ["calories"]) if m in work.columns] or ["calories"]
 
     if work.empty:
         return pd.DataFrame(), "条件に一致する記録がありません。"
 
     if action == "filter":
-        cols = ["date", "meal_type", "food_name"] + [c for c in metrics if c in work.columns]
-        out = work[cols].sort_values("date", ascending=False)
+        cols = ["date", "meal_type", "food_name"] + metrics
+        # (date, id) 昇順を逆順にすれば新しい順
+        out = work[cols].iloc[::-1]
         return out, f"{len(out)}件ヒット"
 
     if action in ("aggregate", "trend"):
         gb = pr.get("group_by")
         agg = pr.get("agg") or "sum"
-        agg_map = {m: agg for m in metrics if m in work.columns}
+        pd_agg = _PLAN_AGG_ALIASES.get(agg, agg)
+        agg_map = {m: pd_agg for m in metrics}
         if gb in ("date", "meal_type", "food_name"):
-            out = work.groupby(gb).agg(agg_map).reset_index()
-            if gb == "date":
-                out = out.sort_values("date")
+            out = work.groupby(gb, observed=True, sort=(gb != "date")).agg(agg_map).reset_index()
             return out, f"{gb}別の{agg}"
         else:
-            out = work[metrics].agg(agg)
+            out = work[metrics].agg(pd_agg)
             out = out.to_frame(name=agg).reset_index().rename(columns={"index": "metric"})
             return out, f"全体の{agg}"
 
     if action == "top_n":
-        sort_by = pr.get("sort_by") or metrics[0]
+        sort_by = pr.get("sort_by") if pr.get("sort_by") in work.columns else metrics[0]
         order = (pr.get("sort_order") or "desc").lower() == "desc"
         n = int(pr.get("top_n") or 5)
         cols = ["date", "meal_type", "food_name", sort_by]
-        cols = [c for c in cols if c in work.columns]
-        out = work.sort_values(sort_by, ascending=not order)[cols].head(n)
+        cols = list(dict.fromkeys(c for c in cols if c in work.columns))
+        if order:
+            out = work.nlargest(n, sort_by)[cols]
+        else:
+            out = work.nsmallest(n, sort_by)[cols]
         return out, f"{sort_by}の上位{n}件"
 
     # default
-    out = work[["date", "meal_type", "food_name"] + [c for c in metrics if c in work.columns]].sort_values("date", ascending=False)
+    out = work[["date", "meal_type", "food_name"] + metrics].iloc[::-1]
     return out, f"{len(out)}件ヒット"
 
 # =============================
@@ -685,10 +3009,10 @@ def _execute_plan(df: pd.DataFrame, plan: dict):
 ALLOWED_COLS = {"id","date","meal_type","food_name","calories","protein","carbohydrates","fat","vitamin_d","salt","zinc","folic_acid"}
 
 
+@instrumented("gemini.llm_to_sql")
 def llm_to_sql(question: str) -> dict:
-    """自然文から安全なSQL(JSON)を生成する。Gemini 2.5 Flash を使用。"""
+    """自然文から安全なSQL(JSON)を生成する。"""
     today_jst = (datetime.datetime.utcnow() + datetime.timedelta(hours=9)).date().strftime("%Y-%m-%d")
-    model = genai.GenerativeModel("gemini-2.5-flash")
     schema_tmpl = """
 あなたはSQLite用のSQLアシスタントです。次の制約を必ず守ってください:
 - SELECT文のみ。INSERT/UPDATE/DELETE/ALTER/DROP は禁止（セミコロン含む）。
@@ -715,455 +3039,851 @@ JSONのみを返してください（説明不要・コードフェンス不要
 上記の制約でSQL JSONを返してください。
 {schema}
 """
-    resp = model.generate_content(prompt)
-    txt = (resp.text or "").strip().replace("```json", "").replace("```", "")
+    resp = gemini_generate("sql", prompt, generation_config=json_output_config(SQL_QUERY_SCHEMA))
     try:
-        return json.loads(txt)
-    except Exception:
+        return _parse_structured(resp.text, validate_sql_query, "llm_to_sql")[0]
+    except StructuredOutputError:
         return {"sql": "", "params": [], "intent": "parse_error"}
 
 
+# 自由モードの SQL は読み取り専用接続・authorizer・時間/命令数の上限・行数上限の中で実行する。
+SQL_MAX_ROWS = 500
+SQL_TIME_BUDGET_S = 2.0            # 実行時間の上限（秒）
+SQL_INSTRUCTION_BUDGET = 50_000_000  # VM 命令数の上限
+SQL_PROGRESS_INTERVAL = 10_000     # progress handler を呼ぶ間隔（VM 命令数）
+_SQL_ALLOWED_TABLES = {"meals"}
+_SQL_DENIED_FUNCTIONS = {"load_extension", "readfile", "writefile", "edit", "fts3_tokenizer"}
+
+
+def _open_readonly_connection():
+    conn = sqlite3.connect(
+        f"file:{DB_FILE}?mode=ro",
+        uri=True,
+        timeout=DB_BUSY_TIMEOUT_MS / 1000,
+        check_same_thread=False,
+        cached_statements=DB_CACHED_STATEMENTS,
+    )
+    conn.execute(f"PRAGMA busy_timeout={int(DB_BUSY_TIMEOUT_MS)}")
+    conn.execute("PRAGMA query_only=ON")
+    return conn
+
+
+@st.cache_resource
+def _get_readonly_pool():
+    return _ConnectionPool(2, opener=_open_readonly_connection)
+
+
+def _sql_authorizer(action, arg1, arg2, db_name, trigger):
+    """meals の許可列の読み取りと SELECT に必要な操作だけを通す。"""
+    if action in (sqlite3.SQLITE_SELECT, getattr(sqlite3, "SQLITE_RECURSIVE", 33)):
+        return sqlite3.SQLITE_OK
+    if action == sqlite3.SQLITE_READ:
+        if arg1 not in _SQL_ALLOWED_TABLES:
+            return sqlite3.SQLITE_DENY
+        # 許可外の列（is_favorite など）は NULL として読ませる
+        return sqlite3.SQLITE_OK if (arg2 in ALLOWED_COLS or not arg2) else sqlite3.SQLITE_IGNORE
+    if action == sqlite3.SQLITE_FUNCTION:
+        return sqlite3.SQLITE_DENY if (arg2 or "").lower() in _SQL_DENIED_FUNCTIONS else sqlite3.SQLITE_OK
+    return sqlite3.SQLITE_DENY
+
+
+def _log_query_plan(conn, sql: str, params: list):
+    """EXPLAIN QUERY PLAN をログに出す。全件走査（SCAN）を含む場合は WARNING。"""
+    try:
+        plan_rows = conn.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+    except sqlite3.Error as e:
+        # 本実行でも同じエラーになるので、ここでは記録だけに留める
+        logger.debug("EXPLAIN QUERY PLAN failed: %s", e)
+        return []
+    details = [row[-1] for row in plan_rows]
+    full_scan = any(d.startswith("SCAN") for d in details)
+    logger.log(logging.WARNING if full_scan else logging.INFO, "llm sql plan%s: %s | %s",
+               " (full scan)" if full_scan else "", " / ".join(details), sql)
+    return details
+
+
+@instrumented("db.safe_run_sql")
 def _safe_run_sql(sql: str, params: list):
-    """最低限のサニタイズを行ってからSQLを実行してDataFrameを返す。"""
+    """LLM が生成した SELECT を読み取り専用・時間制限付きで実行して DataFrame を返す。
+
+    meals 以外の参照や SELECT 以外の操作は authorizer が拒否する。行数は SQL_MAX_ROWS で打ち切り、
+    打ち切った場合は df.attrs["truncated"] が True になる。違反・時間超過は ValueError。
+    """
     if not sql:
         raise ValueError("SQLが空です")
-    s = sql.strip().lower()
-    if not s.startswith("select"):
+    s = sql.strip().rstrip(";").strip()
+    if not s.lower().startswith(("select", "with")):
         raise ValueError("SELECTのみ許可")
-    for bad in ["insert", "update", "delete", "drop", "alter", "attach", "pragma", ";"]:
-        if bad in s:
-            raise ValueError("禁止キーワードを検出しました")
-    if " from " not in s or "meals" not in s:
-        raise ValueError("FROM は meals のみ許可")
-    if " limit " not in s:
-        sql = sql.strip() + " LIMIT 500"
-    conn = get_db_connection()
+    params = list(params or [])
+
+    pool = _get_readonly_pool()
+    conn = pool.acquire()
+    deadline = time.perf_counter() + SQL_TIME_BUDGET_S
+    executed = [0]
+
+    def progress():
+        executed[0] += SQL_PROGRESS_INTERVAL
+        # 0 以外を返すと SQLite が実行を中断する
+        return int(time.perf_counter() > deadline or executed[0] > SQL_INSTRUCTION_BUDGET)
+
     try:
-        df = pd.read_sql_query(sql, conn, params=params or [])
+        conn.set_authorizer(_sql_authorizer)
+        _log_query_plan(conn, s, params)
+        conn.set_progress_handler(progress, SQL_PROGRESS_INTERVAL)
+        try:
+            cur = conn.execute(s, params)
+            rows = cur.fetchmany(SQL_MAX_ROWS + 1)
+            columns = [d[0] for d in cur.description or []]
+            cur.close()
+        except sqlite3.Error as e:
+            msg = str(e)
+            if "interrupted" in msg:
+                raise ValueError(
+                    f"クエリが実行上限（{SQL_TIME_BUDGET_S:g}秒 / {SQL_INSTRUCTION_BUDGET:,}命令）を超えたため中断しました"
+                ) from e
+            if "not authorized" in msg or "prohibited" in msg:
+                raise ValueError(f"許可されていない操作です（meals の参照のみ可）: {msg}") from e
+            raise ValueError(f"SQLを実行できません: {msg}") from e
+        except sqlite3.Warning as e:
+            # 複文（; 区切り）など
+            raise ValueError(f"SQLを実行できません: {e}") from e
     finally:
-        conn.close()
+        conn.set_progress_handler(None, 0)
+        conn.set_authorizer(None)
+        pool.release(conn)
+
+    df = pd.DataFrame.from_records(rows[:SQL_MAX_ROWS], columns=columns)
+    df.attrs["truncated"] = len(rows) > SQL_MAX_ROWS
     return df
 
 # =============================
 # App
 # =============================
-init_db()
-
-# --- Sidebar ---
-with st.sidebar:
-    st.markdown("### メニュー")
-    menu = st.radio("選択", ["食事記録", "運動記録", "相談する"], index=0, label_visibility="collapsed")
-
-# --- Dynamic Header ---
-if menu == "食事記録":
-    title = "🍽️ 食事記録"
-    subtitle = "日々の食事やサプリ・水分補給をシンプルに記録しましょう。"
-elif menu == "運動記録":
-    title = "💪 運動記録"
-    subtitle = "日々の運動を記録して、活動の習慣を可視化しましょう。"
-else: # 相談する
-    title = "💬 AIに相談する"
-    subtitle = "食事と運動の記録を基に、AIがパーソナルなアドバイスをします。"
-
-st.markdown(
-    f"""
-    <div class="hero">
-      <div class="hero-title">{title}</div>
-      <div class="hero-sub">{subtitle}</div>
-    </div>
-    """,
-    unsafe_allow_html=True,
-)
+MEAL_TYPES = ["朝食", "昼食", "夕食", "間食", "プロテイン", "サプリ", "水分補給"]
+PAGE_SIZE_OPTIONS = [25, 50, 100, 200]
 
-# --- Quick glance (today) ---
-if menu != "相談する": # 相談ページでは非表示
-    all_df = get_all_records()
 
-    def _sum_today(df: pd.DataFrame):
-        if df.empty:
-            return {"cal": 0, "p": 0, "c": 0, "f": 0}
-        today_str = datetime.date.today().strftime("%Y-%m-%d")
-        t = df[df["date"] == today_str]
-        t = t[t["meal_type"] != "水分補給"]
-        return {
-            "cal": float(t["calories"].fillna(0).sum()),
-            "p": float(t["protein"].fillna(0).sum()),
-            "c": float(t["carbohydrates"].fillna(0).sum()),
-            "f": float(t["fat"].fillna(0).sum()),
-        }
+def _page_cursor(state_key: str, filter_sig) -> tuple:
+    """ページ送りの状態を返す。フィルタ条件が変わったら先頭ページに戻す。"""
+    stack_key, sig_key = f"{state_key}_cursors", f"{state_key}_filter"
+    if st.session_state.get(sig_key) != filter_sig or stack_key not in st.session_state:
+        st.session_state[stack_key] = [None]
+        st.session_state[sig_key] = filter_sig
+    stack = st.session_state[stack_key]
+    return stack[-1], len(stack)
 
-    sum_today = _sum_today(all_df)
-    col1, col2, col3, col4 = st.columns(4)
-    col1.metric("本日のカロリー", f"{int(sum_today['cal'])} kcal")
-    col2.metric("たんぱく質", f"{sum_today['p']:.1f} g")
-    col3.metric("炭水化物", f"{sum_today['c']:.1f} g")
-    col4.metric("脂質", f"{sum_today['f']:.1f} g")
 
-# =============================
-# RECORD
-# =============================
-if menu == "食事記録":
-    with st.container():
-        st.markdown('<div class="card">', unsafe_allow_html=True)
-        st.subheader("食事の記録")
-        
-        left, right = st.columns([1, 1])
-        with left:
-            meal_type = st.selectbox(
-                "記録の種類",
-                ["朝食", "昼食", "夕食", "間食", "プロテイン", "サプリ", "水分補給"],
-                index=0,
+def _is_admin() -> bool:
+    """?admin=<ADMIN_TOKEN> で開いたときだけ管理者向けの表示を出す（ADMIN_TOKEN 未設定なら常に False）。"""
+    try:
+        token = st.secrets.get("ADMIN_TOKEN") or os.environ.get("DIET_APP_ADMIN_TOKEN")
+    except FileNotFoundError:
+        token = os.environ.get("DIET_APP_ADMIN_TOKEN")
+    if not token:
+        return False
+    if st.query_params.get("admin") == token:
+        st.session_state["is_admin"] = True
+    return bool(st.session_state.get("is_admin"))
+
+
+def _render_metrics_panel():
+    with st.expander("パフォーマンス（このプロセス）", expanded=False):
+        rows = _get_metrics().summary()
+        if not rows:
+            st.caption("まだ計測値がありません。")
+            return
+        df = pd.DataFrame(rows).set_index("op")
+        st.dataframe(df.round(1), use_container_width=True)
+        if st.button("計測値をリセット", key="reset_metrics", use_container_width=True):
+            _get_metrics().reset()
+            st.rerun()
+
+
+def _sum_today():
+    """本日の（水分補給を除く）カロリー・PFC 合計。"""
+    t = get_daily_totals(datetime.date.today())
+    if t.empty:
+        return {"cal": 0, "p": 0, "c": 0, "f": 0}
+    row = t.iloc[0]
+    return {
+        "cal": float(row["calories"]),
+        "p": float(row["protein"]),
+        "c": float(row["carbohydrates"]),
+        "f": float(row["fat"]),
+    }
+
+
+def _start_analysis_job(submit, payload):
+    try:
+        job = submit(payload)
+    except GeminiUnavailableError as e:
+        st.warning(str(e))
+        return
+    st.session_state.analysis_job_id = job.id
+    # 前の推定結果は、新しい結果が届くまで表示しない
+    st.session_state.pop("analysis_result", None)
+
+
+def _poll_analysis_job():
+    """解析ジョブを確認し、終わっていれば結果（またはエラー）を session_state に取り込む。
+
+    まだ終わっていなければそのジョブを、確認するものが無ければ None を返す。
+    """
+    job_id = st.session_state.get("analysis_job_id")
+    if not job_id:
+        return None
+    jobs = _get_analysis_jobs()
+    job = jobs.get(_session_key(), job_id)
+    if job is not None and not job.finished:
+        return job
+    del st.session_state["analysis_job_id"]
+    if job is None:
+        return None
+    jobs.forget(_session_key(), job_id)
+    if job.status == "done":
+        st.session_state.analysis_result = job.result
+        st.session_state.nutrition_chat_history = []
+    else:
+        st.session_state.analysis_job_error = job.error
+    return None
+
+
+@st.fragment(run_every=ANALYSIS_JOB_POLL_S)
+def _analysis_job_status():
+    """解析中の表示。この部分だけを定期的に再実行し、終わったら画面全体を更新する。"""
+    job = _poll_analysis_job()
+    if job is None:
+        st.rerun()
+    label = "画像" if job.kind == "image" else "記述内容"
+    st.info(f"AIが{label}を分析中です…（{time.time() - job.submitted_at:.0f}秒経過）。この間も他の操作を続けられます。")
+
+
+def _start_photo_batch(files):
+    """複数枚の写真をそれぞれジョブとして投げ、一覧を session_state に置く。同じ写真は1回だけ。"""
+    batch, seen = [], set()
+    for f in files[:IMAGE_BATCH_MAX_FILES]:
+        try:
+            job = submit_photo_analysis(f.getvalue())
+        except GeminiUnavailableError as e:
+            st.warning(f"{f.name} 以降は受け付けられませんでした: {e}")
+            break
+        if job.id in seen:
+            continue
+        seen.add(job.id)
+        batch.append({"name": f.name, "job_id": job.id})
+    st.session_state.analysis_batch = batch
+    st.session_state.pop("analysis_batch_dishes", None)
+    st.session_state.pop("analysis_result", None)
+
+
+def _photo_batch_jobs() -> list:
+    """(写真の情報, ジョブ or None) の一覧。None は期限切れで結果が失われたもの。"""
+    jobs = _get_analysis_jobs()
+    return [(entry, jobs.get(_session_key(), entry["job_id"])) for entry in st.session_state.get("analysis_batch", [])]
+
+
+def _photo_batch_line(entry: dict, job) -> str:
+    if job is None:
+        return f"⚠️ {entry['name']}: 結果の保持期限が切れました"
+    if job.status == "done":
+        analysis = job.result["analysis"]
+        note = "（応答が途中で切れたため一部欠けている可能性あり）" if analysis.get("truncated") else ""
+        return f"✅ {entry['name']}: {len(analysis.get('dishes', []))}品{note}"
+    if job.status == "error":
+        return f"⚠️ {entry['name']}: {job.error}"
+    return f"⏳ {entry['name']}: {'分析中' if job.status == 'running' else '順番待ち'}…"
+
+
+def _merge_photo_batch(entries: list, meal_type: str) -> pd.DataFrame:
+    """全写真の料理を1つの編集用の表にまとめる。"""
+    rows = []
+    for entry, job in entries:
+        if job is None or job.status != "done":
+            continue
+        for dish in job.result["analysis"].get("dishes", []):
+            nutrients = dish.get("nutrients") or {}
+            row = {"記録": True, "写真": entry["name"], "種類": meal_type, "料理名": dish.get("name") or ""}
+            row.update({col: nutrients.get(key) for col, key in _NUTRIENT_RESULT_KEYS.items()})
+            rows.append(row)
+    frame = pd.DataFrame(rows, columns=["記録", "写真", "種類", "料理名", *_NUTRIENT_RESULT_KEYS])
+    for col in _NUTRIENT_RESULT_KEYS:
+        frame[col] = pd.to_numeric(frame[col], errors="coerce")
+    return frame
+
+
+@st.fragment(run_every=ANALYSIS_JOB_POLL_S)
+def _photo_batch_status():
+    """写真ごとの進み具合。全部終わったら画面全体を更新して一覧の編集に移る。"""
+    entries = _photo_batch_jobs()
+    finished = sum(1 for _, job in entries if job is None or job.finished)
+    if finished == len(entries):
+        st.rerun()
+    st.progress(finished / len(entries), text=f"{finished} / {len(entries)} 枚の分析が完了")
+    for entry, job in entries:
+        st.caption(_photo_batch_line(entry, job))
+
+
+def _render_photo_batch(record_date, meal_type: str):
+    entries = _photo_batch_jobs()
+    if any(job is not None and not job.finished for _, job in entries):
+        _photo_batch_status()
+        return
+    for entry, job in entries:
+        if job is None or job.status != "done":
+            st.caption(_photo_batch_line(entry, job))
+    if "analysis_batch_dishes" not in st.session_state:
+        st.session_state.analysis_batch_dishes = _merge_photo_batch(entries, meal_type)
+    dishes = st.session_state.analysis_batch_dishes
+    if dishes.empty:
+        st.error("どの写真からも料理を推定できませんでした。テキストで入力してください。")
+        return
+
+    st.markdown("##### まとめて記録する料理")
+    st.caption("内容・種類・栄養素は直接編集できます。記録しない料理はチェックを外すか行を削除してください。")
+    edited = st.data_editor(
+        dishes,
+        num_rows="dynamic",
+        column_config={
+            "記録": st.column_config.CheckboxColumn("記録", width="small", default=True),
+            "写真": st.column_config.TextColumn("写真", disabled=True),
+            "種類": st.column_config.SelectboxColumn("種類", options=MEAL_TYPES, required=True, default=meal_type),
+            "料理名": st.column_config.TextColumn("料理名", required=True),
+            "calories": st.column_config.NumberColumn("cal", format="%.0f"),
+            "protein": st.column_config.NumberColumn("P", format="%.1f"),
+            "carbohydrates": st.column_config.NumberColumn("C", format="%.1f"),
+            "fat": st.column_config.NumberColumn("F", format="%.1f"),
+            "vitamin_d": st.column_config.NumberColumn("VitD", format="%.1f"),
+            "salt": st.column_config.NumberColumn("塩分", format="%.1f"),
+            "zinc": st.column_config.NumberColumn("亜鉛", format="%.1f"),
+            "folic_acid": st.column_config.NumberColumn("葉酸", format="%.0f"),
+        },
+        hide_index=True,
+        use_container_width=True,
+        key="analysis_batch_editor",
+    )
+    selected = edited[edited["記録"].fillna(False).astype(bool) & edited["料理名"].fillna("").astype(str).str.strip().ne("")]
+    if st.button(f"{len(selected)}件をまとめて記録する", type="primary", disabled=selected.empty):
+        records = [
+            (
+                record_date,
+                row["種類"] or meal_type,
+                row["料理名"].strip(),
+                {key: (None if pd.isna(row[col]) else float(row[col])) for col, key in _NUTRIENT_RESULT_KEYS.items()},
+            )
+            for _, row in selected.iterrows()
+        ]
+        # add_records は1トランザクションで書き込む
+        add_records(records)
+        st.success(f"{len(records)}件の料理を記録しました: {', '.join(r[2] for r in records)}")
+        for entry, _ in entries:
+            _get_analysis_jobs().forget(_session_key(), entry["job_id"])
+        for key in list(st.session_state.keys()):
+            if key.startswith("analysis_"):
+                del st.session_state[key]
+        st.rerun()
+
+
+def _meal_editor_frame(page_df: pd.DataFrame) -> pd.DataFrame:
+    """食事記録一覧の data_editor に渡す表。お気に入りを bool にし、削除チェック列を足す。"""
+    display_df = page_df.copy()
+    display_df['is_favorite'] = display_df['is_favorite'].astype(bool)
+    display_df["削除"] = False
+    return display_df
+
+
+def _page_nav(state_key: str, next_cursor, shown: int):
+    stack = st.session_state[f"{state_key}_cursors"]
+    nav_prev, nav_next, nav_info = st.columns([1, 1, 4])
+    if nav_prev.button("← 前へ", key=f"{state_key}_prev", disabled=len(stack) <= 1, use_container_width=True):
+        stack.pop()
+        st.rerun()
+    if nav_next.button("次へ →", key=f"{state_key}_next", disabled=next_cursor is None, use_container_width=True):
+        stack.append(next_cursor)
+        st.rerun()
+    nav_info.caption(f"{len(stack)}ページ目（{shown}件を表示）")
+
+
+def main():
+    run_started = time.perf_counter()
+    _setup_page()
+    _require_api_key()
+    init_db()
+    try:
+        _render()
+    finally:
+        # st.stop() / st.rerun() で抜けた場合も計測する
+        run_s = time.perf_counter() - run_started
+        _record_run(run_s)
+        _get_metrics().record("render.total", run_s)
+
+
+def _render():
+    lap = _section_timer("render")
+
+    # --- Sidebar ---
+    with st.sidebar:
+        st.markdown("### メニュー")
+        menu = st.radio("選択", ["食事記録", "運動記録", "相談する"], index=0, label_visibility="collapsed")
+        with st.expander("メンテナンス", expanded=False):
+            st.caption("日別集計（daily_totals）が記録とずれた場合に再集計します。")
+            if st.button("日別集計を再構築", key="rebuild_daily_totals", use_container_width=True):
+                rebuild_daily_totals()
+                st.success("日別集計を再構築しました。")
+            cache_stats = analysis_cache_stats()
+            st.caption(
+                f"AI解析キャッシュ: {cache_stats['entries']}件保存 / "
+                f"ヒット {cache_stats['hits']}・ミス {cache_stats['misses']}（{cache_stats['hit_rate']:.0%}）"
             )
-        with right:
-            record_date = st.date_input("日付", datetime.date.today())
+            call_stats = gemini_call_stats()
+            if call_stats:
+                st.caption("Gemini 呼び出し: " + " / ".join(
+                    f"{name} {v['calls']}回" + (f"（失敗 {v['errors']}）" if v["errors"] else "")
+                    + ({"open": "・遮断中", "half_open": "・復旧確認中"}.get(v["breaker"], ""))
+                    for name, v in call_stats.items()
+                ))
+            startup_text = format_startup_report()
+            if startup_text:
+                st.caption(startup_text)
+        if _is_admin():
+            _render_metrics_panel()
+    lap("sidebar")
+
+    # --- Dynamic Header ---
+    if menu == "食事記録":
+        title = "🍽️ 食事記録"
+        subtitle = "日々の食事やサプリ・水分補給をシンプルに記録しましょう。"
+    elif menu == "運動記録":
+        title = "💪 運動記録"
+        subtitle = "日々の運動を記録して、活動の習慣を可視化しましょう。"
+    else: # 相談する
+        title = "💬 AIに相談する"
+        subtitle = "食事と運動の記録を基に、AIがパーソナルなアドバイスをします。"
+
+    st.markdown(
+        f"""
+    <div class="hero">
+      <div class="hero-title">{title}</div>
+      <div class="hero-sub">{subtitle}</div>
+    </div>
+    """,
+        unsafe_allow_html=True,
+    )
+    lap("header")
+
+    # --- Quick glance (today) ---
+    if menu != "相談する": # 相談ページでは非表示
+        sum_today = _sum_today()
+        col1, col2, col3, col4 = st.columns(4)
+        col1.metric("本日のカロリー", f"{int(sum_today['cal'])} kcal")
+        col2.metric("たんぱく質", f"{sum_today['p']:.1f} g")
+        col3.metric("炭水化物", f"{sum_today['c']:.1f} g")
+        col4.metric("脂質", f"{sum_today['f']:.1f} g")
+    lap("quick_glance")
+
+    # =============================
+    # RECORD
+    # =============================
+    if menu == "食事記録":
+        with st.container():
+            st.markdown('<div class="card">', unsafe_allow_html=True)
+            st.subheader("食事の記録")
         
-        if meal_type == "プロテイン":
-            with st.form(key="protein_form", clear_on_submit=True):
-                protein_amount = st.number_input("たんぱく質の量 (g)", min_value=0.0, step=0.1, value=20.0, format="%.1f")
-                if st.form_submit_button("プロテインを記録する", use_container_width=True):
-                    nutrients = { "protein": protein_amount, "calories": protein_amount * 4 } 
-                    add_record(record_date, "プロテイン", f"プロテイン {protein_amount}g", nutrients)
-                    st.success(f"プロテイン {protein_amount}g を記録しました！")
-
-        elif meal_type == "サプリ":
-            with st.form(key="supplement_form", clear_on_submit=True):
-                supplements = {
-                    "マルチビタミン": { "displayName": "マルチビタミン", "foodName": "サプリ: スーパーマルチビタミン&ミネラル", "nutrients": { "calories": 5, "protein": 0.02, "carbohydrates": 0.6, "fat": 0.05, "vitaminD": 10.0, "salt": 0, "zinc": 6.0, "folic_acid": 240, }, },
-                    "葉酸": { "displayName": "葉酸", "foodName": "サプリ: 葉酸", "nutrients": { "calories": 1, "protein": 0, "carbohydrates": 0.23, "fat": 0.004, "vitaminD": 0, "salt": 0, "zinc": 0, "folic_acid": 480, }, },
-                    "ビタミンD": { "displayName": "ビタミンD", "foodName": "サプリ: ビタミンD", "nutrients": { "calories": 1, "protein": 0, "carbohydrates": 0, "fat": 0.12, "vitaminD": 30.0, "salt": 0, "zinc": 0, "folic_acid": 0, }, },
-                    "亜鉛": { "displayName": "亜鉛", "foodName": "サプリ: 亜鉛", "nutrients": { "calories": 1, "protein": 0, "carbohydrates": 0.17, "fat": 0.005, "vitaminD": 0, "salt": 0, "zinc": 14.0, "folic_acid": 0, }, },
-                }
-                selected_sup = st.selectbox("サプリを選択", list(supplements.keys()))
-                if st.form_submit_button("サプリを記録する", use_container_width=True):
-                    sup_data = supplements[selected_sup]
-                    add_record(record_date, "サプリ", sup_data["foodName"], sup_data["nutrients"])
-                    st.success(f"{sup_data['displayName']}を記録しました！")
-
-        elif meal_type == "水分補給":
-            with st.form(key="water_form", clear_on_submit=True):
-                amount_ml = st.number_input("飲んだ量 (ml)", min_value=0, step=50, value=200)
-                if st.form_submit_button("水分補給を記録する", use_container_width=True):
-                    nutrients = { "calories": 0, "protein": 0, "carbohydrates": 0, "fat": 0, "vitaminD": 0, "salt": 0, "zinc": 0, "folic_acid": 0, }
-                    add_record(record_date, "水分補給", f"{amount_ml} ml", nutrients)
-                    st.success(f"水分補給 {amount_ml}ml を記録しました！")
-
-        else: 
-            input_method = st.radio("記録方法", ["栄養素手入力", "フリー記述入力", "画像から入力"], horizontal=True)
-
-            if input_method == "栄養素手入力":
-                favorite_meals_df = get_favorite_meals()
-                favorite_options = {"新規入力": None}
-                for index, row in favorite_meals_df.iterrows():
-                    favorite_options[row['food_name']] = row.to_dict()
-
-                selected_favorite_key = st.selectbox(
-                    "お気に入りから選択",
-                    options=list(favorite_options.keys()),
-                    index=0
+            left, right = st.columns([1, 1])
+            with left:
+                meal_type = st.selectbox(
+                    "記録の種類",
+                    MEAL_TYPES,
+                    index=0,
                 )
+            with right:
+                record_date = st.date_input("日付", datetime.date.today())
+        
+            if meal_type == "プロテイン":
+                with st.form(key="protein_form", clear_on_submit=True):
+                    protein_amount = st.number_input("たんぱく質の量 (g)", min_value=0.0, step=0.1, value=20.0, format="%.1f")
+                    if st.form_submit_button("プロテインを記録する", use_container_width=True):
+                        nutrients = { "protein": protein_amount, "calories": protein_amount * 4 } 
+                        add_record(record_date, "プロテイン", f"プロテイン {protein_amount}g", nutrients)
+                        st.success(f"プロテイン {protein_amount}g を記録しました！")
+
+            elif meal_type == "サプリ":
+                with st.form(key="supplement_form", clear_on_submit=True):
+                    supplements = {
+                        "マルチビタミン": { "displayName": "マルチビタミン", "foodName": "サプリ: スーパーマルチビタミン&ミネラル", "nutrients": { "calories": 5, "protein": 0.02, "carbohydrates": 0.6, "fat": 0.05, "vitaminD": 10.0, "salt": 0, "zinc": 6.0, "folic_acid": 240, }, },
+                        "葉酸": { "displayName": "葉酸", "foodName": "サプリ: 葉酸", "nutrients": { "calories": 1, "protein": 0, "carbohydrates": 0.23, "fat": 0.004, "vitaminD": 0, "salt": 0, "zinc": 0, "folic_acid": 480, }, },
+                        "ビタミンD": { "displayName": "ビタミンD", "foodName": "サプリ: ビタミンD", "nutrients": { "calories": 1, "protein": 0, "carbohydrates": 0, "fat": 0.12, "vitaminD": 30.0, "salt": 0, "zinc": 0, "folic_acid": 0, }, },
+                        "亜鉛": { "displayName": "亜鉛", "foodName": "サプリ: 亜鉛", "nutrients": { "calories": 1, "protein": 0, "carbohydrates": 0.17, "fat": 0.005, "vitaminD": 0, "salt": 0, "zinc": 14.0, "folic_acid": 0, }, },
+                    }
+                    selected_sup = st.selectbox("サプリを選択", list(supplements.keys()))
+                    if st.form_submit_button("サプリを記録する", use_container_width=True):
+                        sup_data = supplements[selected_sup]
+                        add_record(record_date, "サプリ", sup_data["foodName"], sup_data["nutrients"])
+                        st.success(f"{sup_data['displayName']}を記録しました！")
+
+            elif meal_type == "水分補給":
+                with st.form(key="water_form", clear_on_submit=True):
+                    amount_ml = st.number_input("飲んだ量 (ml)", min_value=0, step=50, value=200)
+                    if st.form_submit_button("水分補給を記録する", use_container_width=True):
+                        nutrients = { "calories": 0, "protein": 0, "carbohydrates": 0, "fat": 0, "vitaminD": 0, "salt": 0, "zinc": 0, "folic_acid": 0, }
+                        add_record(record_date, "水分補給", f"{amount_ml} ml", nutrients)
+                        st.success(f"水分補給 {amount_ml}ml を記録しました！")
+
+            else: 
+                input_method = st.radio("記録方法", ["栄養素手入力", "フリー記述入力", "画像から入力"], horizontal=True)
+
+                if input_method == "栄養素手入力":
+                    favorite_meals_df = get_favorite_meals()
+                    favorite_options = {"新規入力": None}
+                    for index, row in favorite_meals_df.iterrows():
+                        favorite_options[row['food_name']] = row.to_dict()
+
+                    selected_favorite_key = st.selectbox(
+                        "お気に入りから選択",
+                        options=list(favorite_options.keys()),
+                        index=0
+                    )
                 
-                selected_favorite_data = favorite_options.get(selected_favorite_key)
-
-                with st.form(key="text_input_form", clear_on_submit=True):
-                    food_name = st.text_input("食事名", value=selected_favorite_data['food_name'] if selected_favorite_data else "", placeholder="例）鮭の塩焼き定食 など")
-                    cols = st.columns(2)
-                    calories = cols[0].number_input("カロリー (kcal)", value=float(selected_favorite_data['calories'] or 0.0) if selected_favorite_data else 0.0, format="%.1f")
-                    protein = cols[1].number_input("たんぱく質 (g)", value=float(selected_favorite_data['protein'] or 0.0) if selected_favorite_data else 0.0, format="%.1f")
-                    carbohydrates = cols[0].number_input("炭水化物 (g)", value=float(selected_favorite_data['carbohydrates'] or 0.0) if selected_favorite_data else 0.0, format="%.1f")
-                    fat = cols[1].number_input("脂質 (g)", value=float(selected_favorite_data['fat'] or 0.0) if selected_favorite_data else 0.0, format="%.1f")
-                    vitamin_d = cols[0].number_input("ビタミンD (μg)", value=float(selected_favorite_data['vitamin_d'] or 0.0) if selected_favorite_data else 0.0, format="%.1f")
-                    salt = cols[1].number_input("食塩相当量 (g)", value=float(selected_favorite_data['salt'] or 0.0) if selected_favorite_data else 0.0, format="%.1f")
-                    zinc = cols[0].number_input("亜鉛 (mg)", value=float(selected_favorite_data['zinc'] or 0.0) if selected_favorite_data else 0.0, format="%.1f")
-
-                    if st.form_submit_button("食事を記録する", use_container_width=True, type="primary"):
-                        if food_name:
-                            nutrients = { "calories": calories, "protein": protein, "carbohydrates": carbohydrates, "fat": fat, "vitaminD": vitamin_d, "salt": salt, "zinc": zinc, }
-                            add_record(record_date, meal_type, food_name, nutrients)
-                            st.success(f"{food_name}を記録しました！")
-                        else:
-                            st.warning("食事名を入力してください。")
+                    selected_favorite_data = favorite_options.get(selected_favorite_key)
+
+                    with st.form(key="text_input_form", clear_on_submit=True):
+                        food_name = st.text_input("食事名", value=selected_favorite_data['food_name'] if selected_favorite_data else "", placeholder="例）鮭の塩焼き定食 など")
+                        cols = st.columns(2)
+                        calories = cols[0].number_input("カロリー (kcal)", value=float(selected_favorite_data['calories'] or 0.0) if selected_favorite_data else 0.0, format="%.1f")
+                        protein = cols[1].number_input("たんぱく質 (g)", value=float(selected_favorite_data['protein'] or 0.0) if selected_favorite_data else 0.0, format="%.1f")
+                        carbohydrates = cols[0].number_input("炭水化物 (g)", value=float(selected_favorite_data['carbohydrates'] or 0.0) if selected_favorite_data else 0.0, format="%.1f")
+                        fat = cols[1].number_input("脂質 (g)", value=float(selected_favorite_data['fat'] or 0.0) if selected_favorite_data else 0.0, format="%.1f")
+                        vitamin_d = cols[0].number_input("ビタミンD (μg)", value=float(selected_favorite_data['vitamin_d'] or 0.0) if selected_favorite_data else 0.0, format="%.1f")
+                        salt = cols[1].number_input("食塩相当量 (g)", value=float(selected_favorite_data['salt'] or 0.0) if selected_favorite_data else 0.0, format="%.1f")
+                        zinc = cols[0].number_input("亜鉛 (mg)", value=float(selected_favorite_data['zinc'] or 0.0) if selected_favorite_data else 0.0, format="%.1f")
+
+                        if st.form_submit_button("食事を記録する", use_container_width=True, type="primary"):
+                            if food_name:
+                                nutrients = { "calories": calories, "protein": protein, "carbohydrates": carbohydrates, "fat": fat, "vitaminD": vitamin_d, "salt": salt, "zinc": zinc, }
+                                add_record(record_date, meal_type, food_name, nutrients)
+                                st.success(f"{food_name}を記録しました！")
+                            else:
+                                st.warning("食事名を入力してください。")
             
-            elif input_method == "フリー記述入力":
-                description = st.text_area("食事の内容を自由に入力してください", placeholder="例：飲み会で、焼き鳥を5本（タレ）、ビールを2杯、枝豆を食べた")
-                if st.button("AIで栄養素を推定する", use_container_width=True):
-                    if description.strip():
-                        with st.spinner("AIが記述内容を分析中です..."):
-                            analysis_result = analyze_text_with_gemini(description)
-                        if analysis_result:
-                            st.session_state.analysis_result = analysis_result
-                            st.session_state.nutrition_chat_history = []
-                        else:
-                            st.error("分析に失敗しました。もう少し具体的に記述してください。")
-                    else:
-                        st.warning("食事の内容を入力してください。")
-
-            elif input_method == "画像から入力":
-                uploaded_file = st.file_uploader("食事の画像をアップロード", type=["jpg", "jpeg", "png"])
-                if uploaded_file is not None:
-                    st.image(uploaded_file, caption="アップロードされた画像", use_column_width=True)
-                    if st.button("画像を分析する", use_container_width=True):
-                        with st.spinner("AIが画像を分析中です..."):
-                            analysis_result = analyze_image_with_gemini(uploaded_file.getvalue())
-                        if analysis_result:
-                            st.session_state.analysis_result = analysis_result
-                            st.session_state.nutrition_chat_history = []
+                elif input_method == "フリー記述入力":
+                    description = st.text_area("食事の内容を自由に入力してください", placeholder="例：飲み会で、焼き鳥を5本（タレ）、ビールを2杯、枝豆を食べた")
+                    use_history = st.checkbox("過去に記録した料理は記録から推定する（AIを使わない）", value=True)
+                    if st.button("AIで栄養素を推定する", use_container_width=True):
+                        if description.strip():
+                            analysis_result = estimate_from_history(description) if use_history else None
+                            if analysis_result:
+                                st.caption("すべて過去の記録にある料理だったため、記録の中央値から推定しました。")
+                                st.session_state.analysis_result = analysis_result
+                                st.session_state.nutrition_chat_history = []
+                            else:
+                                _start_analysis_job(submit_text_analysis, description)
                         else:
-                            st.error("分析に失敗しました。テキストで入力してください。")
+                            st.warning("食事の内容を入力してください。")
+
+                elif input_method == "画像から入力":
+                    uploaded_files = st.file_uploader(
+                        f"食事の画像をアップロード（{IMAGE_BATCH_MAX_FILES}枚まで。複数枚ならまとめて分析します）",
+                        type=["jpg", "jpeg", "png"],
+                        accept_multiple_files=True,
+                    )
+                    if len(uploaded_files) > IMAGE_BATCH_MAX_FILES:
+                        st.warning(f"一度に分析できるのは{IMAGE_BATCH_MAX_FILES}枚までです。先頭の{IMAGE_BATCH_MAX_FILES}枚を使います。")
+                    if len(uploaded_files) == 1:
+                        uploaded_file = uploaded_files[0]
+                        st.image(uploaded_file, caption="アップロードされた画像", use_column_width=True)
+                        if st.button("画像を分析する", use_container_width=True):
+                            prepared_image, prep_stats = preprocess_image(uploaded_file.getvalue())
+                            st.caption(_format_preprocess_stats(prep_stats))
+                            st.session_state.pop("analysis_batch", None)
+                            _start_analysis_job(submit_image_analysis, prepared_image)
+                    elif uploaded_files:
+                        st.image(uploaded_files[:IMAGE_BATCH_MAX_FILES], caption=[f.name for f in uploaded_files[:IMAGE_BATCH_MAX_FILES]], width=160)
+                        if st.button(f"{min(len(uploaded_files), IMAGE_BATCH_MAX_FILES)}枚の画像をまとめて分析する", use_container_width=True):
+                            st.session_state.pop("analysis_job_id", None)
+                            _start_photo_batch(uploaded_files)
+                    if st.session_state.get("analysis_batch"):
+                        _render_photo_batch(record_date, meal_type)
+
+                if input_method in ["フリー記述入力", "画像から入力"]:
+                    if _poll_analysis_job() is not None:
+                        _analysis_job_status()
+                    if "analysis_job_error" in st.session_state:
+                        st.error(f"分析に失敗しました: {st.session_state.pop('analysis_job_error')}")
             
-            if input_method in ["フリー記述入力", "画像から入力"] and "analysis_result" in st.session_state:
-                st.info("AIの推定結果です。内容を確認し、必要に応じて修正してください。")
-                result = st.session_state.analysis_result
+                if input_method in ["フリー記述入力", "画像から入力"] and "analysis_result" in st.session_state:
+                    st.info("AIの推定結果です。内容を確認し、必要に応じて修正してください。")
+                    result = st.session_state.analysis_result
+                    if result.get("truncated"):
+                        st.warning("AIの応答が途中で切れていたため、一部の料理が欠けている可能性があります。足りなければもう一度分析してください。")
                 
-                if "nutrition_chat_history" in st.session_state:
-                    for msg in st.session_state.nutrition_chat_history:
-                        with st.chat_message(msg["role"]):
-                            st.markdown(msg["content"])
+                    if "nutrition_chat_history" in st.session_state:
+                        for msg in st.session_state.nutrition_chat_history:
+                            with st.chat_message(msg["role"]):
+                                st.markdown(msg["content"])
                 
-                st.markdown("##### AIによる現在の推定内訳")
-                dishes_df = pd.DataFrame(result.get("dishes", []))
-                if not dishes_df.empty:
-                    nutrients_df = pd.json_normalize(dishes_df['nutrients'])
-                    display_dishes = pd.concat([dishes_df[['name', 'rationale']], nutrients_df], axis=1)
-                    st.dataframe(display_dishes.rename(columns={
-                        "name": "料理名", "rationale": "推定根拠", "calories": "cal", "protein": "P",
-                        "carbohydrates": "C", "fat": "F", "vitaminD": "VitD", "salt": "塩分", "zinc": "亜鉛"
-                    }), use_container_width=True)
+                    st.markdown("##### AIによる現在の推定内訳")
+                    dishes_df = pd.DataFrame(result.get("dishes", []))
+                    if not dishes_df.empty:
+                        nutrients_df = pd.json_normalize(dishes_df['nutrients'])
+                        display_dishes = pd.concat([dishes_df[['name', 'rationale']], nutrients_df], axis=1)
+                        st.dataframe(display_dishes.rename(columns={
+                            "name": "料理名", "rationale": "推定根拠", "calories": "cal", "protein": "P",
+                            "carbohydrates": "C", "fat": "F", "vitaminD": "VitD", "salt": "塩分", "zinc": "亜鉛"
+                        }), use_container_width=True)
                 
-                st.divider()
-                st.markdown("##### この内容で登録しますか？")
+                    st.divider()
+                    st.markdown("##### この内容で登録しますか？")
                 
-                col1, col2, col_spacer = st.columns([1,2,2])
-                if col1.button("はい、この内容で記録する", type="primary"):
-                    dishes = result.get("dishes", [])
-                    if not dishes:
-                        st.warning("記録する料理がありません。")
-                    else:
-                        recorded_dishes = []
-                        with st.spinner("記録中..."):
-                            for dish in dishes:
-                                add_record(record_date, meal_type, dish.get("name"), dish.get("nutrients", {}))
-                                recorded_dishes.append(dish.get("name"))
-                        st.success(f"{len(recorded_dishes)}件の料理を記録しました: {', '.join(recorded_dishes)}")
+                    col1, col2, col_spacer = st.columns([1,2,2])
+                    if col1.button("はい、この内容で記録する", type="primary"):
+                        dishes = result.get("dishes", [])
+                        if not dishes:
+                            st.warning("記録する料理がありません。")
+                        else:
+                            recorded_dishes = [dish.get("name") for dish in dishes]
+                            with st.spinner("記録中..."):
+                                add_records([(record_date, meal_type, dish.get("name"), dish.get("nutrients", {})) for dish in dishes])
+                            st.success(f"{len(recorded_dishes)}件の料理を記録しました: {', '.join(recorded_dishes)}")
                         
-                        for key in list(st.session_state.keys()):
-                            if key.startswith('analysis_') or key.startswith('nutrition_'):
-                                del st.session_state[key]
-                        st.rerun()
-
-                if col2.button("修正を希望する"):
-                    st.session_state.show_nutrition_correction = True
+                            for key in list(st.session_state.keys()):
+                                if key.startswith('analysis_') or key.startswith('nutrition_'):
+                                    del st.session_state[key]
+                            st.rerun()
 
-                if st.session_state.get("show_nutrition_correction"):
-                    correction_text = st.text_area("修正点を自由に入力してください", placeholder="例：焼き鳥は5本じゃなくて3本です。あと、ビールは飲んでいません。", key="nut_correction_text")
-                    if st.button("AIに修正を依頼する"):
-                        if correction_text.strip():
-                            st.session_state.nutrition_chat_history.append({"role": "user", "content": correction_text})
-                            with st.spinner("AIが修正案を作成中です..."):
-                                new_proposal = refine_nutrition_with_ai(st.session_state.nutrition_chat_history, result)
+                    if col2.button("修正を希望する"):
+                        st.session_state.show_nutrition_correction = True
+
+                    if st.session_state.get("show_nutrition_correction"):
+                        correction_text = st.text_area("修正点を自由に入力してください", placeholder="例：焼き鳥は5本じゃなくて3本です。あと、ビールは飲んでいません。", key="nut_correction_text")
+                        if st.button("AIに修正を依頼する"):
+                            if correction_text.strip():
+                                st.session_state.nutrition_chat_history.append({"role": "user", "content": correction_text})
+                                # 量の按分だけなら AI を呼ばずに反映する
+                                new_proposal = apply_local_portion_adjustment(correction_text, result)
+                                if new_proposal is None:
+                                    with st.spinner("AIが修正案を作成中です..."):
+                                        new_proposal = refine_nutrition_with_ai(st.session_state.nutrition_chat_history, result)
                             
-                            if new_proposal:
-                                st.session_state.nutrition_chat_history.append({"role": "assistant", "content": new_proposal["response_text"]})
-                                st.session_state.analysis_result = new_proposal["updated_data"]
-                                st.session_state.show_nutrition_correction = False
-                                st.rerun()
+                                if new_proposal:
+                                    st.session_state.nutrition_chat_history.append({"role": "assistant", "content": new_proposal["response_text"]})
+                                    st.session_state.analysis_result = new_proposal["updated_data"]
+                                    st.session_state.show_nutrition_correction = False
+                                    st.rerun()
+                                else:
+                                    st.error("修正案の作成に失敗しました。")
                             else:
-                                st.error("修正案の作成に失敗しました。")
-                        else:
-                            st.warning("修正内容を入力してください。")
-
-        st.markdown('</div>', unsafe_allow_html=True)
-
-    # ---- List ----
-    with st.container():
-        st.markdown('<div class="card">', unsafe_allow_html=True)
-        st.subheader("食事記録一覧")
-        all_records_df = get_all_records()
-        if all_records_df.empty:
-            st.info("まだ記録がありません。")
-        else:
-            # ★修正点: 削除列を追加
-            display_df = all_records_df.copy()
-            display_df['is_favorite'] = display_df['is_favorite'].astype(bool)
-            display_df["削除"] = False
-            
-            # ★修正点: 列の順番を指定し、削除列のconfigを追加
-            edited_df = st.data_editor(
-                display_df,
-                column_order=("date", "meal_type", "food_name", "is_favorite", "削除", "calories", "protein", "carbohydrates", "fat"),
-                column_config={
-                    "id": None,
-                    "date": "日付",
-                    "meal_type": "種類",
-                    "food_name": "内容",
-                    "calories": st.column_config.NumberColumn("カロリー", format="%d kcal"),
-                    "protein": st.column_config.NumberColumn("P(g)", format="%.1f"),
-                    "carbohydrates": st.column_config.NumberColumn("C(g)", format="%.1f"),
-                    "fat": st.column_config.NumberColumn("F(g)", format="%.1f"),
-                    "vitamin_d": None, "salt": None, "zinc": None, "folic_acid": None,
-                    "is_favorite": st.column_config.CheckboxColumn("プルダウン登録", width="small"),
-                    "削除": st.column_config.CheckboxColumn("削除？", width="small"),
-                },
-                use_container_width=True,
-                hide_index=True,
-                key="data_editor",
-            )
+                                st.warning("修正内容を入力してください。")
+
+            st.markdown('</div>', unsafe_allow_html=True)
+
+        # ---- List ----
+        with st.container():
+            st.markdown('<div class="card">', unsafe_allow_html=True)
+            st.subheader("食事記録一覧")
+            f_from, f_to, f_types, f_size = st.columns([1, 1, 2, 1])
+            list_from = f_from.date_input("開始日", value=None, key="meal_list_from")
+            list_to = f_to.date_input("終了日", value=None, key="meal_list_to")
+            list_types = f_types.multiselect("種類", MEAL_TYPES, key="meal_list_types")
+            list_size = f_size.selectbox("表示件数", PAGE_SIZE_OPTIONS, index=1, key="meal_list_size")
+
+            cursor, page_no = _page_cursor("meal_list", (list_from, list_to, tuple(list_types), list_size))
+            page_df, next_cursor = get_records_page(list_size, cursor, list_from, list_to, list_types)
+            if page_df.empty and page_no == 1:
+                st.info("まだ記録がありません。" if not (list_from or list_to or list_types) else "条件に一致する記録がありません。")
+            else:
+                display_df = _meal_editor_frame(page_df)
+
+                # ★修正点: 列の順番を指定し、削除列のconfigを追加
+                edited_df = st.data_editor(
+                    display_df,
+                    column_order=("date", "meal_type", "food_name", "is_favorite", "削除", "calories", "protein", "carbohydrates", "fat"),
+                    column_config={
+                        "id": None,
+                        "date": "日付",
+                        "meal_type": "種類",
+                        "food_name": "内容",
+                        "calories": st.column_config.NumberColumn("カロリー", format="%d kcal"),
+                        "protein": st.column_config.NumberColumn("P(g)", format="%.1f"),
+                        "carbohydrates": st.column_config.NumberColumn("C(g)", format="%.1f"),
+                        "fat": st.column_config.NumberColumn("F(g)", format="%.1f"),
+                        "vitamin_d": None, "salt": None, "zinc": None, "folic_acid": None,
+                        "is_favorite": st.column_config.CheckboxColumn("プルダウン登録", width="small"),
+                        "削除": st.column_config.CheckboxColumn("削除？", width="small"),
+                    },
+                    use_container_width=True,
+                    hide_index=True,
+                    key=f"data_editor_{page_no}_{cursor}",
+                )
+                _page_nav("meal_list", next_cursor, len(page_df))
             
-            # 変更を検出してDBに保存
-            if not edited_df.equals(all_records_df):
-                # is_favoriteの変更を検出
-                fav_diff = edited_df[edited_df['is_favorite'] != all_records_df['is_favorite']]
-                if not fav_diff.empty:
-                    for index, row in fav_diff.iterrows():
-                        update_favorite_status(row['id'], row['is_favorite'])
-                    st.success("お気に入り設定を更新しました。")
-                    st.rerun()
-
-            # 削除がチェックされた行を処理
-            if edited_df["削除"].any():
-                btn_col1, btn_col2 = st.columns([1, 3])
-                with btn_col1:
-                    if st.container().button("選択した記録を削除", type="primary", use_container_width=True):
-                        ids_to_delete = edited_df[edited_df["削除"]]["id"]
-                        for rid in ids_to_delete:
-                            delete_record(int(rid))
-                        st.success("選択した記録を削除しました。")
+                # 変更を検出してDBに保存
+                if not edited_df.equals(page_df):
+                    # is_favoriteの変更を検出
+                    fav_diff = edited_df[edited_df['is_favorite'] != page_df['is_favorite']]
+                    if not fav_diff.empty:
+                        update_favorite_statuses(
+                            fav_diff.loc[fav_diff['is_favorite'], 'id'],
+                            fav_diff.loc[~fav_diff['is_favorite'], 'id'],
+                        )
+                        st.success("お気に入り設定を更新しました。")
                         st.rerun()
 
-        st.markdown('</div>', unsafe_allow_html=True)
+                # 削除がチェックされた行を処理
+                if edited_df["削除"].any():
+                    btn_col1, btn_col2 = st.columns([1, 3])
+                    with btn_col1:
+                        if st.container().button("選択した記録を削除", type="primary", use_container_width=True):
+                            delete_records(edited_df.loc[edited_df["削除"], "id"])
+                            st.success("選択した記録を削除しました。")
+                            st.rerun()
 
-elif menu == "運動記録":
-    with st.container():
-        st.markdown('<div class="card">', unsafe_allow_html=True)
-        st.subheader("運動の記録")
-        st.caption("日々の運動を記録して、活動量を管理しましょう。")
-        
-        default_exercises = ["ヨガ", "エアロビクス", "Group Centergy"]
-        try:
-            past_exercises = get_unique_exercise_names()
-            exercise_options = sorted(list(set(default_exercises + past_exercises)))
-        except Exception:
-            exercise_options = default_exercises
-        exercise_options.append("その他（自由入力）")
+            st.markdown('</div>', unsafe_allow_html=True)
 
-        selected_exercise = st.selectbox(
-            "運動メニュー",
-            exercise_options
-        )
+    elif menu == "運動記録":
+        with st.container():
+            st.markdown('<div class="card">', unsafe_allow_html=True)
+            st.subheader("運動の記録")
+            st.caption("日々の運動を記録して、活動量を管理しましょう。")
+        
+            default_exercises = ["ヨガ", "エアロビクス", "Group Centergy"]
+            try:
+                past_exercises = get_unique_exercise_names()
+                exercise_options = sorted(list(set(default_exercises + past_exercises)))
+            except Exception:
+                exercise_options = default_exercises
+            exercise_options.append("その他（自由入力）")
+
+            selected_exercise = st.selectbox(
+                "運動メニュー",
+                exercise_options
+            )
 
-        if selected_exercise != "その他（自由入力）":
-            with st.form(key="exercise_form_select", clear_on_submit=True):
-                duration = st.number_input("運動時間（分）", min_value=0, value=60, step=5)
+            if selected_exercise != "その他（自由入力）":
+                with st.form(key="exercise_form_select", clear_on_submit=True):
+                    duration = st.number_input("運動時間（分）", min_value=0, value=60, step=5)
+                    record_date_ex = st.date_input("日付", datetime.date.today())
+                    if st.form_submit_button("運動を記録する", use_container_width=True, type="primary"):
+                        if duration > 0:
+                            add_exercise_record(record_date_ex, selected_exercise, duration)
+                            st.success(f"{selected_exercise} ({duration}分) を記録しました！")
+                        else:
+                            st.warning("運動時間を入力してください。")
+            else:
+                st.info("実施した運動内容と時間を自由に入力してください。AIが内容を整理します。")
+                free_text_exercise = st.text_area("運動内容と時間", placeholder="例：ジムで筋トレを60分、そのあとランニングを30分")
                 record_date_ex = st.date_input("日付", datetime.date.today())
-                if st.form_submit_button("運動を記録する", use_container_width=True, type="primary"):
-                    if duration > 0:
-                        add_exercise_record(record_date_ex, selected_exercise, duration)
-                        st.success(f"{selected_exercise} ({duration}分) を記録しました！")
-                    else:
-                        st.warning("運動時間を入力してください。")
-        else:
-            st.info("実施した運動内容と時間を自由に入力してください。AIが内容を整理します。")
-            free_text_exercise = st.text_area("運動内容と時間", placeholder="例：ジムで筋トレを60分、そのあとランニングを30分")
-            record_date_ex = st.date_input("日付", datetime.date.today())
             
-            if st.button("内容を整理して確認", use_container_width=True):
-                if free_text_exercise.strip():
-                    with st.spinner("AIが内容を解析中..."):
-                        parsed_exercise = parse_exercise_from_text(free_text_exercise)
-                    if parsed_exercise:
-                        st.session_state.exercise_proposal = parsed_exercise
-                        st.session_state.record_date_ex = record_date_ex # 日付を保存
-                    else:
-                        st.error("内容を解析できませんでした。もう少し具体的に記述してください。")
-                else:
-                    st.warning("運動内容を入力してください。")
-
-            if "exercise_proposal" in st.session_state:
-                proposal = st.session_state.exercise_proposal
-                st.write("---")
-                st.write(f"AIは以下の内容と解釈しました。この内容で記録しますか？")
-                st.markdown(f"**運動内容:** `{proposal['name']}`")
-                st.markdown(f"**運動時間:** `{proposal['duration']}` 分")
-
-                col1, col2, col_spacer = st.columns([1,1,2])
-                if col1.button("はい、この内容で記録する", type="primary"):
-                    record_date_to_save = st.session_state.get('record_date_ex', datetime.date.today())
-                    add_exercise_record(record_date_to_save, proposal['name'], proposal['duration'])
-                    st.success(f"{proposal['name']} ({proposal['duration']}分) を記録しました！")
-                    # セッションステートをクリーンアップ
-                    for key in list(st.session_state.keys()):
-                        if key.startswith('exercise_') or key == 'record_date_ex':
-                            del st.session_state[key]
-                    st.rerun()
-
-                if col2.button("修正する"):
-                    st.session_state.show_exercise_correction = True
-                
-                if st.session_state.get("show_exercise_correction"):
-                    correction_text = st.text_area("修正点を入力してください", placeholder="時間を90分に変更して", key="ex_correction_text")
-                    if st.button("修正を反映"):
-                        with st.spinner("AIが修正案を作成中..."):
-                            new_proposal = correct_exercise_from_text(proposal, correction_text)
-                        if new_proposal:
-                            st.session_state.exercise_proposal = new_proposal
-                            st.session_state.show_exercise_correction = False
-                            st.rerun()
+                if st.button("内容を整理して確認", use_container_width=True):
+                    if free_text_exercise.strip():
+                        try:
+                            with st.spinner("AIが内容を解析中..."):
+                                parsed_exercise = parse_exercise_from_text(free_text_exercise)
+                        except GeminiUnavailableError as e:
+                            st.warning(str(e))
                         else:
-                            st.error("修正内容を解析できませんでした。")
+                            if parsed_exercise:
+                                st.session_state.exercise_proposal = parsed_exercise
+                                st.session_state.record_date_ex = record_date_ex # 日付を保存
+                            else:
+                                st.error("内容を解析できませんでした。もう少し具体的に記述してください。")
+                    else:
+                        st.warning("運動内容を入力してください。")
+
+                if "exercise_proposal" in st.session_state:
+                    proposal = st.session_state.exercise_proposal
+                    st.write("---")
+                    st.write(f"AIは以下の内容と解釈しました。この内容で記録しますか？")
+                    st.markdown(f"**運動内容:** `{proposal['name']}`")
+                    st.markdown(f"**運動時間:** `{proposal['duration']}` 分")
+
+                    col1, col2, col_spacer = st.columns([1,1,2])
+                    if col1.button("はい、この内容で記録する", type="primary"):
+                        record_date_to_save = st.session_state.get('record_date_ex', datetime.date.today())
+                        add_exercise_record(record_date_to_save, proposal['name'], proposal['duration'])
+                        st.success(f"{proposal['name']} ({proposal['duration']}分) を記録しました！")
+                        # セッションステートをクリーンアップ
+                        for key in list(st.session_state.keys()):
+                            if key.startswith('exercise_') or key == 'record_date_ex':
+                                del st.session_state[key]
+                        st.rerun()
 
-        st.markdown('</div>', unsafe_allow_html=True)
+                    if col2.button("修正する"):
+                        st.session_state.show_exercise_correction = True
+                
+                    if st.session_state.get("show_exercise_correction"):
+                        correction_text = st.text_area("修正点を入力してください", placeholder="時間を90分に変更して", key="ex_correction_text")
+                        if st.button("修正を反映"):
+                            try:
+                                with st.spinner("AIが修正案を作成中..."):
+                                    new_proposal = correct_exercise_from_text(proposal, correction_text)
+                            except GeminiUnavailableError as e:
+                                st.warning(str(e))
+                            else:
+                                if new_proposal:
+                                    st.session_state.exercise_proposal = new_proposal
+                                    st.session_state.show_exercise_correction = False
+                                    st.rerun()
+                                else:
+                                    st.error("修正内容を解析できませんでした。")
+
+            st.markdown('</div>', unsafe_allow_html=True)
         
-    with st.container():
-        st.markdown('<div class="card">', unsafe_allow_html=True)
-        st.subheader("運動記録一覧")
-        all_exercise_df = get_all_exercise_records()
-        if all_exercise_df.empty:
-            st.info("まだ運動の記録がありません。")
-        else:
-            display_ex_df = all_exercise_df.copy()
-            display_ex_df["削除"] = [False] * len(display_ex_df)
+        with st.container():
+            st.markdown('<div class="card">', unsafe_allow_html=True)
+            st.subheader("運動記録一覧")
+            f_from, f_to, f_size = st.columns([1, 1, 1])
+            ex_list_from = f_from.date_input("開始日", value=None, key="ex_list_from")
+            ex_list_to = f_to.date_input("終了日", value=None, key="ex_list_to")
+            ex_list_size = f_size.selectbox("表示件数", PAGE_SIZE_OPTIONS, index=1, key="ex_list_size")
+
+            ex_cursor, ex_page_no = _page_cursor("ex_list", (ex_list_from, ex_list_to, ex_list_size))
+            page_ex_df, ex_next_cursor = get_exercise_records_page(ex_list_size, ex_cursor, ex_list_from, ex_list_to)
+            if page_ex_df.empty and ex_page_no == 1:
+                st.info("まだ運動の記録がありません。" if not (ex_list_from or ex_list_to) else "条件に一致する記録がありません。")
+            else:
+                display_ex_df = page_ex_df.copy()
+                display_ex_df["削除"] = [False] * len(display_ex_df)
             
-            edited_ex_df = st.data_editor(
-                display_ex_df[["date", "exercise_name", "duration_minutes", "削除"]],
-                column_config={
-                    "date": "日付",
-                    "exercise_name": "運動内容",
-                    "duration_minutes": "時間(分)",
-                    "削除": st.column_config.CheckboxColumn("削除？"),
-                },
-                use_container_width=True,
-                hide_index=True,
-                key="ex_data_editor",
-            )
-
-            if edited_ex_df["削除"].any():
-                btn_col1, btn_col2 = st.columns([1, 3])
-                with btn_col1:
-                    if st.container().button("選択した記録を削除", type="primary", use_container_width=True, key="delete_ex"):
-                        ids_to_delete = edited_ex_df[edited_ex_df["削除"]].index
-                        original_ids = all_exercise_df.loc[ids_to_delete, "id"]
-                        for rid in original_ids:
-                            delete_exercise_record(int(rid))
-                        st.success("選択した記録を削除しました。")
-                        st.rerun()
-        st.markdown('</div>', unsafe_allow_html=True)
+                edited_ex_df = st.data_editor(
+                    display_ex_df[["date", "exercise_name", "duration_minutes", "削除"]],
+                    column_config={
+                        "date": "日付",
+                        "exercise_name": "運動内容",
+                        "duration_minutes": "時間(分)",
+                        "削除": st.column_config.CheckboxColumn("削除？"),
+                    },
+                    use_container_width=True,
+                    hide_index=True,
+                    key=f"ex_data_editor_{ex_page_no}_{ex_cursor}",
+                )
+                _page_nav("ex_list", ex_next_cursor, len(page_ex_df))
+
+                if edited_ex_df["削除"].any():
+                    btn_col1, btn_col2 = st.columns([1, 3])
+                    with btn_col1:
+                        if st.container().button("選択した記録を削除", type="primary", use_container_width=True, key="delete_ex"):
+                            ids_to_delete = edited_ex_df[edited_ex_df["削除"]].index
+                            delete_exercise_records(page_ex_df.loc[ids_to_delete, "id"])
+                            st.success("選択した記録を削除しました。")
+                            st.rerun()
+            st.markdown('</div>', unsafe_allow_html=True)
 
-# =============================
-# ADVICE
-# =============================
-elif menu == "相談する":
-    with st.container():
-        st.markdown('<div class="card">', unsafe_allow_html=True)
-        st.subheader("AIに相談する")
+    # =============================
+    # ADVICE
+    # =============================
+    elif menu == "相談する":
+        with st.container():
+            st.markdown('<div class="card">', unsafe_allow_html=True)
+            st.subheader("AIに相談する")
 
-        all_records_df = get_all_records()
-        all_exercise_df = get_all_exercise_records()
+            all_records_df = get_all_records()
+            all_exercise_df = get_all_exercise_records()
 
-        if all_records_df.empty and all_exercise_df.empty:
-            st.warning("アドバイスには最低1件の記録が必要です。まずは食事か運動を記録してみましょう。")
-            st.stop()
+            if all_records_df.empty and all_exercise_df.empty:
+                st.warning("アドバイスには最低1件の記録が必要です。まずは食事か運動を記録してみましょう。")
+                st.stop()
 
-        user_profile = (
-            """
+            user_profile = (
+                """
             - 年齢: 35歳女性
             - 身長: 153cm
             - 体重: 50kg
@@ -1172,8 +3892,8 @@ elif menu == "相談する":
             - 苦手な食べ物: 生のトマト、納豆
             - 運動補足: Group Centergyはヨガやピラティスをベースにした下半身の筋力強化に効果的なプログラム。
             """
-        )
-        prompt_qna = f"""
+            )
+            prompt_qna = f"""
 あなたは経験豊富な食生活と運動のパーソナルアドバイザーです。ユーザーの問いに対してのみ簡潔に回答してください。
 出力ルール:
 - 挨拶・導入・締めの定型文は不要
@@ -1184,7 +3904,7 @@ elif menu == "相談する":
 参考情報（出力に含めない）:
 {user_profile}
 """
-        prompt_full = f"""
+            prompt_full = f"""
 あなたは経験豊富な食生活と運動のパーソナルアドバイザーです。以下のユーザー情報と記録に基づき、**包括的な分析レポート**を日本語で作成してください。
 出力はMarkdownで、次の構成を必ず含めてください:
 ## 概要
@@ -1200,73 +3920,114 @@ elif menu == "相談する":
 {user_profile}
 """
 
-        prompt_to_send = ""
+            prompt_to_send = ""
 
-        tab1, tab2, tab3 = st.tabs(["✍️ テキストで相談", "📊 全記録から分析", "🗓️ 期間で分析"])
+            tab1, tab2, tab3, tab4 = st.tabs(["✍️ テキストで相談", "📊 全記録から分析", "🗓️ 期間で分析", "🔎 記録に質問"])
 
-        with tab1:
-            question = st.text_area("相談内容を入力してください", height=150, placeholder="例：最近疲れやすいのですが、食事や運動で改善できますか？")
-            if st.button("AIに相談する", key="text_consult"):
-                if question:
-                    record_history = all_records_df.head(30).to_string(index=False)
-                    exercise_history = all_exercise_df.head(15).to_string(index=False)
-                    prompt_to_send = f"""{prompt_qna}# 食事記録（参考）
-{record_history}
-# 運動記録（参考）
-{exercise_history}
+            with tab1:
+                question = st.text_area("相談内容を入力してください", height=150, placeholder="例：最近疲れやすいのですが、食事や運動で改善できますか？")
+                if st.button("AIに相談する", key="text_consult"):
+                    if question:
+                        context_text, context_report = build_advice_context(
+                            all_records_df, all_exercise_df, ADVICE_QNA_TOKEN_BUDGET
+                        )
+                        prompt_to_send = f"""{prompt_qna}# 記録の要約（参考）
+{context_text}
 
 # 相談内容
 {question}
 
 上記相談内容に対して、記録を参考にしつつ回答してください。
 """
-                else:
-                    st.warning("相談内容を入力してください。")
-
-        with tab2:
-            st.info("今までの全ての記録を総合的に分析し、アドバイスをします。")
-            if st.button("アドバイスをもらう", key="all_consult"):
-                record_history = all_records_df.to_string(index=False)
-                exercise_history = all_exercise_df.to_string(index=False)
-                prompt_to_send = f"""{prompt_full}# 全ての食事記録
-{record_history}
-# 全ての運動記録
-{exercise_history}
+                    else:
+                        st.warning("相談内容を入力してください。")
+
+            with tab2:
+                st.info("今までの全ての記録を総合的に分析し、アドバイスをします。")
+                if st.button("アドバイスをもらう", key="all_consult"):
+                    all_dates = pd.concat([all_records_df["date"], all_exercise_df["date"]])
+                    daily_df = get_daily_totals(
+                        datetime.date.fromisoformat(all_dates.min()), datetime.date.fromisoformat(all_dates.max())
+                    )
+                    context_text, context_report = build_advice_context(
+                        all_records_df, all_exercise_df, ADVICE_CONTEXT_TOKEN_BUDGET, daily_df=daily_df
+                    )
+                    prompt_to_send = f"""{prompt_full}# 全記録の要約（集計・特徴的な日・直近の記録）
+{context_text}
 
 記録データに即した網羅的な分析レポートを出力してください。
 """
 
-        with tab3:
-            today = datetime.date.today()
-            one_week_ago = today - datetime.timedelta(days=7)
-            cols = st.columns(2)
-            start_date = cols[0].date_input("開始日", one_week_ago)
-            end_date = cols[1].date_input("終了日", today)
-            if st.button("指定期間のアドバイスをもらう", key="period_consult"):
-                if start_date > end_date:
-                    st.error("終了日は開始日以降に設定してください。")
-                else:
-                    period_records_df = get_records_by_period(start_date, end_date)
-                    period_exercise_df = get_all_exercise_records() # Simple filter for now
-                    period_exercise_df['date'] = pd.to_datetime(period_exercise_df['date'])
-                    period_exercise_df = period_exercise_df[(period_exercise_df['date'] >= pd.to_datetime(start_date)) & (period_exercise_df['date'] <= pd.to_datetime(end_date))]
-                    
-                    if period_records_df.empty and period_exercise_df.empty:
-                        st.warning("指定された期間に記録がありません。")
+            with tab3:
+                today = datetime.date.today()
+                one_week_ago = today - datetime.timedelta(days=7)
+                cols = st.columns(2)
+                start_date = cols[0].date_input("開始日", one_week_ago)
+                end_date = cols[1].date_input("終了日", today)
+                if st.button("指定期間のアドバイスをもらう", key="period_consult"):
+                    if start_date > end_date:
+                        st.error("終了日は開始日以降に設定してください。")
                     else:
-                        record_history = period_records_df.to_string(index=False)
-                        exercise_history = period_exercise_df.to_string(index=False)
-                        prompt_to_send = f"""{prompt_full}# 食事記録 ({start_date} ~ {end_date})
-{record_history}
-# 運動記録 ({start_date} ~ {end_date})
-{exercise_history}
+                        period_records_df = get_records_by_period(start_date, end_date)
+                        period_exercise_df = get_exercise_records_by_period(start_date, end_date)
+                    
+                        if period_records_df.empty and period_exercise_df.empty:
+                            st.warning("指定された期間に記録がありません。")
+                        else:
+                            context_text, context_report = build_advice_context(
+                                period_records_df,
+                                period_exercise_df,
+                                ADVICE_CONTEXT_TOKEN_BUDGET,
+                                daily_df=get_daily_totals(start_date, end_date),
+                            )
+                            prompt_to_send = f"""{prompt_full}# 記録の要約 ({start_date} ~ {end_date})
+{context_text}
 
 上記の指定期間の記録を評価し、アドバイスをしてください。
 """
 
-        if prompt_to_send:
-            with st.spinner("AIがアドバイスを生成中です..."):
-                advice = get_advice_from_gemini(prompt_to_send)
+            with tab4:
+                st.info("食事記録について自然な文章で質問すると、集計して表で答えます（例：今日のたんぱく質は？ / 先週の夕食でカロリーが高かった順に5件）。")
+                nl_question = st.text_input("質問", key="nl_query_question", placeholder="例：今日のたんぱく質は？")
+                if st.button("集計する", key="nl_query"):
+                    if nl_question.strip():
+                        plan_started = time.perf_counter()
+                        plan, plan_from_cache = plan_question(nl_question)
+                        if not plan:
+                            st.error("質問を集計条件に変換できませんでした。言い回しを変えてお試しください。")
+                        else:
+                            result_df, result_summary = _execute_plan(get_analytics_frame(), plan)
+                            st.markdown(f"**{result_summary}**")
+                            if not result_df.empty:
+                                st.dataframe(result_df, use_container_width=True, hide_index=True)
+                            st.caption(
+                                ("保存済みの集計条件を使いました（AI呼び出しなし）" if plan_from_cache else "AIで集計条件を作成しました")
+                                + f" / {(time.perf_counter() - plan_started) * 1000:.0f}ms"
+                            )
+                            with st.expander("集計条件（JSON）"):
+                                st.json(plan)
+                    else:
+                        st.warning("質問を入力してください。")
+
+            if prompt_to_send:
+                st.caption(
+                    f"プロンプト: 約{estimate_tokens(prompt_to_send):,}トークン（{len(prompt_to_send):,}文字、"
+                    f"記録部分の予算 {context_report['token_budget']:,}トークン）"
+                )
+                advice_timings = {}
                 with st.chat_message("ai", avatar="💬"):
-                    st.markdown(advice)
-        st.markdown('</div>', unsafe_allow_html=True)
+                    st.write_stream(stream_advice_from_gemini(prompt_to_send, advice_timings))
+                # 体感待ち時間（最初の文字が出るまで）と全体時間をセッション内に残す
+                st.session_state.setdefault(
+                    "advice_latency_history", deque(maxlen=ADVICE_LATENCY_HISTORY_MAX)
+                ).append(advice_timings)
+                if advice_timings.get("ttft_s") is not None:
+                    st.caption(f"最初の表示まで {advice_timings['ttft_s']:.1f}秒 / 全体 {advice_timings['total_s']:.1f}秒")
+            st.markdown('</div>', unsafe_allow_html=True)
+    lap(f"page.{menu}")
+
+
+_MODULE_S = time.perf_counter() - _MODULE_STARTED
+
+if __name__ == "__main__":
+    main()
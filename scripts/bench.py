@@ -0,0 +1,293 @@
+"""DB・集計のホットパスを合成データで計測し、結果を JSON で書き出す。
+
+    python scripts/bench.py                          # 1k / 100k / 1M 行
+    python scripts/bench.py --sizes 1k,100k --repeat 3 --out bench_results.json
+    python scripts/bench.py --sizes 1k --compare bench_results.json
+
+サイズごとに別プロセスで app.py を読み込むので、キャッシュや接続プールは毎回まっさらな状態から
+計測される。Gemini はスタブに差し替えており、ネットワークには一切出ない（呼ばれたら失敗する）。
+合成DBは --workdir に保存して再利用する（seed と行数が同じなら作り直さない）。
+
+計測値はミリ秒。cold はキャッシュを消してからの呼び出し、warm はキャッシュが効いた状態の呼び出し。
+"""
+
+import argparse
+import datetime
+import importlib
+import json
+import os
+import platform
+import re
+import statistics
+import subprocess
+import sys
+import time
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import synth_data  # noqa: E402
+
+DEFAULT_SIZES = "1k,100k,1m"
+DEFAULT_REPEAT = 5
+DEFAULT_WORKDIR = os.path.join(ROOT, ".bench")
+# 合成データの最終日を固定して、いつ実行しても同じDBになるようにする
+BENCH_END_DATE = datetime.date(2025, 1, 31)
+REGRESSION_RATIO = 1.2         # --compare でこの倍率以上遅くなった項目を REGRESSION と表示する
+REGRESSION_MIN_DELTA_MS = 1.0  # ただし差がこれ未満なら誤差とみなす
+
+
+def parse_size(text: str) -> int:
+    text = text.strip().lower()
+    units = {"k": 1_000, "m": 1_000_000}
+    if text[-1:] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+# -----------------------------
+# Worker（1サイズ分の計測）
+# -----------------------------
+def _install_gemini_stub():
+    """google.generativeai をスタブに差し替える。計測対象は Gemini を呼ばないので、呼ばれたら失敗させる。"""
+    # google.protobuf など本物の google パッケージを先に読み込んでおく
+    importlib.import_module("streamlit")
+
+    def _refuse(*args, **kwargs):
+        raise RuntimeError("ベンチマーク中に Gemini が呼ばれました")
+
+    stub = types.ModuleType("google.generativeai")
+    stub.configure = lambda **kwargs: None
+    stub.GenerativeModel = lambda *args, **kwargs: types.SimpleNamespace(generate_content=_refuse)
+    sys.modules.setdefault("google", types.ModuleType("google"))
+    sys.modules["google.generativeai"] = stub
+
+
+def _summarize(samples: list) -> dict:
+    ms = sorted(s * 1000 for s in samples)
+    p95_index = min(len(ms) - 1, max(0, round(0.95 * (len(ms) - 1))))
+    return {
+        "n": len(ms),
+        "min_ms": round(ms[0], 3),
+        "median_ms": round(statistics.median(ms), 3),
+        "p95_ms": round(ms[p95_index], 3),
+        "max_ms": round(ms[-1], 3),
+    }
+
+
+def _time(fn, repeat: int, before=None) -> dict:
+    samples = []
+    for _ in range(repeat):
+        if before:
+            before()
+        started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - started)
+    return _summarize(samples)
+
+
+# _execute_plan の結果の形。action の指定漏れなどで別の処理（既定の filter）に落ちたら計測を止める
+PLAN_EXPECTATIONS = {
+    "period_sum_by_date_30d": (r"date別のsum", ["date", "calories", "protein"], lambda n: 0 < n <= 30),
+    "top10_meals_by_calories_1y": (r"caloriesの上位10件", ["date", "meal_type", "food_name", "calories"],
+                                   lambda n: n == 10),
+    "name_contains_avg_by_meal_type": (r"meal_type別のavg", ["meal_type", "calories"], lambda n: n > 0),
+    "meal_type_filter_rows_30d": (r"\d+件ヒット", ["date", "meal_type", "food_name", "calories", "fat"],
+                                  lambda n: n > 0),
+}
+
+
+def _check_plan_result(name: str, out, summary: str):
+    pattern, columns, rows_ok = PLAN_EXPECTATIONS[name]
+    if not re.fullmatch(pattern, summary) or list(out.columns) != columns or not rows_ok(len(out)):
+        raise RuntimeError(
+            f"{name}: 想定と違う結果です（{summary!r}、列 {list(out.columns)}、{len(out)}行）"
+        )
+
+
+def run_worker(db_path: str, rows: int, repeat: int) -> dict:
+    _install_gemini_stub()
+    app = synth_data._import_app(db_path)
+    app.init_db()
+
+    today = BENCH_END_DATE
+
+    # _sum_today は「今日」を見るので、合成データの最終日を今日として扱う
+    class _BenchDate(datetime.date):
+        @classmethod
+        def today(cls):
+            return today
+
+    bench_datetime = types.ModuleType("datetime")
+    bench_datetime.__dict__.update(datetime.__dict__)
+    bench_datetime.date = _BenchDate
+    app.datetime = bench_datetime
+    month_ago = today - datetime.timedelta(days=29)
+    year_ago = today - datetime.timedelta(days=364)
+    plans = {
+        "period_sum_by_date_30d": {
+            "action": "aggregate",
+            "date_range": {"start": month_ago.isoformat(), "end": today.isoformat()},
+            "metrics": ["calories", "protein"], "agg": "sum", "group_by": "date",
+        },
+        "top10_meals_by_calories_1y": {
+            "action": "top_n",
+            "date_range": {"start": year_ago.isoformat(), "end": today.isoformat()},
+            "metrics": ["calories"], "top_n": 10, "sort_by": "calories", "sort_order": "desc",
+        },
+        "name_contains_avg_by_meal_type": {
+            "action": "aggregate",
+            "name_contains": "丼", "metrics": ["calories"], "agg": "avg", "group_by": "meal_type",
+        },
+        "meal_type_filter_rows_30d": {
+            "action": "filter",
+            "date_range": {"start": month_ago.isoformat(), "end": today.isoformat()},
+            "meal_types": ["夕食"], "metrics": ["calories", "fat"],
+        },
+    }
+
+    ops = {}
+
+    def measure(name, fn, clear=None, warm=True):
+        ops[name] = {"cold": _time(fn, repeat, before=clear)}
+        if warm and clear is not None:
+            fn()
+            ops[name]["warm"] = _time(fn, repeat)
+
+    measure("get_all_records", app.get_all_records, clear=app._load_all_records.clear)
+    measure("get_records_by_period_30d", lambda: app.get_records_by_period(month_ago, today))
+    measure("get_records_by_period_1y", lambda: app.get_records_by_period(year_ago, today))
+    measure("get_favorite_meals", app.get_favorite_meals, clear=app._load_favorite_meals.clear)
+    measure("_sum_today", app._sum_today, clear=app._load_daily_totals.clear)
+    measure(
+        "meal_editor_first_page",
+        lambda: app._meal_editor_frame(app.get_records_page(50)[0]),
+        clear=app._load_records_page.clear,
+    )
+    measure("analytics_frame", app.get_analytics_frame, clear=app._load_analytics_frame.clear)
+    frame = app.get_analytics_frame()
+    for name, plan in plans.items():
+        _check_plan_result(name, *app._execute_plan(frame, plan))
+        measure(f"_execute_plan.{name}", lambda plan=plan: app._execute_plan(frame, plan))
+
+    gemini_calls = app.gemini_call_stats()
+    if gemini_calls:
+        raise RuntimeError(f"Gemini が呼ばれました: {gemini_calls}")
+    return {"rows": rows, "ops": ops}
+
+
+# -----------------------------
+# Driver
+# -----------------------------
+def _metadata(args) -> dict:
+    import sqlite3
+    import pandas as pd
+    try:
+        revision = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return {
+        "created_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "git_revision": revision,
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "pandas": pd.__version__,
+        "platform": platform.platform(),
+        "repeat": args.repeat,
+        "seed": args.seed,
+        "end_date": BENCH_END_DATE.isoformat(),
+    }
+
+
+def _ensure_db(workdir: str, rows: int, seed: int) -> tuple:
+    """合成DBを用意する。既にあれば再利用し、(パス, 生成にかかった秒数 or None) を返す。"""
+    os.makedirs(workdir, exist_ok=True)
+    db_path = os.path.join(workdir, f"bench_{rows}_s{seed}.db")
+    if os.path.exists(db_path):
+        return db_path, None
+    # 生成も app.py を読み込むので、計測と同じく別プロセスで行う
+    proc = subprocess.run(
+        [sys.executable, os.path.join(ROOT, "scripts", "synth_data.py"), "--db", db_path, "--json",
+         "--rows", str(rows), "--seed", str(seed), "--end-date", BENCH_END_DATE.isoformat()],
+        capture_output=True, text=True,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"合成データの生成に失敗しました:\n{proc.stderr}")
+    return db_path, json.loads(proc.stdout)["elapsed_s"]
+
+
+def compare(base: dict, current: dict, ratio: float = REGRESSION_RATIO) -> list:
+    """median_ms を比べて (サイズ, 項目, 旧, 新, 倍率, 退行か) の一覧を返す。"""
+    rows = []
+    for size, result in current["results"].items():
+        base_ops = base.get("results", {}).get(size, {}).get("ops", {})
+        for op, phases in result["ops"].items():
+            for phase, stats in phases.items():
+                old = base_ops.get(op, {}).get(phase)
+                if not old or not old["median_ms"]:
+                    continue
+                r = stats["median_ms"] / old["median_ms"]
+                regressed = r >= ratio and stats["median_ms"] - old["median_ms"] >= REGRESSION_MIN_DELTA_MS
+                rows.append((size, f"{op} [{phase}]", old["median_ms"], stats["median_ms"], r, regressed))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="diet_app の DB・集計処理のベンチマーク")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help=f"食事記録の行数（カンマ区切り、既定: {DEFAULT_SIZES}）")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT, help="各項目の計測回数")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--workdir", default=DEFAULT_WORKDIR, help="合成DBの保存先")
+    parser.add_argument("--out", default=None, help="結果 JSON の出力先（既定: 標準出力）")
+    parser.add_argument("--compare", default=None, help="比較対象の結果 JSON")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--db", help=argparse.SUPPRESS)
+    parser.add_argument("--rows", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.worker:
+        print(json.dumps(run_worker(args.db, args.rows, args.repeat)))
+        return 0
+
+    report = {"meta": _metadata(args), "results": {}}
+    for size in [parse_size(s) for s in args.sizes.split(",") if s.strip()]:
+        print(f"[{size:,} 行] 合成データを準備中...", file=sys.stderr)
+        db_path, generate_s = _ensure_db(args.workdir, size, args.seed)
+        print(f"[{size:,} 行] 計測中...", file=sys.stderr)
+        proc = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--worker", "--db", db_path,
+             "--rows", str(size), "--repeat", str(args.repeat)],
+            capture_output=True, text=True,
+        )
+        if proc.returncode != 0:
+            print(proc.stderr, file=sys.stderr)
+            return 1
+        result = json.loads(proc.stdout.strip().splitlines()[-1])
+        result["generate_s"] = generate_s
+        report["results"][str(size)] = result
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+        print(f"結果を {args.out} に書き出しました。", file=sys.stderr)
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            base = json.load(f)
+        rows = compare(base, report)
+        for size, op, old, new, r, regressed in rows:
+            mark = "  REGRESSION" if regressed else ""
+            print(f"{int(size):>9,} {op:<48} {old:>10.2f}ms → {new:>10.2f}ms  x{r:.2f}{mark}", file=sys.stderr)
+        if any(row[-1] for row in rows):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
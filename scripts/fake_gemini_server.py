@@ -0,0 +1,280 @@
+"""Gemini API（REST）のローカルスタブと、それに対する負荷試験。
+
+    # スタブを起動（0.3秒±0.2秒で応答し、10% を 429/503 にする）
+    python scripts/fake_gemini_server.py serve --latency-ms 300 --jitter-ms 200 --error-rate 0.1
+
+    # アプリをスタブに向ける
+    DIET_APP_GEMINI_ENDPOINT=http://127.0.0.1:8765 streamlit run app.py
+
+    # app.py のヘルパーを並列に呼んで、リトライ・遮断・同時実行制限の挙動を見る
+    python scripts/fake_gemini_server.py load --requests 200 --concurrency 16
+
+実行中の障害注入は POST /_control（例: {"error_rate": 1.0}）、受信数などは GET /_stats で確認できる。
+応答はリクエストの response_schema（無ければプロンプトの内容）から、栄養推定・修正案・運動・集計計画・SQL・
+アドバイスのどれかを見分けてそれらしく返す。
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+DEFAULT_PORT = 8765
+_STATUS_NAMES = {429: "RESOURCE_EXHAUSTED", 500: "INTERNAL", 503: "UNAVAILABLE", 504: "DEADLINE_EXCEEDED"}
+
+_NUTRIENTS = {"calories": 520.0, "protein": 21.0, "carbohydrates": 70.0, "fat": 17.0,
+              "vitaminD": 0.3, "salt": 6.0, "zinc": 1.6, "folic_acid": 30.0}
+
+
+_MEAL = {
+    "summary": "スタブの推定結果",
+    "totalNutrients": _NUTRIENTS,
+    "dishes": [{"name": "ラーメン", "rationale": "スタブ", "nutrients": _NUTRIENTS}],
+}
+# response_schema の項目名 → 返す JSON。app.py のヘルパーはどれも JSON モードでスキーマを付けて呼ぶ
+_SCHEMA_REPLIES = [
+    ({"response_text", "updated_data"}, {"response_text": "スタブの修正案です。", "updated_data": _MEAL}),
+    ({"summary", "totalNutrients", "dishes"}, _MEAL),
+    ({"foodName", "nutrients"}, {"foodName": "ラーメン", "nutrients": _NUTRIENTS, "note": "スタブ"}),
+    ({"name", "duration"}, {"name": "ランニング", "duration": 30}),
+    ({"action", "metrics"}, {"action": "aggregate", "metrics": ["calories"], "agg": "sum", "group_by": "date"}),
+    ({"sql", "params"}, {"sql": "SELECT date, SUM(calories) FROM meals GROUP BY date LIMIT 30",
+                         "params": [], "intent": "日別カロリー"}),
+]
+
+
+def _fake_reply(prompt: str, schema: dict = None) -> str:
+    """スキーマ（無ければプロンプトの内容）から、どのヘルパーの呼び出しかを見分けて応答を作る。"""
+    fields = set((schema or {}).get("properties") or {})
+    for wanted, reply in _SCHEMA_REPLIES:
+        if wanted <= fields:
+            return json.dumps(reply, ensure_ascii=False)
+    if fields:
+        raise ValueError(f"未知のスキーマです: {sorted(fields)}")
+    # スキーマ無しの呼び出し（アドバイスなど）。修正依頼のプロンプトは dishes も含むので先に見る
+    if '"response_text"' in prompt or "updated_data" in prompt:
+        return json.dumps(_SCHEMA_REPLIES[0][1], ensure_ascii=False)
+    if "dishes" in prompt:
+        return json.dumps(_MEAL, ensure_ascii=False)
+    if "指定スキーマのJSON" in prompt:
+        return json.dumps(_SCHEMA_REPLIES[4][1])
+    if '"sql"' in prompt:
+        return json.dumps(_SCHEMA_REPLIES[5][1], ensure_ascii=False)
+    if '"duration"' in prompt:
+        return json.dumps(_SCHEMA_REPLIES[3][1], ensure_ascii=False)
+    if '"foodName"' in prompt:
+        return json.dumps(_SCHEMA_REPLIES[2][1], ensure_ascii=False)
+    return "バランスの良い食事が続いています。たんぱく質をもう少し増やしましょう。（スタブ応答）"
+
+
+class FakeGemini:
+    """応答遅延と障害率を実行中に変えられるスタブの状態。"""
+
+    def __init__(self, latency_ms: float, jitter_ms: float, error_rate: float, error_codes: list, seed: int = None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.error_codes = error_codes
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.stats = {"requests": 0, "errors": 0, "in_flight": 0, "max_in_flight": 0}
+
+    def configure(self, **changes):
+        with self._lock:
+            for key in ("latency_ms", "jitter_ms", "error_rate", "error_codes"):
+                if key in changes:
+                    setattr(self, key, changes[key])
+
+    def begin(self):
+        """遅延（秒）と、返すエラーコード（正常なら None）を決める。"""
+        with self._lock:
+            self.stats["requests"] += 1
+            self.stats["in_flight"] += 1
+            self.stats["max_in_flight"] = max(self.stats["max_in_flight"], self.stats["in_flight"])
+            delay = max(0.0, self.latency_ms + self._rng.uniform(-self.jitter_ms, self.jitter_ms)) / 1000
+            error = self._rng.choice(self.error_codes) if self._rng.random() < self.error_rate else None
+            if error:
+                self.stats["errors"] += 1
+            return delay, error
+
+    def end(self):
+        with self._lock:
+            self.stats["in_flight"] -= 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {**self.stats, "latency_ms": self.latency_ms, "jitter_ms": self.jitter_ms,
+                    "error_rate": self.error_rate, "error_codes": self.error_codes}
+
+
+def _make_handler(state: FakeGemini):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, fmt, *args):
+            pass
+
+        def _send_json(self, status: int, payload):
+            body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _read_json(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            return json.loads(self.rfile.read(length) or b"{}")
+
+        def do_GET(self):
+            if urlparse(self.path).path == "/_stats":
+                self._send_json(200, state.snapshot())
+            else:
+                self._send_json(404, {"error": {"code": 404, "message": "not found", "status": "NOT_FOUND"}})
+
+        def do_POST(self):
+            path = urlparse(self.path).path
+            body = self._read_json()
+            if path == "/_control":
+                state.configure(**body)
+                self._send_json(200, state.snapshot())
+                return
+            if not (path.endswith(":generateContent") or path.endswith(":streamGenerateContent")):
+                self._send_json(404, {"error": {"code": 404, "message": "not found", "status": "NOT_FOUND"}})
+                return
+            delay, error = state.begin()
+            try:
+                time.sleep(delay)
+                if error:
+                    self._send_json(error, {"error": {
+                        "code": error, "message": "fake error injected", "status": _STATUS_NAMES.get(error, "UNKNOWN"),
+                    }})
+                    return
+                prompt = "".join(
+                    part.get("text", "") for content in body.get("contents", []) for part in content.get("parts", [])
+                )
+                config = body.get("generationConfig") or body.get("generation_config") or {}
+                try:
+                    text = _fake_reply(prompt, config.get("responseSchema") or config.get("response_schema"))
+                except ValueError as e:
+                    self._send_json(400, {"error": {"code": 400, "message": str(e), "status": "INVALID_ARGUMENT"}})
+                    return
+                usage = {"promptTokenCount": len(prompt) // 2, "candidatesTokenCount": len(text) // 2,
+                         "totalTokenCount": len(prompt) // 2 + len(text) // 2}
+
+                def chunk(t):
+                    return {"candidates": [{"content": {"parts": [{"text": t}], "role": "model"},
+                                            "finishReason": 1, "index": 0}], "usageMetadata": usage}
+
+                if path.endswith(":streamGenerateContent"):
+                    # REST のストリーミングは JSON 配列を少しずつ返す
+                    pieces = [text[i:i + 40] for i in range(0, len(text), 40)] or [""]
+                    self._send_json(200, [chunk(p) for p in pieces])
+                else:
+                    self._send_json(200, chunk(text))
+            finally:
+                state.end()
+
+    return Handler
+
+
+def serve(args):
+    state = FakeGemini(args.latency_ms, args.jitter_ms, args.error_rate,
+                       [int(c) for c in args.error_codes.split(",")], seed=args.seed)
+    server = ThreadingHTTPServer((args.host, args.port), _make_handler(state))
+    print(f"fake Gemini: http://{args.host}:{server.server_port}", file=sys.stderr, flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def _percentile(values: list, q: float):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def load(args):
+    """app.py を UI なしで読み込み、analyze_text_with_gemini を並列に呼ぶ。"""
+    endpoint = args.endpoint
+    os.environ["DIET_APP_GEMINI_ENDPOINT"] = endpoint
+    os.environ.setdefault("GOOGLE_API_KEY", "fake-key")
+    # 解析キャッシュが効かないよう、使い捨てのDBに書く
+    workdir = tempfile.mkdtemp(prefix="diet_app_load_")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import synth_data
+    app = synth_data._import_app(os.path.join(workdir, "load.db"))
+    app.init_db()
+
+    def one(i):
+        started = time.perf_counter()
+        try:
+            ok = app.analyze_text_with_gemini(f"負荷試験の食事 {i}: ラーメンと餃子") is not None
+        except Exception:
+            ok = False
+        return ok, time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(one, range(args.requests)))
+    elapsed = time.perf_counter() - started
+    latencies = [t * 1000 for _, t in results]
+    report = {
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "ok": sum(1 for ok, _ in results if ok),
+        "failed": sum(1 for ok, _ in results if not ok),
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(args.requests / elapsed, 2) if elapsed else None,
+        "latency_p50_ms": round(_percentile(latencies, 0.5), 1),
+        "latency_p95_ms": round(_percentile(latencies, 0.95), 1),
+        "models": app.gemini_call_stats(),
+        "metrics": [row for row in app._get_metrics().summary() if row["op"].startswith("gemini.")],
+    }
+    try:
+        from urllib.request import urlopen
+        with urlopen(endpoint.rstrip("/") + "/_stats", timeout=5) as resp:
+            report["server"] = json.loads(resp.read())
+    except OSError:
+        pass
+    print(json.dumps(report, ensure_ascii=False, indent=2, default=str))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Gemini API のローカルスタブ / 負荷試験")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_serve = sub.add_parser("serve", help="スタブサーバーを起動する")
+    p_serve.add_argument("--host", default="127.0.0.1")
+    p_serve.add_argument("--port", type=int, default=DEFAULT_PORT)
+    p_serve.add_argument("--latency-ms", type=float, default=300.0)
+    p_serve.add_argument("--jitter-ms", type=float, default=100.0)
+    p_serve.add_argument("--error-rate", type=float, default=0.0, help="エラーを返す割合（0〜1）")
+    p_serve.add_argument("--error-codes", default="429,503", help="返すエラーの HTTP ステータス（カンマ区切り）")
+    p_serve.add_argument("--seed", type=int, default=None)
+    p_serve.set_defaults(func=serve)
+
+    p_load = sub.add_parser("load", help="app.py のヘルパーをスタブに対して並列に呼ぶ")
+    p_load.add_argument("--endpoint", default=f"http://127.0.0.1:{DEFAULT_PORT}")
+    p_load.add_argument("--requests", type=int, default=100)
+    p_load.add_argument("--concurrency", type=int, default=8)
+    p_load.set_defaults(func=load)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,223 @@
+"""ベンチマーク・動作確認用の合成データを diet_records.db（または指定したDB）に書き込む。
+
+    python scripts/synth_data.py --years 3
+    python scripts/synth_data.py --rows 100000 --db /tmp/bench.db --force
+
+同じ --seed / --end-date なら同じ内容になる。スキーマは app.py のマイグレーションで作るので、
+daily_totals などの派生テーブルもトリガー経由で実データと同じように埋まる。
+"""
+
+import argparse
+import datetime
+import json
+import math
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 料理名, 種類, (kcal, P, C, F, ビタミンD, 塩分, 亜鉛, 葉酸)
+FOODS = [
+    ("ご飯", "主食", (252, 3.8, 55.7, 0.5, 0.0, 0.0, 0.9, 5)),
+    ("食パン", "主食", (158, 5.3, 28.0, 2.5, 0.0, 0.8, 0.5, 18)),
+    ("おにぎり（鮭）", "主食", (190, 5.5, 39.0, 1.0, 3.2, 1.1, 0.7, 8)),
+    ("味噌汁", "汁物", (45, 3.0, 4.5, 1.5, 0.0, 1.5, 0.3, 12)),
+    ("焼き鮭", "主菜", (160, 22.0, 0.1, 7.5, 25.6, 0.9, 0.4, 15)),
+    ("鶏の唐揚げ", "主菜", (290, 18.0, 12.0, 18.0, 0.2, 1.4, 1.5, 12)),
+    ("豚の生姜焼き", "主菜", (330, 20.0, 9.0, 23.0, 0.1, 1.8, 2.3, 4)),
+    ("とんかつ", "主菜", (450, 23.0, 15.0, 33.0, 0.3, 1.2, 2.2, 5)),
+    ("ハンバーグ", "主菜", (380, 20.0, 14.0, 26.0, 0.3, 1.6, 3.8, 22)),
+    ("麻婆豆腐", "主菜", (260, 15.0, 9.0, 18.0, 0.1, 2.4, 1.6, 30)),
+    ("納豆", "副菜", (90, 7.4, 5.4, 4.5, 0.0, 0.0, 0.9, 54)),
+    ("冷奴", "副菜", (72, 6.6, 1.6, 4.2, 0.0, 0.5, 0.6, 12)),
+    ("ほうれん草のおひたし", "副菜", (25, 2.2, 3.0, 0.3, 0.0, 0.6, 0.6, 168)),
+    ("もやし炒め", "副菜", (80, 2.5, 4.0, 6.0, 0.0, 0.8, 0.3, 35)),
+    ("サラダ", "副菜", (60, 1.5, 5.0, 4.0, 0.0, 0.4, 0.2, 60)),
+    ("ゆで卵", "副菜", (76, 6.2, 0.2, 5.2, 1.9, 0.2, 0.7, 22)),
+    ("カレーライス", "一品", (750, 18.0, 110.0, 24.0, 0.2, 3.3, 3.0, 40)),
+    ("ラーメン", "一品", (520, 21.0, 70.0, 17.0, 0.3, 6.0, 1.6, 30)),
+    ("親子丼", "一品", (690, 28.0, 100.0, 17.0, 1.0, 3.0, 2.5, 45)),
+    ("牛丼", "一品", (700, 22.0, 98.0, 23.0, 0.1, 2.8, 5.2, 20)),
+    ("ざるそば", "一品", (330, 14.0, 64.0, 2.0, 0.0, 2.5, 1.0, 25)),
+    ("パスタ（ミートソース）", "一品", (620, 22.0, 85.0, 19.0, 0.2, 2.9, 3.5, 38)),
+    ("ヨーグルト", "間食", (62, 3.6, 4.9, 3.0, 0.0, 0.1, 0.4, 11)),
+    ("バナナ", "間食", (86, 1.1, 22.5, 0.2, 0.0, 0.0, 0.2, 26)),
+    ("チョコレート", "間食", (280, 3.5, 28.0, 17.0, 0.5, 0.0, 0.8, 9)),
+    ("ポテトチップス", "間食", (330, 3.0, 33.0, 21.0, 0.0, 0.6, 0.3, 40)),
+    ("ホエイプロテイン", "プロテイン", (115, 22.0, 3.0, 1.5, 0.0, 0.2, 0.3, 0)),
+    ("マルチビタミン", "サプリ", (5, 0.0, 1.0, 0.0, 10.0, 0.0, 6.0, 240)),
+    ("ビタミンD", "サプリ", (1, 0.0, 0.0, 0.1, 25.0, 0.0, 0.0, 0)),
+    ("水", "水分補給", (0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0)),
+    ("緑茶", "水分補給", (4, 0.4, 0.4, 0.0, 0.0, 0.0, 0.0, 32)),
+]
+EXERCISES = ["ウォーキング", "ランニング", "筋トレ", "ヨガ", "水泳", "サイクリング", "ストレッチ"]
+_NUTRIENT_KEYS = ("calories", "protein", "carbohydrates", "fat", "vitaminD", "salt", "zinc", "folic_acid")
+
+# 1日の食事の組み立て: (種類, 候補の分類, 記録される確率)
+DAY_TEMPLATE = [
+    ("朝食", ("主食",), 0.9),
+    ("朝食", ("汁物", "副菜"), 0.6),
+    ("昼食", ("一品",), 0.95),
+    ("夕食", ("主食",), 0.9),
+    ("夕食", ("主菜",), 0.95),
+    ("夕食", ("副菜", "汁物"), 0.7),
+    ("間食", ("間食",), 0.5),
+    ("プロテイン", ("プロテイン",), 0.2),
+    ("サプリ", ("サプリ",), 0.4),
+    ("水分補給", ("水分補給",), 0.6),
+]
+MEALS_PER_DAY = sum(p for _, _, p in DAY_TEMPLATE)
+FAVORITE_RATE = 0.005     # お気に入りにする記録の割合
+EXERCISE_RATE = 0.5       # 運動を記録する日の割合
+BATCH_SIZE = 10_000
+
+
+def _import_app(db_path: str):
+    """DB の場所を環境変数で渡してから app.py を（UI を描画せずに）読み込む。"""
+    os.environ["DIET_APP_DB_FILE"] = os.path.abspath(db_path)
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    import app
+    import logging
+    for name in list(logging.root.manager.loggerDict):
+        if name.startswith("streamlit"):
+            logging.getLogger(name).setLevel(logging.ERROR)
+    return app
+
+
+def _foods_by_kind():
+    kinds = {}
+    for name, kind, values in FOODS:
+        kinds.setdefault(kind, []).append((name, values))
+    return kinds
+
+
+def iter_days(end_date: datetime.date, seed: int):
+    """end_date から過去に向かって1日分ずつ (日付, 食事行, 運動行) を返す。"""
+    rng = random.Random(seed)
+    kinds = _foods_by_kind()
+    day = end_date
+    while True:
+        meals = []
+        for meal_type, wanted, prob in DAY_TEMPLATE:
+            if rng.random() > prob:
+                continue
+            name, values = rng.choice([f for kind in wanted for f in kinds[kind]])
+            scale = rng.uniform(0.7, 1.3)
+            nutrients = {k: round(v * scale, 1) for k, v in zip(_NUTRIENT_KEYS, values)}
+            meals.append((day, meal_type, name, nutrients, rng.random() < FAVORITE_RATE))
+        exercises = []
+        if rng.random() < EXERCISE_RATE:
+            exercises.append((day, rng.choice(EXERCISES), rng.choice([10, 15, 20, 30, 45, 60, 90])))
+        yield day, meals, exercises
+        day -= datetime.timedelta(days=1)
+
+
+def generate(db_path: str, rows: int = None, years: float = None, seed: int = 42,
+             end_date: datetime.date = None, force: bool = False, progress=None) -> dict:
+    """合成データを書き込み、件数と所要時間を返す。rows（食事の行数）か years のどちらかを指定する。"""
+    if rows is None and years is None:
+        raise ValueError("rows か years を指定してください")
+    if os.path.exists(db_path):
+        if not force:
+            raise ValueError(f"{db_path} は既に存在します（上書きする場合は --force）")
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(db_path + suffix):
+                os.remove(db_path + suffix)
+    if rows is None:
+        rows = math.ceil(years * 365 * MEALS_PER_DAY)
+    end_date = end_date or datetime.date.today()
+
+    app = _import_app(db_path)
+    started = time.perf_counter()
+    app.migrate_db()
+    meal_count = exercise_count = favorite_count = 0
+    meal_batch, favorite_batch, exercise_batch = [], [], []
+
+    def flush():
+        nonlocal meal_batch, favorite_batch, exercise_batch
+        with app.db_transaction() as conn:
+            conn.executemany(app._INSERT_MEAL_SQL, [app._meal_row(*m[:4]) for m in meal_batch])
+            if favorite_batch:
+                # 直前に入れた行の id は連番なので、バッチ内の位置から求められる
+                last_id = conn.execute("SELECT MAX(id) FROM meals").fetchone()[0]
+                first_id = last_id - len(meal_batch) + 1
+                conn.executemany(
+                    "UPDATE meals SET is_favorite = 1 WHERE id = ?",
+                    [(first_id + i,) for i in favorite_batch],
+                )
+            conn.executemany(
+                "INSERT INTO exercises (date, exercise_name, duration_minutes) VALUES (?, ?, ?)",
+                [(d.strftime("%Y-%m-%d"), name, minutes) for d, name, minutes in exercise_batch],
+            )
+        meal_batch, favorite_batch, exercise_batch = [], [], []
+        if progress:
+            progress(meal_count, rows)
+
+    for _, meals, exercises in iter_days(end_date, seed):
+        for meal in meals[: rows - meal_count]:
+            if meal[4]:
+                favorite_batch.append(len(meal_batch))
+                favorite_count += 1
+            meal_batch.append(meal)
+            meal_count += 1
+        exercise_batch.extend(exercises)
+        exercise_count += len(exercises)
+        if len(meal_batch) >= BATCH_SIZE:
+            flush()
+        if meal_count >= rows:
+            break
+    flush()
+
+    with app.get_db_connection() as conn:
+        conn.execute("PRAGMA optimize")
+        start = conn.execute("SELECT MIN(date) FROM meals").fetchone()[0]
+    return {
+        "db": os.path.abspath(db_path),
+        "meals": meal_count,
+        "exercises": exercise_count,
+        "favorites": favorite_count,
+        "date_range": [start, end_date.strftime("%Y-%m-%d")],
+        "seed": seed,
+        "elapsed_s": time.perf_counter() - started,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="diet_app 用の合成データを生成する")
+    parser.add_argument("--db", default="diet_records.db", help="書き込み先のDB（既定: diet_records.db）")
+    size = parser.add_mutually_exclusive_group(required=True)
+    size.add_argument("--rows", type=int, help="食事記録の行数")
+    size.add_argument("--years", type=float, help="何年分の記録を作るか")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--end-date", type=datetime.date.fromisoformat, default=None,
+                        help="最終日（YYYY-MM-DD、既定: 今日）")
+    parser.add_argument("--force", action="store_true", help="既存のDBを削除して作り直す")
+    parser.add_argument("--json", action="store_true", help="結果を JSON で出力する")
+    args = parser.parse_args(argv)
+
+    def progress(done, total):
+        print(f"\r{done:,} / {total:,} 行", end="", file=sys.stderr, flush=True)
+
+    try:
+        result = generate(args.db, rows=args.rows, years=args.years, seed=args.seed,
+                          end_date=args.end_date, force=args.force, progress=progress)
+    except ValueError as e:
+        print(f"\n{e}", file=sys.stderr)
+        return 2
+    print(file=sys.stderr)
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False))
+        return 0
+    print(
+        f"{result['db']}: 食事 {result['meals']:,} 件 / 運動 {result['exercises']:,} 件 / "
+        f"お気に入り {result['favorites']:,} 件（{result['date_range'][0]} 〜 {result['date_range'][1]}、"
+        f"{result['elapsed_s']:.1f}秒）"
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,10 @@
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# app.py は import 時に DB の場所を決めるので、実データに触れないよう先に差し替える
+os.environ.setdefault("DIET_APP_DB_FILE", os.path.join(tempfile.mkdtemp(prefix="diet_app_test_"), "test.db"))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
@@ -0,0 +1,97 @@
+"""scripts/fake_gemini_server.py のスタブに対して、JSON を返す全ヘルパーが応答を読めることを確かめる。"""
+import io
+import json
+import os
+import sys
+import threading
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+import app
+
+pytest.importorskip("google.generativeai")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts"))
+import fake_gemini_server  # noqa: E402
+
+
+@pytest.fixture(scope="module")
+def stub():
+    state = fake_gemini_server.FakeGemini(latency_ms=0, jitter_ms=0, error_rate=0.0, error_codes=[503], seed=0)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), fake_gemini_server._make_handler(state))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}", state
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def gemini(stub, monkeypatch):
+    endpoint, state = stub
+    monkeypatch.setenv("GOOGLE_API_KEY", "fake-key")
+    monkeypatch.setattr(app, "GEMINI_API_ENDPOINT", endpoint)
+    app._get_genai.clear()
+    app._get_model_registry.clear()
+    app.init_db()
+    yield state
+    app._get_genai.clear()
+    app._get_model_registry.clear()
+
+
+def _assert_meal_analysis(data):
+    assert data["dishes"] and data["dishes"][0]["name"] == "ラーメン"
+    assert data["totalNutrients"]["calories"] == 520.0
+
+
+def test_text_analysis(gemini):
+    _assert_meal_analysis(app._analyze_text(f"スタブ確認 {id(gemini)} ラーメン"))
+
+
+def test_image_analysis(gemini):
+    Image = pytest.importorskip("PIL.Image")
+    buf = io.BytesIO()
+    Image.new("RGB", (64, 48), (10, 20, 30)).save(buf, format="JPEG")
+    _assert_meal_analysis(app._analyze_image(buf.getvalue()))
+
+
+def test_exercise_helpers(gemini):
+    assert app.parse_exercise_from_text("30分走った") == {"name": "ランニング", "duration": 30}
+    assert app.correct_exercise_from_text({"name": "ランニング", "duration": 20}, "30分だった")["duration"] == 30
+
+
+def test_nutrition_refinement(gemini):
+    current = {"summary": "s", "totalNutrients": {}, "dishes": [{"name": "ラーメン", "nutrients": {}}]}
+    result = app.refine_nutrition_with_ai([{"role": "user", "content": "量は半分"}], current)
+    assert result["response_text"] == "スタブの修正案です。"
+    _assert_meal_analysis(result["updated_data"])
+
+
+def test_note_refinement(gemini):
+    result = app._refine_by_note("ラーメン", {"calories": 500}, "大盛り")
+    assert result["foodName"] == "ラーメン"
+    assert result["nutrients"]["salt"] == 6.0
+
+
+def test_query_planner(gemini):
+    plan = app._nl_to_plan("日別のカロリー合計は？")
+    assert plan["action"] == "aggregate"
+    assert plan["metrics"] == ["calories"]
+
+
+def test_sql_generation(gemini):
+    result = app.llm_to_sql("日別のカロリー")
+    assert result["sql"].startswith("SELECT")
+    assert result["intent"] != "parse_error"
+
+
+@pytest.mark.parametrize("schema, validate", [
+    (app.MEAL_ANALYSIS_SCHEMA, app.validate_meal_analysis),
+    (app.EXERCISE_SCHEMA, app.validate_exercise),
+    (app.NUTRITION_REFINEMENT_SCHEMA, app.validate_nutrition_refinement),
+    (app.NOTE_REFINEMENT_SCHEMA, app.validate_note_refinement),
+    (app.QUERY_PLAN_SCHEMA, app.validate_query_plan),
+    (app.SQL_QUERY_SCHEMA, app.validate_sql_query),
+])
+def test_reply_follows_schema_not_prompt(schema, validate):
+    # プロンプトの文言に関係なく、指定されたスキーマどおりの応答を返す
+    validate(json.loads(fake_gemini_server._fake_reply("dishes response_text updated_data", schema)))
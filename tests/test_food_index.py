@@ -0,0 +1,46 @@
+import pytest
+
+import app
+
+
+def _index(*names):
+    index = app._FoodIndex()
+    for i, name in enumerate(names):
+        index._add(name, (100.0 + i, 10.0, 20.0, 5.0, 0.0, 1.0, 1.0, 10.0), append_new=False)
+    return index
+
+
+@pytest.mark.parametrize("known, query", [
+    ("鶏むね肉200g", "鶏むね肉100g"),
+    ("チャーシュー麺並盛り", "チャーシュー麺大盛り"),
+    ("ご飯小", "ご飯大"),
+    ("焼き鳥5本", "焼き鳥3本"),
+    ("牛丼並盛", "牛丼特盛"),
+])
+def test_fuzzy_match_rejects_different_portion(known, query):
+    assert _index(known).lookup(query) is None
+
+
+@pytest.mark.parametrize("known, query", [("鶏むね肉200g", "鶏むね肉100g"), ("チャーシュー麺並盛り", "チャーシュー麺大盛り")])
+def test_portion_difference_alone_is_above_cutoff(known, query):
+    # 名前の類似度だけなら一致してしまう組み合わせ（数量・盛りの比較がないと中央値を流用してしまう）
+    ratio = app.difflib.SequenceMatcher(None, app.food_key(query), app.food_key(known)).ratio()
+    assert ratio >= app.FOOD_INDEX_FUZZY_CUTOFF
+
+
+def test_fuzzy_match_picks_candidate_with_same_portion():
+    index = _index("鶏むね肉200g", "鶏むね肉 100g（皮なし）")
+    name, nutrients, n = index.lookup("鶏むね肉100g皮無し")
+    assert name == "鶏むね肉 100g（皮なし）"
+    assert n == 1
+
+
+def test_fuzzy_match_without_quantities():
+    name, _, _ = _index("鮭のおにぎり").lookup("鮭おにぎり")
+    assert name == "鮭のおにぎり"
+
+
+def test_exact_key_ignores_width_and_symbols():
+    name, nutrients, _ = _index("鶏むね肉100g").lookup("鶏むね肉 １００ｇ")
+    assert name == "鶏むね肉100g"
+    assert nutrients["calories"] == 100.0
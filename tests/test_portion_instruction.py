@@ -0,0 +1,40 @@
+import pytest
+
+import app
+
+DISHES = [
+    {"name": "ご飯", "nutrients": {}},
+    {"name": "焼き鳥", "nutrients": {}},
+    {"name": "ビール", "nutrients": {}},
+    {"name": "とんかつ", "nutrients": {}},
+]
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("半分しか食べてない", {0: 0.5, 1: 0.5, 2: 0.5, 3: 0.5}),
+    ("ご飯は1.5倍", {0: 1.5}),
+    ("ご飯とビールは半分", {0: 0.5, 2: 0.5}),
+    ("とんかつは3分の1", {3: 1 / 3}),
+    ("ご飯は半分、焼き鳥は2倍", {0: 0.5, 1: 2.0}),
+])
+def test_pure_scaling_is_applied_locally(text, expected):
+    assert app.parse_portion_instruction(text, DISHES) == pytest.approx(expected)
+
+
+@pytest.mark.parametrize("text", [
+    "ご飯以外は半分",
+    "ご飯じゃなくてパンを2倍",
+    "ご飯とビール以外は半分",
+    "焼き鳥5本じゃなくて半分",
+    "ご飯は大盛りで2倍",
+    "ご飯とかは半分",
+    "ご飯大盛りは半分",
+    "ビールは飲んでいない",
+])
+def test_anything_beyond_scaling_goes_to_ai(text):
+    assert app.parse_portion_instruction(text, DISHES) is None
+
+
+def test_subject_must_be_part_of_dish_name():
+    assert app._match_dishes("ご飯", [{"name": "白ご飯"}]) == [0]
+    assert app._match_dishes("白ご飯大盛り", [{"name": "白ご飯"}]) == []
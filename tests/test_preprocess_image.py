@@ -0,0 +1,46 @@
+import io
+import random
+
+import pytest
+
+import app
+
+Image = pytest.importorskip("PIL.Image")
+
+
+def _jpeg(size, quality, exif=None):
+    buf = io.BytesIO()
+    # ノイズ画像は圧縮が効きにくく、高画質で再エンコードすると元より大きくなる
+    rng = random.Random(0)
+    img = Image.frombytes("RGB", size, bytes(rng.getrandbits(8) for _ in range(size[0] * size[1] * 3)))
+    kwargs = {"exif": exif} if exif is not None else {}
+    img.save(buf, format="JPEG", quality=quality, **kwargs)
+    return buf.getvalue()
+
+
+def test_small_compressed_jpeg_is_sent_as_is():
+    raw = _jpeg((320, 240), quality=40)
+    out, stats = app.preprocess_image(raw, quality=95)
+    assert out == raw
+    assert stats["kept_original"]
+    assert "削減" not in app._format_preprocess_stats(stats)
+
+
+def test_large_photo_is_downscaled():
+    raw = _jpeg((1600, 1200), quality=95)
+    out, stats = app.preprocess_image(raw)
+    assert not stats["kept_original"]
+    assert stats["processed_size"] == (app.IMAGE_MAX_EDGE, app.IMAGE_MAX_EDGE * 3 // 4)
+    assert stats["saved_bytes"] > 0
+
+
+def test_metadata_is_still_stripped_even_if_output_grows():
+    exif = Image.Exif()
+    exif[0x010F] = "TestCamera"
+    raw = _jpeg((320, 240), quality=40, exif=exif.tobytes())
+    out, stats = app.preprocess_image(raw, quality=95)
+    assert out != raw
+    assert not Image.open(io.BytesIO(out)).getexif()
+    caption = app._format_preprocess_stats(stats)
+    assert stats["saved_bytes"] < 0
+    assert "削減" not in caption and "メタデータ" in caption
@@ -0,0 +1,96 @@
+import types
+
+import pytest
+
+import app
+
+
+@pytest.mark.parametrize("data", [
+    {},
+    {"action": "aggregate"},
+    {"action": "aggregate", "metrics": ["bogus"]},
+    {"action": "explain", "metrics": ["calories"]},
+    {"date_range": {"start": "2024-01-01", "end": "2024-01-31"}},
+])
+def test_plan_without_action_or_metrics_is_rejected(data):
+    with pytest.raises(app.StructuredOutputError):
+        app.validate_query_plan(data)
+
+
+def test_valid_plan_keeps_known_fields_only():
+    plan = app.validate_query_plan({
+        "action": "aggregate", "metrics": ["calories", "bogus"], "agg": "avg", "group_by": "weekday",
+        "date_range": {"start": "2024-01-01", "end": "2024-01-31"},
+    })
+    assert plan["metrics"] == ["calories"]
+    assert plan["agg"] == "avg"
+    assert plan["group_by"] is None
+    assert plan["date_range"] == {"start": "2024-01-01", "end": "2024-01-31"}
+
+
+def test_uninterpretable_question_is_not_cached_or_postprocessed(monkeypatch):
+    calls = []
+    monkeypatch.setattr(app, "_nl_to_plan", lambda q: calls.append(q) or {})
+    question = "今週の天気はどう？"
+    assert app.plan_question(question) == ({}, False)
+    # 保存されていないので、次も AI に問い合わせる
+    assert app.plan_question(question) == ({}, False)
+    assert len(calls) == 2
+
+
+def _plan(start, end):
+    return {"action": "aggregate", "metrics": ["calories"], "agg": "sum", "group_by": None,
+            "date_range": {"start": start, "end": end}}
+
+
+@pytest.fixture
+def today(monkeypatch):
+    """app.py から見た「今日」を差し替える。"""
+    real = app.datetime
+    state = {"today": real.date(2025, 10, 10)}
+
+    class _Date(real.date):
+        @classmethod
+        def today(cls):
+            return state["today"]
+
+    fake = types.ModuleType("datetime")
+    fake.__dict__.update(real.__dict__)
+    fake.date = _Date
+    monkeypatch.setattr(app, "datetime", fake)
+    return state
+
+
+@pytest.mark.parametrize("question, planned", [
+    ("9月の合計カロリーは？", _plan("2025-09-01", "2025-09-30")),
+    ("2025年の合計カロリーは？", _plan("2025-01-01", "2025-12-31")),
+    ("2024年3月のたんぱく質は？", _plan("2024-03-01", "2024-03-31")),
+])
+def test_cached_absolute_period_is_not_shifted(monkeypatch, today, question, planned):
+    monkeypatch.setattr(app, "_nl_to_plan", lambda q: dict(planned))
+    first, from_cache = app.plan_question(question)
+    assert not from_cache
+    today["today"] = app.datetime.date(2025, 10, 20)
+    second, from_cache = app.plan_question(question)
+    assert from_cache
+    assert second["date_range"] == planned["date_range"]
+
+
+def test_cached_rolling_window_is_shifted(monkeypatch, today):
+    monkeypatch.setattr(app, "_nl_to_plan", lambda q: _plan("2025-10-05", "2025-10-05"))
+    app.plan_question("5日前の脂質は？")
+    today["today"] = app.datetime.date(2025, 10, 20)
+    plan, from_cache = app.plan_question("5日前の脂質は？")
+    assert from_cache
+    assert plan["date_range"] == {"start": "2025-10-15", "end": "2025-10-15"}
+
+
+def test_calendar_relative_question_is_planned_again_on_another_day(monkeypatch, today):
+    calls = []
+    monkeypatch.setattr(app, "_nl_to_plan", lambda q: calls.append(q) or _plan("2025-01-01", "2025-10-10"))
+    app.plan_question("今年の合計カロリーは？")
+    assert app.plan_question("今年の合計カロリーは？")[1]   # 同じ日ならキャッシュを使う
+    today["today"] = app.datetime.date(2025, 10, 20)
+    plan, from_cache = app.plan_question("今年の合計カロリーは？")
+    assert not from_cache
+    assert len(calls) == 2
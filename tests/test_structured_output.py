@@ -0,0 +1,68 @@
+import json
+import types
+
+import pytest
+
+import app
+
+
+def _nutrients(calories):
+    return {k: (calories if k == "calories" else 1.0) for k in app._NUTRIENT_KEYS}
+
+
+FULL = json.dumps({
+    "dishes": [
+        {"name": "焼き鮭", "rationale": "切り身80g", "nutrients": _nutrients(160)},
+        {"name": "ご飯", "rationale": "茶碗1杯", "nutrients": _nutrients(252)},
+    ],
+    "summary": "焼き魚定食",
+    "totalNutrients": _nutrients(412),
+}, ensure_ascii=False)
+
+
+def test_complete_response_is_not_marked_repaired():
+    data, repaired = app._parse_structured("```json\n" + FULL + "\n```", app.validate_meal_analysis, "test")
+    assert not repaired
+    assert [d["name"] for d in data["dishes"]] == ["焼き鮭", "ご飯"]
+
+
+def test_truncated_response_drops_half_written_dish():
+    cut = FULL.index('"ご飯"') + 40
+    data, repaired = app._parse_structured(FULL[:cut], app.validate_meal_analysis, "test")
+    assert repaired
+    assert [d["name"] for d in data["dishes"]] == ["焼き鮭"]
+    assert data["totalNutrients"]["calories"] == 160.0
+
+
+def test_truncated_response_without_dishes_is_rejected():
+    text = json.dumps({"totalNutrients": _nutrients(412), "summary": "定食", "dishes": [{"name": "焼き"}]})
+    with pytest.raises(app.StructuredOutputError):
+        app._parse_structured(text[:-5], app.validate_meal_analysis, "test")
+
+
+@pytest.mark.parametrize("text", ['{"a": "x\\u00', '{"a": [1, 2, 3', '{"a": tru', '[{"k": "v"}, {"k'])
+def test_repair_json_closes_at_last_complete_value(text):
+    json.loads(app._repair_json(text))
+
+
+def test_repaired_analysis_is_not_cached(monkeypatch):
+    stored = []
+    monkeypatch.setattr(app, "analysis_cache_get", lambda key: None)
+    monkeypatch.setattr(app, "analysis_cache_put", lambda *args: stored.append(args))
+    reply = [FULL[:FULL.index('"ご飯"') + 40]]
+    monkeypatch.setattr(app, "gemini_generate", lambda *a, **kw: types.SimpleNamespace(text=reply[0]))
+
+    data = app._analyze_text("焼き魚定食")
+    assert data["truncated"] is True
+    assert stored == []
+
+    reply[0] = FULL
+    data = app._analyze_text("焼き魚定食")
+    assert "truncated" not in data
+    assert len(stored) == 1
+
+
+def test_truncated_sql_is_never_used():
+    text = '{"intent": "日別", "params": [], "sql": "SELECT date FROM meals WHERE date >= \'2024'
+    with pytest.raises(app.StructuredOutputError):
+        app._parse_structured(text, app.validate_sql_query, "test")